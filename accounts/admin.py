@@ -1,10 +1,16 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, PatientProfile, DoctorProfile, NurseProfile
+from django.db.models import Q
+
+from clinic import blind_index
+from .models import CustomUser, PatientProfile, DoctorProfile, NurseProfile, hash_email
 
 class CustomUserAdmin(UserAdmin):
     model = CustomUser
     list_display = ['username', 'email', 'role', 'is_staff']
+    # Encrypted columns cannot be matched with icontains; names go through the
+    # blind index and email through email_hash in get_search_results.
+    search_fields = ['username']
     fieldsets = UserAdmin.fieldsets + (
         (None, {'fields': ('role',)}),
     )
@@ -12,7 +18,35 @@ class CustomUserAdmin(UserAdmin):
         (None, {'fields': ('role',)}),
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        term = search_term.strip()
+        if term:
+            results |= queryset.filter(
+                Q(email_hash=hash_email(term))
+                | blind_index.search_q(CustomUser, ['first_name', 'last_name'], term)
+            )
+        return results, may_have_duplicates
+
+
+class PatientProfileAdmin(admin.ModelAdmin):
+    list_display = ['user', 'phone']
+    list_select_related = ['user']
+    sortable_by = ['user']
+    search_fields = ['user__username']
+
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        term = search_term.strip()
+        if term:
+            results |= queryset.filter(
+                blind_index.search_q(PatientProfile, ['phone'], term)
+                | blind_index.search_q(CustomUser, ['first_name', 'last_name'], term, lookup='user')
+            )
+        return results, may_have_duplicates
+
+
 admin.site.register(CustomUser, CustomUserAdmin)
-admin.site.register(PatientProfile)
+admin.site.register(PatientProfile, PatientProfileAdmin)
 admin.site.register(DoctorProfile)
 admin.site.register(NurseProfile)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from clinic import blind_index
+        blind_index.register('accounts.CustomUser', first_name='words', last_name='words')
+        blind_index.register('accounts.PatientProfile', phone='digits')
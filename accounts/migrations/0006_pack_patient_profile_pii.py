@@ -0,0 +1,41 @@
+import clinic.encrypted_fields
+from clinic.encrypted_columns import pack_encrypted_columns, unpack_encrypted_columns
+from django.db import migrations
+
+PACKED_FIELDS = ['phone', 'address', 'date_of_birth']
+
+
+def pack_pii(apps, schema_editor):
+    pack_encrypted_columns(apps.get_model('accounts', 'PatientProfile'), PACKED_FIELDS, 'pii')
+
+
+def unpack_pii(apps, schema_editor):
+    unpack_encrypted_columns(apps.get_model('accounts', 'PatientProfile'), 'pii', PACKED_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_encrypt_user_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientprofile',
+            name='pii',
+            field=clinic.encrypted_fields.EncryptedPackedField(help_text='Encrypted phone, address and date of birth'),
+        ),
+        migrations.RunPython(pack_pii, unpack_pii),
+        migrations.RemoveField(
+            model_name='patientprofile',
+            name='address',
+        ),
+        migrations.RemoveField(
+            model_name='patientprofile',
+            name='date_of_birth',
+        ),
+        migrations.RemoveField(
+            model_name='patientprofile',
+            name='phone',
+        ),
+    ]
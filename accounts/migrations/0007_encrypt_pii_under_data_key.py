@@ -0,0 +1,20 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:03
+
+import clinic.encrypted_fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_pack_patient_profile_pii'),
+        ('clinic', '0006_datakey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='patientprofile',
+            name='pii',
+            field=clinic.encrypted_fields.EncryptedPackedField(data_key='user_id', help_text='Encrypted phone, address and date of birth'),
+        ),
+    ]
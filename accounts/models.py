@@ -4,12 +4,14 @@ from django.conf import settings
 from django.db.models.functions import Lower
 import hashlib
 
+from clinic.encrypted_fields import ChangeTrackingMixin, EncryptedManager, EncryptedQuerySet
+
 
 def hash_email(email: str) -> str:
     normalized = (email or "").strip().lower()
     return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
 
-class CustomUserManager(UserManager):
+class CustomUserManager(UserManager.from_queryset(EncryptedQuerySet)):
     @staticmethod
     def _normalize_full_email(email: str | None) -> str:
         return (email or "").strip().lower()
@@ -42,7 +44,7 @@ class CustomUserManager(UserManager):
         return super().create_superuser(username, email=email_norm, password=password, **extra_fields)
 
 
-class CustomUser(AbstractUser):
+class CustomUser(ChangeTrackingMixin, AbstractUser):
     from clinic.encrypted_fields import EncryptedCharField
     class Role(models.TextChoices):
         ADMIN = 'ADMIN', 'Admin'
@@ -107,20 +109,25 @@ class CustomUser(AbstractUser):
         return False
 
 
-class PatientProfile(models.Model):
-    from clinic.encrypted_fields import EncryptedCharField, EncryptedTextField, EncryptedDateField
+class PatientProfile(ChangeTrackingMixin, models.Model):
+    from clinic.encrypted_fields import EncryptedPackedField, PackedCharField, PackedTextField, PackedDateField
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='patient_profile')
-    phone = EncryptedCharField(max_length=255, blank=True, help_text="Encrypted phone number")
-    address = EncryptedTextField(blank=True, help_text="Encrypted address")
-    date_of_birth = EncryptedDateField(null=True, blank=True, help_text="Encrypted date of birth")
+    pii = EncryptedPackedField(data_key='user_id', help_text="Encrypted phone, address and date of birth")
+    phone = PackedCharField(packed_in='pii', max_length=255, blank=True, help_text="Encrypted phone number")
+    address = PackedTextField(packed_in='pii', blank=True, help_text="Encrypted address")
+    date_of_birth = PackedDateField(packed_in='pii', null=True, blank=True, help_text="Encrypted date of birth")
+
+    objects = EncryptedManager()
 
     def __str__(self):
         return f"Patient: {self.user.username}"
 
-class DoctorProfile(models.Model):
+class DoctorProfile(ChangeTrackingMixin, models.Model):
     from clinic.encrypted_fields import EncryptedCharField
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='doctor_profile')
     specialization = EncryptedCharField(max_length=255, blank=True, help_text="Encrypted specialization")
+
+    objects = EncryptedManager()
     
     def __str__(self):
         return f"Doctor: {self.user.username}"
@@ -20,6 +20,7 @@ from .forms import (
     TwoFactorPasswordResetConfirmForm,
 )
 from .utils import create_2fa_code_for_user, send_2fa_email, verify_2fa_code
+from audit.actions import AuditAction
 from audit.utils import log_action, get_client_ip, make_rate_limit_key, increment_rate_limit, rate_limit_blocked_response
 from audit.signals import twofa_verification_failed
 
@@ -74,7 +75,7 @@ class PatientRegisterView(CreateView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        log_action(self.request, "REGISTER_PATIENT", f"User: {self.object.username}")
+        log_action(self.request, AuditAction.REGISTER_PATIENT, f"User: {self.object.username}")
         messages.success(
             self.request, 
             'Account created successfully. Please log in with your credentials.'
@@ -111,14 +112,14 @@ class TwoFactorLoginView(FormView):
             self.request.session['pending_2fa_user_id'] = user.id
             self.request.session['pending_2fa_created_at'] = timezone.now().isoformat()
             
-            log_action(self.request, "2FA_CODE_SENT", f"User: {user.username}")
+            log_action(self.request, AuditAction.TWO_FACTOR_CODE_SENT, f"User: {user.username}")
             
             return super().form_valid(form)
         except Exception as e:
             form.add_error(None, 'An error occurred. Please try again.')
             log_action(
                 self.request,
-                "2FA_ERROR",
+                AuditAction.TWO_FACTOR_ERROR,
                 resource=f"User: {user.username}",
                 details=f"Exception: {type(e).__name__}",
             )
@@ -193,7 +194,7 @@ class TwoFactorVerifyView(FormView):
 
         if not user.is_active:
             messages.error(self.request, 'This account is inactive.')
-            log_action(self.request, "LOGIN_INACTIVE", f"User: {user.username}", user_obj=user)
+            log_action(self.request, AuditAction.LOGIN_INACTIVE, f"User: {user.username}", user_obj=user)
             self._clear_pending_session()
             return redirect('login')
         
@@ -255,7 +256,7 @@ class DashboardView(LoginRequiredMixin, View):
 class LoggedPasswordChangeView(RecentTwoFactorRequiredMixin, auth_views.PasswordChangeView):
     def form_valid(self, form):
         response = super().form_valid(form)
-        log_action(self.request, "PASSWORD_CHANGE", f"User: {self.request.user.username}")
+        log_action(self.request, AuditAction.PASSWORD_CHANGE, f"User: {self.request.user.username}")
         return response
 
 
@@ -278,7 +279,7 @@ class LoggedPasswordResetView(auth_views.PasswordResetView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        log_action(self.request, "PASSWORD_RESET_REQUEST", "Password reset requested")
+        log_action(self.request, AuditAction.PASSWORD_RESET_REQUEST, "Password reset requested")
         return response
 
 
@@ -304,12 +305,12 @@ class LoggedPasswordResetConfirmView(auth_views.PasswordResetConfirmView):
             if not email_sent:
                 messages.error(self.request, 'Failed to send verification code. Please try again.')
                 return redirect('password_reset')
-            log_action(self.request, "PASSWORD_RESET_2FA_CODE_SENT", f"User: {self.user.username}", user_obj=self.user)
+            log_action(self.request, AuditAction.PASSWORD_RESET_2FA_CODE_SENT, f"User: {self.user.username}", user_obj=self.user)
         except Exception as e:
             messages.error(self.request, 'Could not send verification code. Please try again later.')
             log_action(
                 self.request,
-                "PASSWORD_RESET_2FA_ERROR",
+                AuditAction.PASSWORD_RESET_2FA_ERROR,
                 resource=f"User: {getattr(self.user, 'username', 'unknown')}",
                 details=f"Exception: {type(e).__name__}",
             )
@@ -320,8 +321,8 @@ class LoggedPasswordResetConfirmView(auth_views.PasswordResetConfirmView):
         response = super().form_valid(form)
         user = getattr(self, "user", None)
         if user:
-            log_action(self.request, "PASSWORD_RESET_COMPLETE", f"User: {user.username}", user_obj=user)
+            log_action(self.request, AuditAction.PASSWORD_RESET_COMPLETE, f"User: {user.username}", user_obj=user)
         else:
-            log_action(self.request, "PASSWORD_RESET_COMPLETE", "User: unknown")
+            log_action(self.request, AuditAction.PASSWORD_RESET_COMPLETE, "User: unknown")
         return response
 
@@ -0,0 +1,106 @@
+"""
+Registry of audit action codes.
+
+AuditLog.action stores the code as a small integer; the label is the action's
+name as shown in the UI, archived segments and the hash chain. Codes are
+grouped by area and must never be renumbered or reused: add new actions with
+a fresh code.
+"""
+from django.db import models
+
+
+class AuditAction(models.IntegerChoices):
+    # Authentication
+    LOGIN_SUCCESS = 100, 'LOGIN_SUCCESS'
+    LOGIN_FAILED = 101, 'LOGIN_FAILED'
+    LOGIN_INACTIVE = 102, 'LOGIN_INACTIVE'
+    LOGOUT = 103, 'LOGOUT'
+    RATE_LIMIT_BLOCK = 104, 'RATE_LIMIT_BLOCK'
+    TWO_FACTOR_CODE_SENT = 110, '2FA_CODE_SENT'
+    TWO_FACTOR_ERROR = 111, '2FA_ERROR'
+    TWO_FACTOR_VERIFY_FAILED = 112, '2FA_VERIFY_FAILED'
+
+    # Accounts
+    REGISTER_PATIENT = 200, 'REGISTER_PATIENT'
+    EDIT_PROFILE = 201, 'EDIT_PROFILE'
+    PASSWORD_CHANGE = 210, 'PASSWORD_CHANGE'
+    PASSWORD_RESET_REQUEST = 211, 'PASSWORD_RESET_REQUEST'
+    PASSWORD_RESET_2FA_CODE_SENT = 212, 'PASSWORD_RESET_2FA_CODE_SENT'
+    PASSWORD_RESET_2FA_ERROR = 213, 'PASSWORD_RESET_2FA_ERROR'
+    PASSWORD_RESET_COMPLETE = 214, 'PASSWORD_RESET_COMPLETE'
+
+    # Administration
+    CREATE_PATIENT = 300, 'CREATE_PATIENT'
+    CREATE_STAFF = 301, 'CREATE_STAFF'
+    DELETE_USER = 302, 'DELETE_USER'
+    TOGGLE_PATIENT_STATUS = 303, 'TOGGLE_PATIENT_STATUS'
+    TOGGLE_STAFF_STATUS = 304, 'TOGGLE_STAFF_STATUS'
+    UPDATE_NURSE_ASSIGNMENTS = 305, 'UPDATE_NURSE_ASSIGNMENTS'
+
+    # Clinical changes
+    REQUEST_APPOINTMENT = 400, 'REQUEST_APPOINTMENT'
+    PATIENT_CANCEL_APPT = 401, 'PATIENT_CANCEL_APPT'
+    UPDATE_APPT_STATUS = 402, 'UPDATE_APPT_STATUS'
+    ADD_DIAGNOSIS = 410, 'ADD_DIAGNOSIS'
+    ADD_NOTE = 411, 'ADD_NOTE'
+    EDIT_NOTE = 412, 'EDIT_NOTE'
+    DELETE_NOTE = 413, 'DELETE_NOTE'
+
+    # Reads of patient health information
+    VIEW_PATIENT_LIST_ADMIN = 500, 'VIEW_PATIENT_LIST_ADMIN'
+    VIEW_PATIENT_LIST_MANAGE = 501, 'VIEW_PATIENT_LIST_MANAGE'
+    VIEW_APPOINTMENTS_ADMIN = 502, 'VIEW_APPOINTMENTS_ADMIN'
+    VIEW_PATIENTS_DOCTOR_DASH = 503, 'VIEW_PATIENTS_DOCTOR_DASH'
+    VIEW_APPOINTMENT_HISTORY_DOCTOR = 504, 'VIEW_APPOINTMENT_HISTORY_DOCTOR'
+    VIEW_PATIENTS_NURSE_DASH = 505, 'VIEW_PATIENTS_NURSE_DASH'
+    VIEW_OWN_RECORDS = 506, 'VIEW_OWN_RECORDS'
+    VIEW_PATIENT_FOR_NOTE = 507, 'VIEW_PATIENT_FOR_NOTE'
+    VIEW_PATIENT_DELETE_CONFIRM = 508, 'VIEW_PATIENT_DELETE_CONFIRM'
+
+
+_BY_NAME = {action.label: action for action in AuditAction}
+
+MATCH_EXACT = 'exact'
+MATCH_PREFIX = 'prefix'
+
+
+def action_code(action):
+    """The AuditAction for a member, code or name. Raises ValueError for unregistered actions."""
+    if isinstance(action, str):
+        try:
+            return _BY_NAME[action]
+        except KeyError:
+            raise ValueError(f"Unregistered audit action {action!r}; add it to audit.actions.AuditAction")
+    return AuditAction(action)
+
+
+def action_name(action):
+    return action if isinstance(action, str) else AuditAction(action).label
+
+
+def actions_with_prefix(prefix):
+    prefix = prefix.strip().upper()
+    return [action for name, action in _BY_NAME.items() if name.startswith(prefix)]
+
+
+# Reads of patient records; these also record which patients were viewed (audit.models.PhiAccess).
+PHI_VIEW_ACTIONS = tuple(actions_with_prefix('VIEW_'))
+
+
+def action_prefixes():
+    """The first word of every action name, for prefix pickers."""
+    return sorted({name.split('_', 1)[0] for name in _BY_NAME})
+
+
+def parse_action_filter(value, match=MATCH_PREFIX):
+    """
+    Actions selected by a UI filter: the action named ``value`` (exact) or
+    every action whose name starts with it (prefix). None when there is no
+    filter; an empty list when nothing matches.
+    """
+    value = (value or '').strip().upper()[:64]
+    if not value:
+        return None
+    if match == MATCH_EXACT:
+        return [_BY_NAME[value]] if value in _BY_NAME else []
+    return actions_with_prefix(value)
@@ -1,13 +1,66 @@
+from datetime import datetime, time
+
 from django.contrib import admin
-from .models import AuditLog
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+from accounts.models import CustomUser
+from .actions import PHI_VIEW_ACTIONS, AuditAction, action_prefixes, parse_action_filter
+from .archive import ArchiveQuery, AuditTrail, list_segments
+from .identifiers import reveal_logs
+from .models import AuditLog, PhiAccess
+
+
+class ActionPrefixFilter(admin.SimpleListFilter):
+    """Every action starting with a word (LOGIN, VIEW, ...), as one IN lookup on the action index."""
+    title = 'action group'
+    parameter_name = 'action_prefix'
+
+    def lookups(self, request, model_admin):
+        return [(prefix, prefix) for prefix in action_prefixes()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            group = [action for action in AuditAction if action.label.split('_', 1)[0] == self.value()]
+            return queryset.filter(action__in=group)
+        return queryset
 
 
 @admin.register(AuditLog)
 class AuditLogAdmin(admin.ModelAdmin):
-    list_display = ['timestamp', 'actor', 'action', 'ip_address']
-    list_filter = ['action', 'timestamp']
-    search_fields = ['action', 'actor__username']
+    list_display = ['timestamp', 'actor_display', 'actor_role', 'action', 'ip_address']
+    list_filter = ['action', ActionPrefixFilter, 'actor_role', 'timestamp']
+    search_fields = ['actor__username']
+    search_help_text = 'Exact username of the actor'
     ordering = ['-timestamp']
+    change_list_template = 'admin/audit/auditlog/change_list.html'
+    # Users may live in another database (audit.routers): prefetch instead of joining.
+    list_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('actor')
+
+    @admin.display(description='actor', ordering='actor')
+    def actor_display(self, obj):
+        return obj.actor_name or '-'
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            reveal_logs([obj])
+        return obj
+
+    def get_search_results(self, request, queryset, search_term):
+        username = search_term.strip()[:150]
+        if not username:
+            return queryset, False
+        user_ids = list(CustomUser.objects.filter(username__iexact=username).values_list('pk', flat=True))
+        return queryset.filter(actor_id__in=user_ids), False
+
     def get_readonly_fields(self, request, obj=None):
         if obj:
             return [f.name for f in self.model._meta.fields]
@@ -21,3 +74,125 @@ class AuditLogAdmin(admin.ModelAdmin):
     
     def has_view_permission(self, request, obj=None):
         return request.user.is_staff
+
+    def get_urls(self):
+        urls = [
+            path(
+                'search/',
+                self.admin_site.admin_view(self.search_view),
+                name='audit_auditlog_search',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    @staticmethod
+    def _parse_date(value, end=False):
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return None
+        return timezone.make_aware(datetime.combine(day, time.max if end else time.min))
+
+    def search_view(self, request):
+        """Search the live table and the archived segments together."""
+        if not self.has_view_permission(request):
+            return self.admin_site.login(request)
+        username = (request.GET.get('actor') or '').strip()[:150]
+        actions = parse_action_filter(request.GET.get('action'), request.GET.get('match'))
+        start = self._parse_date(request.GET.get('start'))
+        end = self._parse_date(request.GET.get('end'), end=True)
+
+        qs = AuditLog.objects.all()
+        archive = {'start': start, 'end': end}
+        if username:
+            actor_ids = list(CustomUser.objects.filter(username__iexact=username).values_list('pk', flat=True))
+            qs = qs.filter(actor_id__in=actor_ids)
+            archive['actor_ids'] = actor_ids
+        if actions is not None:
+            qs = qs.filter(action__in=actions)
+            archive['actions'] = actions
+        if start:
+            qs = qs.filter(timestamp__gte=start)
+        if end:
+            qs = qs.filter(timestamp__lt=end)
+
+        page = Paginator(AuditTrail(qs, ArchiveQuery(**archive)), 100).get_page(request.GET.get('page'))
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Search audit log and archive',
+            'page_obj': page,
+            'segments': len(list_segments()),
+            'action_names': AuditAction.labels,
+            'query': request.GET.copy(),
+        }
+        context['query'].pop('page', None)
+        return TemplateResponse(request, 'admin/audit/auditlog/search.html', context)
+
+
+class PhiActionFilter(admin.SimpleListFilter):
+    title = 'action'
+    parameter_name = 'action'
+
+    def lookups(self, request, model_admin):
+        return [(str(action.value), action.label) for action in PHI_VIEW_ACTIONS]
+
+    def queryset(self, request, queryset):
+        if self.value() and self.value().isdigit():
+            return queryset.filter(action=int(self.value()))
+        return queryset
+
+
+@admin.register(PhiAccess)
+class PhiAccessAdmin(admin.ModelAdmin):
+    """
+    Who viewed which patient's records. The patient and actor columns link to
+    every access of that patient or by that actor; searching for a username
+    lists the accesses where the user is either.
+    """
+    list_display = ['timestamp', 'patient_link', 'actor_link', 'action', 'views', 'last_timestamp', 'sequence']
+    list_display_links = None
+    list_filter = [PhiActionFilter, 'timestamp']
+    search_fields = ['patient__username']
+    search_help_text = 'Exact username of a patient or an actor'
+    ordering = ['-timestamp']
+    # Counting every access on each page load defeats the indexes.
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # Prefetched rather than joined, so accesses of deleted users still show.
+        return super().get_queryset(request).prefetch_related('patient', 'actor')
+
+    def get_search_results(self, request, queryset, search_term):
+        username = search_term.strip()[:150]
+        if not username:
+            return queryset, False
+        user_ids = list(CustomUser.objects.filter(username__iexact=username).values_list('pk', flat=True))
+        return queryset.filter(Q(patient_id__in=user_ids) | Q(actor_id__in=user_ids)), False
+
+    def _user_link(self, user, user_id, lookup):
+        url = reverse('admin:audit_phiaccess_changelist') + f'?{lookup}={user_id}'
+        name = user.username if user is not None else f"deleted user {user_id}"
+        return format_html('<a href="{}">{}</a>', url, name)
+
+    @admin.display(description='patient')
+    def patient_link(self, obj):
+        return self._user_link(obj.patient, obj.patient_id, 'patient__id__exact')
+
+    @admin.display(description='actor')
+    def actor_link(self, obj):
+        if obj.actor_id is None:
+            return '-'
+        return self._user_link(obj.actor, obj.actor_id, 'actor__id__exact')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_view_permission(self, request, obj=None):
+        return request.user.is_staff
@@ -0,0 +1,528 @@
+"""
+Cold tier for the audit log.
+
+archive_audit_log moves AuditLog rows older than AUDIT_ARCHIVE_AFTER_DAYS into
+append-only segment files under AUDIT_ARCHIVE_DIR. A segment is a series of
+blocks of up to BLOCK_ROWS rows; each block is serialized, compressed and
+sealed with the key ring as one envelope, so archived entries stay encrypted
+at rest. Next to every ``.seg`` file a ``.idx`` sidecar records the
+segment's time and id range, the offset and time range of each block, and
+bloom filters over the actor ids and actions it contains. The sidecar is
+written last, so a segment without one is incomplete and ignored.
+
+Searches read segments through mmap and decrypt only blocks whose time range
+overlaps the query in segments whose bloom filters may contain the wanted
+actor or action. AuditTrail chains the hot table and the archive into one
+newest-first sequence that Django's Paginator (AuditLogView, the admin's
+archive search) slices like a queryset.
+"""
+import base64
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Max, Min, Q, prefetch_related_objects
+from django.utils import timezone
+
+from clinic.encrypted_fields import raw_ciphertexts
+from clinic.keyring import get_key_ring
+
+from .actions import action_code, action_name
+from .identifiers import reveal_logs
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+BLOCK_ROWS = 1000
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+DEFAULT_SEGMENT_ROWS = 50000
+DEFAULT_COMPRESSION = 'lzma'
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+ROW_FIELDS = ('id', 'timestamp', 'actor_id', 'action', 'ip_address', 'resource', 'details')
+
+
+def archive_dir():
+    return getattr(settings, 'AUDIT_ARCHIVE_DIR', None) or os.path.join(settings.BASE_DIR, 'audit_archive')
+
+
+def archive_after():
+    return timedelta(days=getattr(settings, 'AUDIT_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS))
+
+
+class BloomFilter:
+    """Fixed-size bloom filter over strings, using double hashing of a blake2b digest."""
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_items(cls, items, rate=BLOOM_FALSE_POSITIVE_RATE):
+        items = set(items)
+        count = max(1, len(items))
+        bits = max(64, int(-count * math.log(rate) / math.log(2) ** 2))
+        hashes = max(1, round(bits / count * math.log(2)))
+        bloom = cls(bits, hashes)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def to_dict(self):
+        return {'bits': self.bits, 'hashes': self.hashes, 'data': base64.b64encode(bytes(self.data)).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['bits'], data['hashes'], base64.b64decode(data['data']))
+
+
+class Segment:
+    """One archived segment: its sidecar index and mmap-ed block reads."""
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.rows = index['rows']
+        self.min_ts = datetime.fromisoformat(index['min_ts'])
+        self.max_ts = datetime.fromisoformat(index['max_ts'])
+        self.actors = BloomFilter.from_dict(index['bloom']['actor'])
+        self.actions = BloomFilter.from_dict(index['bloom']['action'])
+
+    def may_contain(self, actor_ids=None, actions=None, start=None, end=None):
+        if start is not None and self.max_ts < start:
+            return False
+        if end is not None and self.min_ts >= end:
+            return False
+        if actor_ids is not None and not any(str(actor_id) in self.actors for actor_id in actor_ids):
+            return False
+        if actions is not None and not any(action in self.actions for action in actions):
+            return False
+        return True
+
+    @staticmethod
+    def overlaps(block, start=None, end=None):
+        if start is not None and datetime.fromisoformat(block['max_ts']) < start:
+            return False
+        if end is not None and datetime.fromisoformat(block['min_ts']) >= end:
+            return False
+        return True
+
+    def blocks(self, start=None, end=None, newest_first=True):
+        """Yield ``(block index entry, rows)`` for blocks overlapping the time range."""
+        blocks = self.index['blocks']
+        if newest_first:
+            blocks = reversed(blocks)
+        ring = get_key_ring()
+        with open(self.path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for block in blocks:
+                if not self.overlaps(block, start, end):
+                    continue
+                sealed = mapped[block['offset']:block['offset'] + block['length']]
+                rows = json.loads(ring.decrypt(sealed))
+                yield block, (reversed(rows) if newest_first else rows)
+
+    def read_block(self, block):
+        with open(self.path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            sealed = mapped[block['offset']:block['offset'] + block['length']]
+        return json.loads(get_key_ring().decrypt(sealed))
+
+
+_segments_cache = {}
+_segments_lock = threading.Lock()
+
+
+def list_segments(directory=None):
+    """Complete segments, newest first. Sidecar indexes are cached by mtime."""
+    directory = directory or archive_dir()
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if not name.endswith('.idx'):
+            continue
+        index_path = os.path.join(directory, name)
+        try:
+            mtime = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        with _segments_lock:
+            cached = _segments_cache.get(index_path)
+        if cached is None or cached[0] != mtime:
+            with open(index_path) as fh:
+                segment = Segment(index_path[:-4] + '.seg', json.load(fh))
+            with _segments_lock:
+                _segments_cache[index_path] = (mtime, segment)
+        else:
+            segment = cached[1]
+        segments.append(segment)
+    segments.sort(key=lambda segment: segment.index['max_id'], reverse=True)
+    return segments
+
+
+def _serialize(row):
+    row = dict(zip(ROW_FIELDS, row))
+    row['timestamp'] = row['timestamp'].isoformat()
+    return [row[name] for name in ROW_FIELDS]
+
+
+def _fsync_write(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_segment(rows, directory=None, compression=None):
+    """
+    Write ``rows`` (tuples in ROW_FIELDS order, in insertion order, with
+    plaintext values) as one segment plus its sidecar index. Returns the segment path.
+    """
+    directory = directory or archive_dir()
+    compression = compression or getattr(settings, 'AUDIT_ARCHIVE_COMPRESSION', DEFAULT_COMPRESSION)
+    os.makedirs(directory, exist_ok=True)
+    ring = get_key_ring()
+
+    body = bytearray()
+    blocks = []
+    for start in range(0, len(rows), BLOCK_ROWS):
+        chunk = rows[start:start + BLOCK_ROWS]
+        payload = json.dumps([_serialize(row) for row in chunk], separators=(',', ':')).encode()
+        sealed = ring.seal(payload, compression)
+        blocks.append({
+            'offset': len(body),
+            'length': len(sealed),
+            'rows': len(chunk),
+            'min_ts': min(row[1] for row in chunk).isoformat(),
+            'max_ts': max(row[1] for row in chunk).isoformat(),
+        })
+        body += sealed
+
+    first, last = rows[0], rows[-1]
+    name = f"audit-{first[1]:%Y%m%dT%H%M%S}-{first[0]}-{last[0]}"
+    path = os.path.join(directory, name + '.seg')
+    index = {
+        'version': FORMAT_VERSION,
+        'rows': len(rows),
+        'min_id': first[0],
+        'max_id': last[0],
+        'min_ts': min(row[1] for row in rows).isoformat(),
+        'max_ts': max(row[1] for row in rows).isoformat(),
+        'blocks': blocks,
+        'bloom': {
+            'actor': BloomFilter.for_items(str(row[2]) for row in rows).to_dict(),
+            'action': BloomFilter.for_items(row[3] for row in rows).to_dict(),
+        },
+    }
+    _fsync_write(path, bytes(body))
+    _fsync_write(os.path.join(directory, name + '.idx'), json.dumps(index).encode())
+    return path
+
+
+def archive_old_entries(older_than=None, segment_rows=DEFAULT_SEGMENT_ROWS, directory=None, dry_run=False):
+    """
+    Move AuditLog rows older than ``older_than`` (default: the configured age)
+    into segments of up to ``segment_rows`` rows, oldest first. Rows are only
+    deleted from the table once their segment is on disk, and a value that
+    cannot be decrypted aborts the run instead of being archived as a
+    placeholder. The table is only cut at a signed checkpoint of the hash
+    chain, so what remains still verifies from that checkpoint. Returns
+    ``(rows archived, segment paths)``.
+    """
+    from .models import AuditCheckpoint, AuditLog
+
+    cutoff = timezone.now() - (older_than if older_than is not None else archive_after())
+    newer = AuditLog.objects.filter(timestamp__gte=cutoff).aggregate(first=Min('sequence'))['first']
+    checkpoints = AuditCheckpoint.objects.all()
+    if newer is not None:
+        checkpoints = checkpoints.filter(sequence__lt=newer)
+    boundary = checkpoints.aggregate(last=Max('sequence'))['last']
+    if boundary is None:
+        return 0, []
+    ring = get_key_ring()
+    archived = 0
+    paths = []
+    while True:
+        qs = AuditLog.objects.filter(sequence__lte=boundary).order_by('sequence')
+        if dry_run:
+            return qs.count(), paths
+        with raw_ciphertexts():
+            rows = list(qs.values_list(*ROW_FIELDS)[:segment_rows])
+        if not rows:
+            return archived, paths
+        # Segments record actions by name, like the hash chain.
+        rows = [
+            (*row[:3], action_name(row[3]), *(ring.decrypt(token).decode('utf-8') if token else token for token in row[4:]))
+            for row in rows
+        ]
+        paths.append(write_segment(rows, directory=directory))
+        ids = [row[0] for row in rows]
+        with transaction.atomic(using=router.db_for_write(AuditLog)):
+            for start in range(0, len(ids), 1000):
+                AuditLog.objects.filter(pk__in=ids[start:start + 1000]).delete()
+        archived += len(rows)
+        if len(rows) < segment_rows:
+            return archived, paths
+
+
+def rewrap_segments(directory=None, ring=None):
+    """
+    Re-seal every block under the primary key and engine of ``ring`` (the
+    configured key ring by default). Returns segments rewritten.
+    """
+    ring = ring or get_key_ring()
+    rewritten = 0
+    for segment in list_segments(directory):
+        body = bytearray()
+        blocks = []
+        with open(segment.path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for block in segment.index['blocks']:
+                sealed = bytes(mapped[block['offset']:block['offset'] + block['length']])
+                sealed = ring.rotate(sealed)
+                blocks.append({**block, 'offset': len(body), 'length': len(sealed)})
+                body += sealed
+        _fsync_write(segment.path, bytes(body))
+        _fsync_write(segment.path[:-4] + '.idx', json.dumps({**segment.index, 'blocks': blocks}).encode())
+        rewritten += 1
+    return rewritten
+
+
+class ArchiveQuery:
+    """
+    Filtered, newest-first view of the archive. ``actor_ids`` and ``actions``
+    (names or codes) are exact matches that the bloom filters can rule
+    segments out on.
+    """
+
+    def __init__(self, actor_ids=None, actions=None, start=None, end=None, directory=None):
+        self.actor_ids = set(actor_ids) if actor_ids is not None else None
+        self.actions = {action_name(action) for action in actions} if actions is not None else None
+        self.start = start
+        self.end = end
+        self.directory = directory
+        self._count = None
+
+    @property
+    def filtered(self):
+        return any(value is not None for value in (self.actor_ids, self.actions)) or (
+            self.start is not None or self.end is not None
+        )
+
+    def _segments(self):
+        return [
+            segment for segment in list_segments(self.directory)
+            if segment.may_contain(self.actor_ids, self.actions, self.start, self.end)
+        ]
+
+    def _matches(self, row):
+        row_id, timestamp, actor_id, action = row[:4]
+        if self.actor_ids is not None and actor_id not in self.actor_ids:
+            return False
+        if self.actions is not None and action not in self.actions:
+            return False
+        if self.start is not None or self.end is not None:
+            timestamp = datetime.fromisoformat(timestamp)
+            if self.start is not None and timestamp < self.start:
+                return False
+            if self.end is not None and timestamp >= self.end:
+                return False
+        return True
+
+    def count(self):
+        if self._count is None:
+            if not self.filtered:
+                self._count = sum(segment.rows for segment in list_segments(self.directory))
+            else:
+                self._count = sum(
+                    sum(1 for row in rows if self._matches(row))
+                    for segment in self._segments()
+                    for _, rows in segment.blocks(self.start, self.end)
+                )
+        return self._count
+
+    def keyset_rows(self, key=None, limit=50, older=True):
+        """
+        The ``limit`` matching rows closest to ``key`` (a ``(timestamp, id)``
+        pair, None for the newest or oldest end), strictly older than it
+        (newest first) or newer than it (oldest first). Blocks are read in
+        order of their time range and reading stops once no remaining block
+        can hold a closer row, so a page costs a few block reads however
+        large the archive is.
+        """
+        start, end = self.start, self.end
+        if key is not None:
+            if older:
+                end = key[0] + timedelta(microseconds=1) if end is None else min(end, key[0] + timedelta(microseconds=1))
+            else:
+                start = key[0] if start is None else max(start, key[0])
+        candidates = []
+        for segment in list_segments(self.directory):
+            if not segment.may_contain(self.actor_ids, self.actions, start, end):
+                continue
+            for block in segment.index['blocks']:
+                if segment.overlaps(block, start, end):
+                    bound = datetime.fromisoformat(block['max_ts' if older else 'min_ts'])
+                    candidates.append((bound, segment, block))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=older)
+
+        found = []
+        for bound, segment, block in candidates:
+            if len(found) >= limit and (bound < found[-1][0][0] if older else bound > found[-1][0][0]):
+                break
+            for row in segment.read_block(block):
+                if not self._matches(row):
+                    continue
+                row_key = (datetime.fromisoformat(row[1]), row[0])
+                if key is not None and (row_key >= key if older else row_key <= key):
+                    continue
+                found.append((row_key, row))
+            found.sort(key=lambda item: item[0], reverse=older)
+            del found[limit:]
+        return [row for _, row in found]
+
+    def approximate_count(self):
+        """Rows in the segments the filters cannot rule out: exact when unfiltered, an upper bound otherwise."""
+        return sum(segment.rows for segment in self._segments())
+
+    def rows(self, offset=0, limit=None):
+        """Matching rows (lists in ROW_FIELDS order), newest first, skipping ``offset``."""
+        found = []
+        for segment in self._segments():
+            for block, rows in segment.blocks(self.start, self.end):
+                if not self.filtered and offset >= block['rows']:
+                    offset -= block['rows']
+                    continue
+                for row in rows:
+                    if not self._matches(row):
+                        continue
+                    if offset:
+                        offset -= 1
+                        continue
+                    found.append(row)
+                    if limit is not None and len(found) >= limit:
+                        return found
+        return found
+
+
+def to_audit_logs(rows):
+    """
+    Unsaved AuditLog instances for archived rows, so templates can render
+    them like table rows. Actors are not loaded; see AuditTrail.
+    """
+    from .models import AuditLog
+
+    logs = []
+    for row_id, timestamp, actor_id, action, ip_address, resource, details in rows:
+        log = AuditLog(
+            id=row_id, timestamp=datetime.fromisoformat(timestamp), actor_id=actor_id, action=action_code(action),
+            ip_address=ip_address, resource=resource, details=details,
+        )
+        log.is_archived = True
+        logs.append(log)
+    return logs
+
+
+class AuditTrail:
+    """
+    The hot AuditLog queryset followed by the archive, newest first. page()
+    walks it with keyset cursors; count() and slicing are what Paginator
+    needs. Archived rows are always older than the rows still in the table.
+    Actors of the returned entries, hot or archived, are prefetched in one
+    query, and the patient identifiers sealed in them opened together
+    (audit.identifiers).
+    """
+
+    def __init__(self, queryset, archive):
+        self.queryset = queryset
+        self.archive = archive
+        self._hot_count = None
+
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.queryset.count()
+        return self._hot_count
+
+    def count(self):
+        return self.hot_count() + self.archive.count()
+
+    def __len__(self):
+        return self.count()
+
+    def approximate_count(self, cap=10000):
+        """
+        ``(count, capped)`` without scanning the whole table: hot rows are
+        counted up to ``cap``, archived ones estimated from the segment
+        indexes.
+        """
+        hot = self.queryset.order_by()[:cap + 1].count()
+        return min(hot, cap) + self.archive.approximate_count(), hot > cap
+
+    def _hot_page(self, key, limit, older):
+        qs = self.queryset
+        if older:
+            if key is not None:
+                qs = qs.filter(Q(timestamp__lt=key[0]) | Q(timestamp=key[0], id__lt=key[1]))
+            return list(qs.order_by('-timestamp', '-id')[:limit])
+        if key is not None:
+            qs = qs.filter(Q(timestamp__gt=key[0]) | Q(timestamp=key[0], id__gt=key[1]))
+        return list(qs.order_by('timestamp', 'id')[:limit])
+
+    def page(self, before=None, after=None, limit=50):
+        """
+        Up to ``limit`` entries, newest first, older than the ``(timestamp,
+        id)`` key ``before`` or newer than the key ``after`` (the newest
+        entries when neither is given). Returns ``(entries, more)``, with
+        ``more`` telling whether entries exist beyond the page in the
+        direction travelled.
+        """
+        want = limit + 1
+        if after is None:
+            items = self._hot_page(before, want, older=True)
+            if len(items) < want:
+                items += to_audit_logs(self.archive.keyset_rows(before, want - len(items), older=True))
+        else:
+            items = to_audit_logs(self.archive.keyset_rows(after, want, older=False))
+            if len(items) < want:
+                items += self._hot_page(after, want - len(items), older=False)
+        more = len(items) > limit
+        items = items[:limit]
+        if after is not None:
+            items.reverse()
+        prefetch_related_objects(items, 'actor')
+        reveal_logs(items)
+        return items, more
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop = key.start or 0, key.stop
+        hot = self.hot_count()
+        items = list(self.queryset[start:hot if stop is None else min(stop, hot)]) if start < hot else []
+        if stop is None or stop > hot:
+            archive_start = max(0, start - hot)
+            limit = None if stop is None else stop - hot - archive_start
+            items += to_audit_logs(self.archive.rows(offset=archive_start, limit=limit))
+        prefetch_related_objects(items, 'actor')
+        reveal_logs(items)
+        return items
+
@@ -0,0 +1,243 @@
+"""
+Tamper-evident hash chain over the audit log.
+
+Every AuditLog row gets the next ``sequence`` number and a ``chain_hash``:
+the SHA-256 of the previous row's chain hash and of the row's own plaintext
+content. Changing, deleting or inserting a row with raw SQL therefore breaks
+the chain at that row. Whoever inserts rows (the audit writer,
+AuditLog.save) extends the chain under a lock on the single AuditChainHead
+row, so sequence numbers stay gapless across processes. Hashes cover
+plaintexts, so rotate_keys re-encrypting the audit columns leaves the chain
+intact.
+
+Every AUDIT_CHAIN_CHECKPOINT_EVERY rows, and after each successful
+verify_audit_chain run, the head of the chain is recorded as an
+AuditCheckpoint signed with an HMAC key that is not stored in the database
+(AUDIT_CHAIN_KEY, or derived from the field encryption keys). Someone able to
+rewrite the audit table can recompute the unkeyed hashes but not the
+signature, so a rewritten range no longer ends at the checkpoint closing it.
+
+Each row records the chain version its hash was computed with. Version 1
+rows, written before actor_role and the coalesced view counts existed, hash
+CONTENT_FIELDS[1] and keep verifying as they were; rows written since hash
+CONTENT_FIELDS[CHAIN_VERSION] and the version itself, so changing a row's role
+or view count, or its version, breaks the chain there.
+
+Each row can be checked against the stored hash of its predecessor, so
+verify_audit_chain checks chunks of rows in parallel. It only has to cover
+rows after the last verified checkpoint, which serves as a signed anchor.
+"""
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE, iter_raw_chunks
+from clinic.encrypted_fields import raw_ciphertexts
+from clinic.keyring import KeyRing, get_key_ring
+
+from .actions import action_name
+
+GENESIS_HASH = '0' * 64
+DEFAULT_CHECKPOINT_EVERY = 10000
+CHAIN_VERSION = 2
+# Fields hashed by each chain version; the encrypted columns come last.
+CONTENT_FIELDS = {
+    1: ('timestamp', 'actor_id', 'action', 'ip_address', 'resource', 'details'),
+    2: (
+        'timestamp', 'actor_id', 'action', 'actor_role', 'views', 'last_timestamp', 'ip_address', 'resource',
+        'details',
+    ),
+}
+ENCRYPTED_FIELDS = ('ip_address', 'resource', 'details')
+CHAIN_FIELDS = ('sequence', 'chain_hash', 'chain_version') + CONTENT_FIELDS[CHAIN_VERSION]
+
+MISMATCH = 'hash mismatch'
+MISSING = 'rows missing before'
+UNREADABLE = 'unreadable'
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _micros(timestamp):
+    return None if timestamp is None else (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def record_digest(prev_hash, sequence, row, version=CHAIN_VERSION):
+    """
+    Chain hash of one row, given the chain hash of the row before it. ``row``
+    maps at least CONTENT_FIELDS[version] to plaintext values. The action is
+    hashed by name, whether given as a name or as its code.
+    """
+    values = {name: row[name] for name in CONTENT_FIELDS[version]}
+    values['action'] = action_name(values['action'])
+    values['timestamp'] = _micros(values['timestamp'])
+    for name in ENCRYPTED_FIELDS:
+        values[name] = values[name] or ''
+    if version == 1:
+        payload = [sequence, *values.values()]
+    else:
+        values['last_timestamp'] = _micros(values['last_timestamp'])
+        payload = [sequence, version, *values.values()]
+    payload = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(bytes.fromhex(prev_hash) + payload.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=32)
+def derive_chain_key(encryption_key):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b'audit.chain',
+    ).derive(base64.urlsafe_b64decode(encryption_key))
+
+
+def signing_keys():
+    """HMAC keys checkpoints may be signed with; the first one signs new checkpoints."""
+    key = getattr(settings, 'AUDIT_CHAIN_KEY', '')
+    if key:
+        return [key.encode() if isinstance(key, str) else key]
+    return [derive_chain_key(material) for _, material in get_key_ring().key_material]
+
+
+def sign_checkpoint(sequence, chain_hash, key=None):
+    key = key or signing_keys()[0]
+    return hmac.new(key, f"{sequence}:{chain_hash}".encode(), hashlib.sha256).hexdigest()
+
+
+def checkpoint_signature_valid(checkpoint, keys=None):
+    return any(
+        hmac.compare_digest(sign_checkpoint(checkpoint.sequence, checkpoint.chain_hash, key), checkpoint.signature)
+        for key in (keys or signing_keys())
+    )
+
+
+def create_checkpoint(sequence, chain_hash, verified=False):
+    from .models import AuditCheckpoint
+
+    checkpoint, _ = AuditCheckpoint.objects.get_or_create(
+        sequence=sequence,
+        defaults={
+            'chain_hash': chain_hash,
+            'signature': sign_checkpoint(sequence, chain_hash),
+            'verified_at': timezone.now() if verified else None,
+        },
+    )
+    return checkpoint
+
+
+def _lock_head():
+    from .models import AuditChainHead, AuditLog
+
+    # Updating the row first takes its lock (on SQLite, the database write
+    # lock) before the head is read, so concurrent writers queue up here.
+    if not AuditChainHead.objects.filter(pk=1).update(sequence=F('sequence')):
+        last = AuditLog.objects.filter(sequence__isnull=False).order_by('-sequence').values_list(
+            'sequence', 'chain_hash'
+        ).first()
+        sequence, chain_hash = last or (0, GENESIS_HASH)
+        return AuditChainHead.objects.create(pk=1, sequence=sequence, chain_hash=chain_hash)
+    return AuditChainHead.objects.get(pk=1)
+
+
+def extend_chain(logs):
+    """
+    Give unsaved AuditLog instances the next sequence numbers and chain
+    hashes. Must run inside the transaction that inserts them.
+    """
+    head = _lock_head()
+    start = head.sequence
+    for log in logs:
+        head.sequence += 1
+        head.chain_hash = record_digest(
+            head.chain_hash, head.sequence, {name: getattr(log, name) for name in CONTENT_FIELDS[CHAIN_VERSION]},
+        )
+        log.sequence, log.chain_hash, log.chain_version = head.sequence, head.chain_hash, CHAIN_VERSION
+    head.save(update_fields=['sequence', 'chain_hash'])
+    every = getattr(settings, 'AUDIT_CHAIN_CHECKPOINT_EVERY', DEFAULT_CHECKPOINT_EVERY)
+    if every and head.sequence // every > start // every:
+        create_checkpoint(head.sequence, head.chain_hash)
+
+
+def iter_chain_chunks(after=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield lists of rows in CHAIN_FIELDS order, by sequence, starting after
+    ``after``, with the encrypted columns as raw tokens.
+    """
+    from .models import AuditLog
+
+    while True:
+        with raw_ciphertexts():
+            rows = list(
+                AuditLog.objects.filter(sequence__gt=after).order_by('sequence').values_list(*CHAIN_FIELDS)[:chunk_size]
+            )
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+        if len(rows) < chunk_size:
+            return
+
+
+_worker_state = {}
+
+
+def init_worker(keys):
+    _worker_state['ring'] = KeyRing(keys)
+
+
+def verify_chain_rows(rows, prev_sequence, prev_hash):
+    """
+    Check a chunk of rows (CHAIN_FIELDS order, tokens as plain str/bytes)
+    following the row ``prev_sequence`` whose chain hash is ``prev_hash``.
+    Runs in a worker process. Returns ``(checked, [(sequence, reason)])``.
+    """
+    ring = _worker_state.get('ring') or get_key_ring()
+    failures = []
+    for sequence, chain_hash, version, *content in rows:
+        if sequence != prev_sequence + 1:
+            failures.append((sequence, MISSING))
+        elif version not in CONTENT_FIELDS:
+            failures.append((sequence, MISMATCH))
+        else:
+            row = dict(zip(CONTENT_FIELDS[CHAIN_VERSION], content))
+            try:
+                row.update(
+                    (name, ring.decrypt(row[name]).decode('utf-8') if row[name] else '') for name in ENCRYPTED_FIELDS
+                )
+            except Exception:
+                failures.append((sequence, UNREADABLE))
+            else:
+                if record_digest(prev_hash, sequence, row, version) != chain_hash:
+                    failures.append((sequence, MISMATCH))
+        prev_sequence, prev_hash = sequence, chain_hash
+    return len(rows), failures
+
+
+def chain_existing_rows(log_model, head_model, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Chain rows written before the chain existed, in primary-key order, and
+    set the head. For the RunPython migration adding the chain, which
+    predates chain versions and so writes version 1 hashes; a value that
+    cannot be decrypted aborts it.
+    """
+    ring = get_key_ring()
+    names = CONTENT_FIELDS[1]
+    fields = [log_model._meta.get_field(name.removesuffix('_id')) for name in names]
+    sequence, chain_hash = 0, GENESIS_HASH
+    for rows in iter_raw_chunks(log_model, fields, chunk_size=chunk_size):
+        objs = []
+        for pk, *values in rows:
+            row = dict(zip(names, values))
+            row.update((name, ring.decrypt(row[name]).decode('utf-8') if row[name] else '') for name in ENCRYPTED_FIELDS)
+            sequence += 1
+            chain_hash = record_digest(chain_hash, sequence, row, version=1)
+            objs.append(log_model(pk=pk, sequence=sequence, chain_hash=chain_hash))
+        log_model._base_manager.bulk_update(objs, ['sequence', 'chain_hash'], batch_size=100)
+    head_model.objects.update_or_create(pk=1, defaults={'sequence': sequence, 'chain_hash': chain_hash})
@@ -0,0 +1,57 @@
+"""
+Patient identifiers in audit entries, sealed under the patient's data key.
+
+Usernames and emails of patients that log_phi_view and the patient admin
+views write into an entry's resource or details are stored as
+``{pii:<token>}``, where the token is a text envelope under the patient's
+data key (clinic.data_keys), inside the entry's own encryption. Pages
+showing entries open them with reveal_identifiers(). Once DeletePatientView
+has destroyed the key they read as ERASED, while the entry itself, and the
+hash chain over its stored text, stay intact.
+"""
+import re
+
+from clinic.data_keys import keys_for_owners
+from clinic.keyring import get_key_ring
+
+ERASED = '[erased]'
+_SEALED_RE = re.compile(r'\{pii:([A-Za-z0-9_=-]+)\}')
+
+
+def seal_identifiers(identifiers):
+    """``{pii:...}`` markers for ``(owner id, value)`` pairs, in order, loading the data keys together."""
+    identifiers = list(identifiers)
+    data_keys = keys_for_owners(list(dict.fromkeys(owner_id for owner_id, _ in identifiers)))
+    ring = get_key_ring()
+    return [
+        '{pii:%s}' % ring.encrypt_text(str(value).encode('utf-8'), data_key=data_keys[owner_id])
+        for owner_id, value in identifiers
+    ]
+
+
+def seal_identifier(owner_id, value):
+    return seal_identifiers([(owner_id, value)])[0]
+
+
+def reveal_identifiers(texts):
+    """
+    ``texts`` with every sealed identifier opened, or replaced by ERASED
+    when it cannot be. The data keys of all of them are loaded together.
+    """
+    texts = list(texts)
+    tokens = list(dict.fromkeys(token for text in texts if text for token in _SEALED_RE.findall(text)))
+    if not tokens:
+        return texts
+    opened = {}
+    for token, result in zip(tokens, get_key_ring().decrypt_many(tokens)):
+        opened[token] = ERASED if isinstance(result, Exception) else result[0].decode('utf-8')
+    return [_SEALED_RE.sub(lambda match: opened[match.group(1)], text) if text else text for text in texts]
+
+
+def reveal_logs(logs):
+    """Open the sealed identifiers in the resource and details of AuditLog instances, in place."""
+    logs = list(logs)
+    texts = reveal_identifiers([text for log in logs for text in (log.resource, log.details)])
+    for index, log in enumerate(logs):
+        log.resource, log.details = texts[2 * index], texts[2 * index + 1]
+    return logs
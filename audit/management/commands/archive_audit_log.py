@@ -0,0 +1,81 @@
+from datetime import timedelta
+
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand, CommandError
+
+from audit.archive import (
+    DEFAULT_SEGMENT_ROWS, archive_after, archive_dir, archive_old_entries, list_segments, rewrap_segments,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Move audit log entries older than AUDIT_ARCHIVE_AFTER_DAYS into compressed, encrypted '
+        'segment files under AUDIT_ARCHIVE_DIR. Archived entries stay searchable from the audit '
+        'log view and the admin'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days',
+            type=int,
+            default=None,
+            help='Archive entries older than this many days instead of AUDIT_ARCHIVE_AFTER_DAYS'
+        )
+        parser.add_argument(
+            '--segment-rows',
+            type=int,
+            default=DEFAULT_SEGMENT_ROWS,
+            help='Maximum entries per segment file'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the entries that would be archived without changing anything'
+        )
+        parser.add_argument(
+            '--rewrap',
+            action='store_true',
+            help='Re-seal existing segments under the current primary key (rotate_keys already does this '
+                 'when it rotates the audit log)'
+        )
+
+    def handle(self, *args, **options):
+        directory = archive_dir()
+        if options['rewrap']:
+            if options['dry_run']:
+                self.stdout.write(f"{len(list_segments(directory))} segments would be rewrapped")
+                return
+            try:
+                rewritten = rewrap_segments(directory)
+            except InvalidToken:
+                raise CommandError("A segment could not be decrypted with the configured key ring")
+            self.stdout.write(self.style.SUCCESS(f"Rewrapped {rewritten} segments in {directory}"))
+            return
+
+        if options['segment_rows'] < 1:
+            raise CommandError("--segment-rows must be positive")
+        if options['older_than_days'] is not None:
+            if options['older_than_days'] < 0:
+                raise CommandError("--older-than-days must not be negative")
+            older_than = timedelta(days=options['older_than_days'])
+        else:
+            older_than = archive_after()
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING("DRY RUN MODE - No changes will be made"))
+        self.stdout.write(f"Archiving audit log entries older than {older_than.days} days to {directory}...")
+        try:
+            archived, paths = archive_old_entries(
+                older_than=older_than, segment_rows=options['segment_rows'], directory=directory,
+                dry_run=options['dry_run'],
+            )
+        except InvalidToken:
+            raise CommandError("An audit log entry could not be decrypted; nothing further was archived")
+
+        if options['dry_run']:
+            self.stdout.write(f"  Entries to archive: {archived}")
+            return
+        for path in paths:
+            self.stdout.write(f"  {path}")
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} entries into {len(paths)} segments."))
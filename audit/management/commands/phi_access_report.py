@@ -0,0 +1,99 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from audit.phi import access_summary, accesses, backfill_phi_access, usernames
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        'Report who viewed a patient\'s records (--patient) or whose records a user viewed (--actor) '
+        'over the last --days days, from the PhiAccess index. --backfill indexes PHI views logged '
+        'before the index existed'
+    )
+
+    def add_arguments(self, parser):
+        who = parser.add_mutually_exclusive_group()
+        who.add_argument('--patient', help='Username of the patient')
+        who.add_argument('--actor', help='Username of the user who viewed the records')
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=90,
+            help='Report on the last this many days'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=100,
+            help='Maximum individual accesses listed after the summary (0 for the summary only)'
+        )
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            help='Index PHI views in the audit table written before PhiAccess existed, from their details'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Audit entries per transaction with --backfill'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='With --backfill, count the rows that would be created without changing anything'
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self._backfill(options)
+            return
+        if not options['patient'] and not options['actor']:
+            raise CommandError("Give --patient or --actor (or --backfill)")
+        if options['days'] < 1:
+            raise CommandError("--days must be positive")
+
+        username = options['patient'] or options['actor']
+        by = 'actor' if options['patient'] else 'patient'
+        try:
+            user = CustomUser.objects.get(username=username)
+        except CustomUser.DoesNotExist:
+            raise CommandError(f"No user named {username!r}")
+
+        since = timezone.now() - timedelta(days=options['days'])
+        if options['patient']:
+            qs = accesses(patient_ids=[user.pk], since=since)
+            self.stdout.write(f"Accesses to the records of {user.username} in the last {options['days']} days:")
+        else:
+            qs = accesses(actor_ids=[user.pk], since=since)
+            self.stdout.write(f"Patient records viewed by {user.username} in the last {options['days']} days:")
+
+        summary = access_summary(qs, by)
+        if not summary:
+            self.stdout.write("  None")
+            return
+        names = usernames(user_id for user_id, *_ in summary)
+        for user_id, views, first, last in summary:
+            name = names.get(user_id, f"deleted user {user_id}")
+            self.stdout.write(f"  {name:<30} {views:>6} views  first {first:%Y-%m-%d %H:%M}  last {last:%Y-%m-%d %H:%M}")
+
+        if options['limit'] > 0:
+            self.stdout.write("\nMost recent:")
+            for access in qs.order_by('-timestamp')[:options['limit']]:
+                user_id = getattr(access, f'{by}_id')
+                name = names.get(user_id, f"deleted user {user_id}")
+                views = f" ({access.views} views until {access.last_timestamp:%H:%M:%S})" if access.views > 1 else ""
+                self.stdout.write(f"  {access.timestamp:%Y-%m-%d %H:%M:%S}  {name:<30} {access.get_action_display()}{views}")
+
+    def _backfill(self, options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING("DRY RUN MODE - No changes will be made"))
+        entries, created = backfill_phi_access(chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        verb = 'Would create' if options['dry_run'] else 'Created'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {created} PHI access rows from {entries} audit entries."))
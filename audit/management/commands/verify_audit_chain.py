@@ -0,0 +1,194 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from audit.chain import (
+    GENESIS_HASH, checkpoint_signature_valid, create_checkpoint, init_worker, iter_chain_chunks,
+    sign_checkpoint, signing_keys, verify_chain_rows,
+)
+from audit.models import AuditCheckpoint, AuditLog
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE
+from clinic.keyring import get_key_ring
+from clinic.management.commands.rotate_keys import _InlineExecutor, _plain
+
+MAX_LISTED_FAILURES = 50
+
+
+class Command(BaseCommand):
+    help = (
+        'Verify the audit log hash chain. Only rows after the last verified checkpoint are checked '
+        '(--full checks everything still in the table), in chunks decrypted and hashed in a process '
+        'pool; each checkpoint range must end at its signed checkpoint. A successful run signs a new '
+        'checkpoint at the head, so the next run starts there. Exits non-zero on any mismatch'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Verify from the oldest row in the table instead of the last verified checkpoint'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows per chunk'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Worker processes used for verification (1 runs inline)'
+        )
+        parser.add_argument(
+            '--no-checkpoint',
+            action='store_true',
+            help='Do not sign a checkpoint at the head after a successful run'
+        )
+        parser.add_argument(
+            '--resign',
+            action='store_true',
+            help='After a successful run, re-sign every checkpoint with the current key. Before removing '
+                 'an old key from the ring, run rotate_keys (which also re-seals the archived segments, '
+                 'or archive_audit_log --rewrap on its own) and then this'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        workers = max(1, options['workers'])
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        keys = signing_keys()
+        failures = []
+        checkpoints = {}
+        for checkpoint in AuditCheckpoint.objects.order_by('sequence'):
+            if checkpoint_signature_valid(checkpoint, keys):
+                checkpoints[checkpoint.sequence] = checkpoint
+            else:
+                failures.append((checkpoint.sequence, 'checkpoint signature invalid'))
+
+        unchained = AuditLog.objects.filter(sequence__isnull=True).count()
+        if unchained:
+            failures.append((None, f'{unchained} rows without a sequence number'))
+
+        anchor_sequence, anchor_hash = self._anchor(checkpoints, options['full'], failures)
+        self.stdout.write(f"Verifying the audit chain after sequence {anchor_sequence}...")
+        self.stdout.write(f"  Chunk size: {chunk_size}, workers: {workers}")
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker, initargs=(get_key_ring().key_material,)
+            )
+        else:
+            init_worker(get_key_ring().key_material)
+            executor = _InlineExecutor()
+
+        started = time.monotonic()
+        checked = 0
+        last_sequence, last_hash = anchor_sequence, anchor_hash
+        in_flight = deque()
+
+        def complete_oldest():
+            nonlocal checked
+            chunk_checked, chunk_failures = in_flight.popleft().result()
+            checked += chunk_checked
+            failures.extend(chunk_failures)
+
+        try:
+            for rows in iter_chain_chunks(after=anchor_sequence, chunk_size=chunk_size):
+                rows = [(*row[:5], *(_plain(token) for token in row[5:])) for row in rows]
+                in_flight.append(executor.submit(verify_chain_rows, rows, last_sequence, last_hash))
+                for sequence, chain_hash, *_ in rows:
+                    checkpoint = checkpoints.get(sequence)
+                    if checkpoint is not None and checkpoint.chain_hash != chain_hash:
+                        failures.append((sequence, 'does not match its signed checkpoint'))
+                last_sequence, last_hash = rows[-1][:2]
+                if len(in_flight) >= workers * 2:
+                    complete_oldest()
+            while in_flight:
+                complete_oldest()
+        except KeyboardInterrupt:
+            raise CommandError("Verification interrupted")
+        finally:
+            executor.shutdown()
+
+        beyond = [sequence for sequence in checkpoints if sequence > last_sequence]
+        if beyond:
+            failures.append((beyond[0], 'checkpoint beyond the last row (rows deleted)'))
+
+        elapsed = time.monotonic() - started
+        rate = checked / elapsed if elapsed > 0 else 0
+        self.stdout.write(f"  {checked} rows up to sequence {last_sequence} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+        if failures:
+            failures.sort(key=lambda failure: failure[0] or 0)
+            for sequence, reason in failures[:MAX_LISTED_FAILURES]:
+                where = f"sequence {sequence}: " if sequence is not None else ""
+                self.stdout.write(self.style.ERROR(f"  {where}{reason}"))
+            if len(failures) > MAX_LISTED_FAILURES:
+                self.stdout.write(f"  ... and {len(failures) - MAX_LISTED_FAILURES} more")
+            raise CommandError(f"The audit chain is broken in {len(failures)} places")
+
+        now = timezone.now()
+        AuditCheckpoint.objects.filter(
+            sequence__gt=anchor_sequence, sequence__lte=last_sequence, verified_at__isnull=True
+        ).update(verified_at=now)
+        if last_sequence > anchor_sequence and not options['no_checkpoint']:
+            create_checkpoint(last_sequence, last_hash, verified=True)
+            self.stdout.write(f"  Signed checkpoint at sequence {last_sequence}")
+        if options['resign']:
+            for checkpoint in checkpoints.values():
+                checkpoint.signature = sign_checkpoint(checkpoint.sequence, checkpoint.chain_hash, keys[0])
+            AuditCheckpoint.objects.bulk_update(checkpoints.values(), ['signature'], batch_size=500)
+            self.stdout.write(f"  Re-signed {len(checkpoints)} checkpoints")
+
+        self.stdout.write("\n" + "-" * 50)
+        self.stdout.write(self.style.SUCCESS("The audit chain is intact."))
+
+    def _anchor(self, checkpoints, full, failures):
+        """
+        ``(sequence, chain hash)`` to verify from: the last verified checkpoint,
+        or the start of the table (the checkpoint just before its first row
+        when older rows have been archived).
+        """
+        first = AuditLog.objects.aggregate(first=Min('sequence'))['first']
+        if not full:
+            verified = [sequence for sequence, checkpoint in checkpoints.items() if checkpoint.verified_at]
+            if verified:
+                checkpoint = checkpoints[max(verified)]
+                self._check_verified_range(first, checkpoint, failures)
+                return checkpoint.sequence, checkpoint.chain_hash
+        if first is None and checkpoints:
+            # Everything has been archived; the chain ends at the last checkpoint.
+            checkpoint = checkpoints[max(checkpoints)]
+            return checkpoint.sequence, checkpoint.chain_hash
+        if first is None or first == 1:
+            return 0, GENESIS_HASH
+        before = [sequence for sequence in checkpoints if sequence < first]
+        if not before:
+            failures.append((first, 'rows missing before the first row and no checkpoint covers them'))
+            return first - 1, GENESIS_HASH
+        checkpoint = checkpoints[max(before)]
+        return checkpoint.sequence, checkpoint.chain_hash
+
+    def _check_verified_range(self, first, checkpoint, failures):
+        """
+        Cheap checks on the already verified rows an incremental run skips:
+        the anchor row still matches its checkpoint and no row before it is
+        missing. Changed rows in that range are only found by --full.
+        """
+        if first is None or first > checkpoint.sequence:
+            # Everything up to the checkpoint has been archived.
+            return
+        anchor_hash = AuditLog.objects.filter(sequence=checkpoint.sequence).values_list('chain_hash', flat=True).first()
+        if anchor_hash != checkpoint.chain_hash:
+            failures.append((checkpoint.sequence, 'does not match its signed checkpoint'))
+        present = AuditLog.objects.filter(sequence__gte=first, sequence__lte=checkpoint.sequence).count()
+        if present != checkpoint.sequence - first + 1:
+            failures.append((first, f'{checkpoint.sequence - first + 1 - present} verified rows deleted'))
@@ -0,0 +1,36 @@
+import clinic.encrypted_fields
+from clinic.encrypted_columns import copy_encrypted_column
+from django.db import migrations
+
+
+def details_to_binary(apps, schema_editor):
+    copy_encrypted_column(apps.get_model('audit', 'AuditLog'), 'details', 'details_binary')
+
+
+def details_to_text(apps, schema_editor):
+    copy_encrypted_column(apps.get_model('audit', 'AuditLog'), 'details_binary', 'details')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0002_encrypt_audit_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='details_binary',
+            field=clinic.encrypted_fields.EncryptedBinaryTextField(blank=True, help_text='Encrypted details'),
+        ),
+        migrations.RunPython(details_to_binary, details_to_text),
+        migrations.RemoveField(
+            model_name='auditlog',
+            name='details',
+        ),
+        migrations.RenameField(
+            model_name='auditlog',
+            old_name='details_binary',
+            new_name='details',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-16 22:59
+
+import clinic.encrypted_fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0003_store_details_as_binary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='auditlog',
+            name='details',
+            field=clinic.encrypted_fields.EncryptedBinaryTextField(blank=True, compress='zlib', help_text='Encrypted details'),
+        ),
+    ]
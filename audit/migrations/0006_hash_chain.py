@@ -0,0 +1,63 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:21
+
+import django.db.models.deletion
+from audit.chain import chain_existing_rows
+from django.conf import settings
+from django.db import migrations, models
+
+
+def chain_rows(apps, schema_editor):
+    chain_existing_rows(apps.get_model('audit', 'AuditLog'), apps.get_model('audit', 'AuditChainHead'))
+
+
+def unchain_rows(apps, schema_editor):
+    apps.get_model('audit', 'AuditChainHead').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0005_event_timestamp'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditChainHead',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveBigIntegerField(default=0)),
+                ('chain_hash', models.CharField(max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AuditCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveBigIntegerField(unique=True)),
+                ('chain_hash', models.CharField(max_length=64)),
+                ('signature', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('verified_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['sequence'],
+            },
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='chain_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='sequence',
+            field=models.PositiveBigIntegerField(editable=False, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='auditlog',
+            name='actor',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='audit_logs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(chain_rows, unchain_rows),
+    ]
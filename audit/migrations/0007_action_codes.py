@@ -0,0 +1,83 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:25
+
+from audit.actions import AuditAction
+from django.conf import settings
+from django.db import migrations, models
+
+ROLES = ['ADMIN', 'DOCTOR', 'NURSE', 'PATIENT']
+
+
+def actions_to_codes(apps, schema_editor):
+    AuditLog = apps.get_model('audit', 'AuditLog')
+    CustomUser = apps.get_model('accounts', 'CustomUser')
+    names = set(AuditLog.objects.values_list('action', flat=True).distinct())
+    unknown = names - set(AuditAction.labels)
+    if unknown:
+        raise RuntimeError(
+            f"Audit actions not in audit.actions.AuditAction: {', '.join(sorted(unknown))}. Register them first."
+        )
+    for action in AuditAction:
+        if action.label in names:
+            AuditLog.objects.filter(action=action.label).update(action_code=action.value)
+    # Best effort for existing rows: the actor's role today. The ids are
+    # listed rather than subqueried so the statement only touches this table.
+    for role in ROLES:
+        AuditLog.objects.filter(
+            actor_id__in=list(CustomUser.objects.filter(role=role).values_list('pk', flat=True))
+        ).update(actor_role=role)
+
+
+def codes_to_actions(apps, schema_editor):
+    AuditLog = apps.get_model('audit', 'AuditLog')
+    for action in AuditAction:
+        AuditLog.objects.filter(action_code=action.value).update(action=action.label)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0006_hash_chain'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='actor_role',
+            field=models.CharField(blank=True, choices=[('ADMIN', 'Admin'), ('DOCTOR', 'Doctor'), ('NURSE', 'Nurse'), ('PATIENT', 'Patient')], editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='action_code',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        # blank lets the column be re-added with '' when migrating backwards.
+        migrations.AlterField(
+            model_name='auditlog',
+            name='action',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.RunPython(actions_to_codes, codes_to_actions),
+        migrations.RemoveField(
+            model_name='auditlog',
+            name='action',
+        ),
+        migrations.RenameField(
+            model_name='auditlog',
+            old_name='action_code',
+            new_name='action',
+        ),
+        migrations.AlterField(
+            model_name='auditlog',
+            name='action',
+            field=models.PositiveSmallIntegerField(choices=AuditAction.choices),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['action', 'timestamp'], name='audit_action_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['actor_role', 'timestamp'], name='audit_role_ts_idx'),
+        ),
+    ]
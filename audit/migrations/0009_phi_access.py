@@ -0,0 +1,34 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:31
+
+import django.db.models.deletion
+from audit.actions import AuditAction
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0008_timestamp_id_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhiAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.PositiveSmallIntegerField(choices=AuditAction.choices)),
+                ('timestamp', models.DateTimeField(editable=False)),
+                ('sequence', models.PositiveBigIntegerField(editable=False, help_text='Sequence of the audit log entry', null=True)),
+                ('actor', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'PHI access',
+                'verbose_name_plural': 'PHI accesses',
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['patient', 'timestamp'], name='phi_patient_ts_idx'), models.Index(fields=['actor', 'timestamp'], name='phi_actor_ts_idx')],
+            },
+        ),
+    ]
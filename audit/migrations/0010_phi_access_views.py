@@ -0,0 +1,34 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:40
+
+from django.db import migrations, models
+
+
+def fill_last_timestamp(apps, schema_editor):
+    PhiAccess = apps.get_model('audit', 'PhiAccess')
+    PhiAccess.objects.update(last_timestamp=models.F('timestamp'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0009_phi_access'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phiaccess',
+            name='views',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='phiaccess',
+            name='last_timestamp',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_last_timestamp, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='phiaccess',
+            name='last_timestamp',
+            field=models.DateTimeField(editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.15 on 2026-10-17 00:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0010_phi_access_views'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='last_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='auditlog',
+            name='views',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0011_auditlog_views'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditlog',
+            name='chain_version',
+            field=models.PositiveSmallIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -1,27 +1,136 @@
 from django.db import models
 from django.conf import settings
-from django.core.exceptions import PermissionDenied
-from clinic.encrypted_fields import EncryptedCharField, EncryptedTextField
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db import router, transaction
+from django.utils import timezone
+from accounts.models import CustomUser
+from clinic.encrypted_fields import EncryptedBinaryTextField, EncryptedCharField, EncryptedManager
+
+from .actions import AuditAction
 
 
 class AuditLog(models.Model):
-    actor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='audit_logs')
-    action = models.CharField(max_length=64)
+    # Rows keep the id of a deleted actor: nulling it would break the hash chain.
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='audit_logs',
+    )
+    action = models.PositiveSmallIntegerField(choices=AuditAction.choices)
+    # The actor's role when the action happened, so filtering needs no join.
+    actor_role = models.CharField(max_length=10, choices=CustomUser.Role.choices, blank=True, editable=False)
     ip_address = EncryptedCharField(max_length=255, null=True, blank=True, help_text="Encrypted IP address")
     resource = EncryptedCharField(max_length=500, blank=True, help_text="Encrypted target resource")
-    details = EncryptedTextField(blank=True, help_text="Encrypted details")
-    timestamp = models.DateTimeField(auto_now_add=True)
+    details = EncryptedBinaryTextField(blank=True, compress='zlib', help_text="Encrypted details")
+    # Set when the event happens, not when the audit writer inserts it.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # A coalesced PHI view stands for several views, the last at last_timestamp (see audit.writer).
+    views = models.PositiveIntegerField(default=1, editable=False)
+    last_timestamp = models.DateTimeField(null=True, blank=True, editable=False)
+    # Position and digest in the tamper-evident chain (see audit.chain).
+    sequence = models.PositiveBigIntegerField(unique=True, null=True, editable=False)
+    chain_hash = models.CharField(max_length=64, blank=True, editable=False)
+    # Which fields chain_hash covers (audit.chain.CONTENT_FIELDS).
+    chain_version = models.PositiveSmallIntegerField(default=1, editable=False)
+
+    objects = EncryptedManager()
+
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], name='audit_ts_id_idx'),
+            models.Index(fields=['action', 'timestamp'], name='audit_action_ts_idx'),
+            models.Index(fields=['actor_role', 'timestamp'], name='audit_role_ts_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if self.pk is not None:
             raise PermissionDenied("Audit records cannot be modified after creation")
-        super().save(*args, **kwargs)
+        from .chain import extend_chain
+
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(AuditLog, instance=self)):
+            extend_chain([self])
+            super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         raise PermissionDenied("Audit records cannot be deleted")
 
+    @property
+    def actor_name(self):
+        """The actor's username, "deleted user <id>" once the user is gone, or "" for no actor."""
+        if self.actor_id is None:
+            return ""
+        try:
+            actor = self.actor
+        except ObjectDoesNotExist:
+            actor = None
+        # A prefetched actor that no longer exists comes back as None.
+        return actor.username if actor is not None else f"deleted user {self.actor_id}"
+
     def __str__(self):
-        return f"{self.timestamp} - {self.actor} - {self.action}"
+        return f"{self.timestamp} - {self.actor_name or None} - {self.get_action_display()}"
+
+
+class AuditChainHead(models.Model):
+    """The single row holding the last sequence number and chain hash."""
+    sequence = models.PositiveBigIntegerField(default=0)
+    chain_hash = models.CharField(max_length=64)
+
+
+class AuditCheckpoint(models.Model):
+    """A signed record of the chain hash at one sequence number."""
+    sequence = models.PositiveBigIntegerField(unique=True)
+    chain_hash = models.CharField(max_length=64)
+    signature = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    verified_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['sequence']
+
+    def __str__(self):
+        return f"Checkpoint {self.sequence}"
+
 
+
+class PhiAccess(models.Model):
+    """
+    One patient whose records an actor viewed, written by the audit writer in
+    the same transaction as the PHI-view AuditLog row (``sequence``), so
+    per-patient and per-actor access reports need no decryption. Rows stay
+    when the audit row is archived.
+    """
+    # The (patient, timestamp) and (actor, timestamp) indexes cover lookups by either id.
+    patient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        related_name='+',
+    )
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        null=True, blank=True, related_name='+',
+    )
+    action = models.PositiveSmallIntegerField(choices=AuditAction.choices)
+    timestamp = models.DateTimeField(editable=False)
+    # A coalesced audit entry stands for several views (see audit.writer).
+    views = models.PositiveIntegerField(default=1, editable=False)
+    last_timestamp = models.DateTimeField(editable=False)
+    sequence = models.PositiveBigIntegerField(null=True, editable=False, help_text="Sequence of the audit log entry")
+
+    class Meta:
+        ordering = ['-timestamp']
+        verbose_name = 'PHI access'
+        verbose_name_plural = 'PHI accesses'
+        indexes = [
+            models.Index(fields=['patient', 'timestamp'], name='phi_patient_ts_idx'),
+            models.Index(fields=['actor', 'timestamp'], name='phi_actor_ts_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise PermissionDenied("Audit records cannot be modified after creation")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise PermissionDenied("Audit records cannot be deleted")
+
+    def __str__(self):
+        return f"{self.timestamp} - user {self.actor_id} viewed patient {self.patient_id} - {self.get_action_display()}"
@@ -0,0 +1,83 @@
+"""
+Keyset (cursor) pagination for the audit log.
+
+Pages are addressed by the ``(timestamp, id)`` key of the entry next to them
+instead of a page number, so every page is an index range scan of
+``per_page`` rows: no COUNT over the filtered table and no OFFSET that grows
+with the page depth. Cursors are ``<microseconds since epoch>-<id>``.
+"""
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(entry):
+    return f"{(entry.timestamp - _EPOCH) // timedelta(microseconds=1)}-{entry.pk}"
+
+
+def decode_cursor(value):
+    """The ``(timestamp, id)`` key of a cursor, or None if it is malformed."""
+    micros, _, pk = (value or '').partition('-')
+    try:
+        return _EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (ValueError, OverflowError):
+        return None
+
+
+def date_key(value):
+    """Key placing a page at the newest entries on or before the date ``YYYY-MM-DD``."""
+    try:
+        day = datetime.strptime(value or '', '%Y-%m-%d').date()
+    except ValueError:
+        return None
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min)), 0
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_page(trail, params, per_page=50):
+    """
+    The page of ``trail`` (an AuditTrail) that the request parameters ask
+    for: ``before``/``after`` cursors, or ``date`` to jump to a day.
+    """
+    before = decode_cursor(params.get('before')) if params.get('before') else None
+    after = decode_cursor(params.get('after')) if params.get('after') and before is None else None
+    if before is None and after is None:
+        before = date_key(params.get('date'))
+
+    entries, more = trail.page(before=before, after=after, limit=per_page)
+    if not entries and after is not None:
+        # Nothing newer any more: show the newest page.
+        before = after = None
+        entries, more = trail.page(limit=per_page)
+    if not entries:
+        return KeysetPage(entries)
+
+    older = more if after is None else True
+    newer = (more if after is not None else before is not None)
+    return KeysetPage(
+        entries,
+        next_cursor=encode_cursor(entries[-1]) if older else None,
+        previous_cursor=encode_cursor(entries[0]) if newer else None,
+    )
@@ -0,0 +1,101 @@
+"""
+Reports over PhiAccess, the index of which patients each PHI-view audit
+entry covers.
+
+log_phi_view gives the audit writer the ids of the patients on the page, and
+the writer inserts one PhiAccess row per patient next to the encrypted
+AuditLog row. "Who viewed patient X" and "whose records did Y view" are then
+range scans of the (patient, timestamp) and (actor, timestamp) indexes
+instead of decrypting and parsing every entry's details.
+"""
+from django.db import router, transaction
+from django.db.models import Max, Min, Sum
+
+from accounts.models import CustomUser
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE
+
+from .actions import PHI_VIEW_ACTIONS
+from .identifiers import reveal_identifiers
+from .models import AuditLog, PhiAccess
+
+PATIENTS_PREFIX = 'Patients: '
+
+
+def accesses(patient_ids=None, actor_ids=None, since=None, until=None):
+    qs = PhiAccess.objects.all()
+    if patient_ids is not None:
+        qs = qs.filter(patient_id__in=patient_ids)
+    if actor_ids is not None:
+        qs = qs.filter(actor_id__in=actor_ids)
+    if since is not None:
+        qs = qs.filter(timestamp__gte=since)
+    if until is not None:
+        qs = qs.filter(timestamp__lt=until)
+    return qs
+
+
+def access_summary(queryset, by):
+    """
+    One row per ``by`` ('actor' or 'patient') in ``queryset``: its id,
+    number of views and first and last view, most recent first.
+    """
+    return list(
+        queryset.values_list(f'{by}_id').annotate(
+            total=Sum('views'), first=Min('timestamp'), last=Max('last_timestamp'),
+        ).order_by('-last')
+    )
+
+
+def usernames(user_ids):
+    return dict(CustomUser.objects.filter(pk__in=set(user_ids)).values_list('pk', 'username'))
+
+
+def detail_usernames(details):
+    """Patient usernames log_phi_view wrote into revealed details (see audit.identifiers)."""
+    for part in (details or '').split(' | '):
+        if part.startswith(PATIENTS_PREFIX):
+            return [name.strip() for name in part[len(PATIENTS_PREFIX):].split(',') if name.strip()]
+    return []
+
+
+def backfill_phi_access(chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """
+    Create PhiAccess rows for PHI-view entries still in the audit table that
+    were written before it existed, from the patient usernames in their
+    details. Works backwards from the oldest PhiAccess row, one transaction
+    per chunk, so an interrupted run can simply be repeated. Details name at
+    most ten patients per page, and patients deleted since are skipped.
+    Returns ``(entries read, rows created)``.
+    """
+    before = PhiAccess.objects.aggregate(first=Min('sequence'))['first']
+    entries = created = 0
+    while True:
+        qs = AuditLog.objects.filter(action__in=PHI_VIEW_ACTIONS, sequence__isnull=False)
+        if before is not None:
+            qs = qs.filter(sequence__lt=before)
+        chunk = list(qs.order_by('-sequence').only('actor', 'action', 'timestamp', 'details', 'sequence')[:chunk_size])
+        if not chunk:
+            break
+        details = reveal_identifiers(log.details for log in chunk)
+        names = {log.pk: detail_usernames(text) for log, text in zip(chunk, details)}
+        ids = dict(CustomUser.objects.filter(
+            username__in={name for entry in names.values() for name in entry}
+        ).values_list('username', 'pk'))
+        rows = [
+            PhiAccess(
+                patient_id=ids[name], actor_id=log.actor_id, action=log.action, timestamp=log.timestamp,
+                last_timestamp=log.timestamp, sequence=log.sequence,
+            )
+            for log in chunk
+            for name in names[log.pk]
+            if name in ids
+        ]
+        if not dry_run:
+            with transaction.atomic(using=router.db_for_write(PhiAccess)):
+                PhiAccess.objects.bulk_create(rows)
+        entries += len(chunk)
+        created += len(rows)
+        before = chunk[-1].sequence
+        if len(chunk) < chunk_size:
+            break
+    return entries, created
@@ -0,0 +1,359 @@
+"""
+Rate-limit counters.
+
+A hit on a key counts it in a sliding window: windows are aligned to
+multiples of their length, and the count is the hits of the current window
+plus the previous window's weighted by how much of it still overlaps the
+last ``window`` seconds. A key hit more than ``limit`` times is locked out
+for ``lockout`` seconds from that hit, however quickly its count decays.
+Every hit is an atomic read-modify-write, and hit_many()/reset() apply to
+several keys in one locked step.
+
+RATE_LIMIT_BACKEND chooses where the counters live:
+
+- ``cache`` (default): the RATE_LIMIT_CACHE cache, shared by every host that
+  uses it. Caches with an atomic ``incr`` (memcached, Redis, locmem) count
+  with it; the database cache, whose ``incr`` is a get followed by a set,
+  counts under a per-key mutex taken with ``add``. The file and dummy caches
+  are refused.
+- ``local``: a memory-mapped table in RATE_LIMIT_PATH (under /dev/shm when
+  it exists) shared by the processes of ONE host, updated under flock. Each
+  host counts separately, so only set it for single-host deployments.
+
+Both fail closed: a hit that cannot be counted (the mutex stays taken, or
+every slot a key may use holds a live lockout) is reported as blocked.
+"""
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('cache', 'local')
+DEFAULT_BACKEND = 'cache'
+DEFAULT_SLOTS = 16384
+PROBES = 8
+# Seconds a hit waits for another request's mutex on a key, and after which
+# the mutex of a request that died expires.
+MUTEX_WAIT = 2.0
+MUTEX_TIMEOUT = 5
+WRITE_ATTEMPTS = 4
+# Seconds a hit that could not be counted is refused for.
+UNAVAILABLE_RETRY_AFTER = 1.0
+
+_MAGIC = b'CLNRATE2'
+# Magic, slot count and the random salt of the slot hash.
+_HEADER = struct.Struct('<8sI4x16s')
+# Key digest, window number, expiry, lockout end, hits in the window and in the previous one.
+_SLOT = struct.Struct('<16sqddII')
+_EMPTY_SLOT = bytes(_SLOT.size)
+
+
+class Usage(namedtuple('Usage', 'count blocked retry_after')):
+    """
+    A key's sliding-window count after a hit, whether it is over its limit
+    or locked out, and the seconds left of the lockout.
+    """
+
+
+def _lockout_seconds(lockout, count, window):
+    if lockout is None:
+        return window
+    return lockout(count) if callable(lockout) else lockout
+
+
+def _usage(now, window, number, current, previous, locked_until, limit, lockout):
+    """Usage of a key with ``current`` hits in window ``number`` and ``previous`` in the one before."""
+    overlap = 1 - (now - number * window) / window
+    count = math.ceil(previous * overlap + current)
+    if limit is not None and count > limit:
+        locked_until = max(locked_until, now + _lockout_seconds(lockout, count, window))
+    retry_after = max(0.0, locked_until - now)
+    blocked = retry_after > 0 or (limit is not None and count > limit)
+    return Usage(count, blocked, retry_after), locked_until
+
+
+def _unavailable(key, limit, reason):
+    logger.warning("Rate limit for %s not counted (%s); refusing the request", key, reason)
+    return Usage((limit or 0) + 1, True, UNAVAILABLE_RETRY_AFTER)
+
+
+class RateLimiter:
+    def hit(self, key, window, limit=None, lockout=None):
+        return self.hit_many([key], window, limit=limit, lockout=lockout)[0]
+
+    def hit_many(self, keys, window, limit=None, lockout=None):
+        """
+        Count one hit on each key in a ``window`` seconds sliding window and
+        return their Usage. Over ``limit``, a key is locked out for
+        ``lockout`` seconds (the window by default), or ``lockout(count)``
+        when it is callable.
+        """
+        raise NotImplementedError
+
+    def reset(self, keys, window):
+        """Forget the counts and lockouts of ``keys``, counted in ``window`` seconds windows."""
+        raise NotImplementedError
+
+
+class SharedMemoryRateLimiter(RateLimiter):
+    """
+    Counters in an open-addressed table of ``slots`` fixed-size slots in a
+    memory-mapped file. Keys are stored as digests salted with a random
+    value kept in the file, so clients cannot pick keys that share slots; a
+    key is looked up in PROBES consecutive slots from its hash. A new key
+    takes an expired slot, else the one closest to expiry that holds no
+    lockout, else it is refused. Updates hold an exclusive flock on the file
+    (other processes) and a lock (other threads). Each process maps the file
+    itself, so it is reopened after a fork.
+    """
+
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mapped = None
+        self._salt = None
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = _HEADER.size + self.slots * _SLOT.size
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            magic = slots = None
+            if os.fstat(fd).st_size == size:
+                os.lseek(fd, 0, os.SEEK_SET)
+                magic, slots, salt = _HEADER.unpack(os.read(fd, _HEADER.size))
+            if (magic, slots) != (_MAGIC, self.slots):
+                # New file, or one laid out for another slot count: start empty.
+                salt = os.urandom(16)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, _HEADER.pack(_MAGIC, self.slots, salt))
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        self._mapped = mmap.mmap(fd, size)
+        self._fd = fd
+        self._salt = salt
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._mapped
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _digest(self, key):
+        return hashlib.blake2b(key.encode(), digest_size=16, key=self._salt).digest()
+
+    def _find(self, mapped, digest, now):
+        """
+        Offset of the slot holding ``digest`` and its fields, or of the slot
+        to take and None; ``(None, None)`` when every candidate holds a live
+        lockout.
+        """
+        first = int.from_bytes(digest[:8], 'little') % self.slots
+        free = victim = None
+        victim_expires = math.inf
+        for probe in range(PROBES):
+            offset = _HEADER.size + (first + probe) % self.slots * _SLOT.size
+            fields = _SLOT.unpack_from(mapped, offset)
+            if fields[0] == digest:
+                return offset, (fields if fields[2] > now else None)
+            if fields[2] <= now:
+                if free is None:
+                    free = offset
+            elif fields[3] <= now and fields[2] < victim_expires:
+                victim, victim_expires = offset, fields[2]
+        return (free if free is not None else victim), None
+
+    def hit_many(self, keys, window, limit=None, lockout=None):
+        results = []
+        with self._locked() as mapped:
+            now = time.time()
+            number = int(now // window)
+            for key in keys:
+                digest = self._digest(key)
+                offset, fields = self._find(mapped, digest, now)
+                if offset is None:
+                    results.append(_unavailable(key, limit, 'no free slot'))
+                    continue
+                current = previous = 0
+                locked_until = 0.0
+                if fields is not None:
+                    _, slot_number, _, locked_until, current, previous = fields
+                    if slot_number != number:
+                        previous = current if slot_number == number - 1 else 0
+                        current = 0
+                current += 1
+                usage, locked_until = _usage(now, window, number, current, previous, locked_until, limit, lockout)
+                expires = max((number + 2) * window, locked_until)
+                _SLOT.pack_into(mapped, offset, digest, number, expires, locked_until, current, previous)
+                results.append(usage)
+        return results
+
+    def reset(self, keys, window):
+        with self._locked() as mapped:
+            now = time.time()
+            for key in keys:
+                offset, fields = self._find(mapped, self._digest(key), now)
+                if fields is not None:
+                    mapped[offset:offset + _SLOT.size] = _EMPTY_SLOT
+
+
+class CacheRateLimiter(RateLimiter):
+    """
+    Counters in a Django cache: one ``<key>:<window number>`` entry per
+    window, kept for two windows, and a ``<key>:lock`` entry holding the end
+    of a lockout. Caches whose ``incr`` is atomic count with it; others
+    (the database cache) read and write a key's entries while holding a
+    ``<key>:mutex`` entry created with ``add``, which only one request can.
+    """
+
+    def __init__(self, cache):
+        if isinstance(cache, (FileBasedCache, DummyCache)):
+            raise ImproperlyConfigured(
+                f"{type(cache).__name__} cannot count rate limits atomically; use the database cache, "
+                f"memcached or Redis (or RATE_LIMIT_BACKEND='local' on a single host)"
+            )
+        self.cache = cache
+        self.atomic_incr = type(cache).incr is not BaseCache.incr
+
+    def _count(self, counter, window):
+        try:
+            return self.cache.incr(counter)
+        except ValueError:
+            if self.cache.add(counter, 1, timeout=2 * math.ceil(window)):
+                return 1
+            # Created by another request in the meantime.
+            return self.cache.incr(counter)
+
+    @contextmanager
+    def _mutex(self, key):
+        """Hold ``key``'s mutex; yields False if it could not be taken in MUTEX_WAIT seconds."""
+        name = f'{key}:mutex'
+        deadline = time.monotonic() + MUTEX_WAIT
+        while not self.cache.add(name, 1, timeout=MUTEX_TIMEOUT):
+            if time.monotonic() > deadline:
+                yield False
+                return
+            time.sleep(0.005)
+        try:
+            yield True
+        finally:
+            self.cache.delete(name)
+
+    def _write_count(self, counter, window):
+        """
+        Add a hit to ``counter`` while holding its mutex. The database cache
+        drops writes that fail on a locked database without saying so, hence
+        the read back. Returns the new count, or None if it was not stored.
+        """
+        current = self.cache.get(counter, 0) + 1
+        for attempt in range(WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(0.01 * attempt)
+            self.cache.set(counter, current, timeout=2 * math.ceil(window))
+            if self.cache.get(counter) == current:
+                return current
+        return None
+
+    def _usages(self, keys, counts, now, window, number, limit, lockout):
+        stored = self.cache.get_many(
+            [f'{key}:{number - 1}' for key in keys] + [f'{key}:lock' for key in keys]
+        )
+        results = []
+        for key, current in zip(keys, counts):
+            locked_until = stored.get(f'{key}:lock', 0.0)
+            usage, new_locked_until = _usage(
+                now, window, number, current, stored.get(f'{key}:{number - 1}', 0), locked_until, limit, lockout,
+            )
+            if new_locked_until > locked_until:
+                self.cache.set(f'{key}:lock', new_locked_until, timeout=math.ceil(new_locked_until - now))
+            results.append(usage)
+        return results
+
+    def hit_many(self, keys, window, limit=None, lockout=None):
+        now = time.time()
+        number = int(now // window)
+        if self.atomic_incr:
+            counts = [self._count(f'{key}:{number}', window) for key in keys]
+            return self._usages(keys, counts, now, window, number, limit, lockout)
+        results = []
+        for key in keys:
+            with self._mutex(key) as held:
+                if not held:
+                    results.append(_unavailable(key, limit, 'mutex busy'))
+                    continue
+                current = self._write_count(f'{key}:{number}', window)
+                if current is None:
+                    results.append(_unavailable(key, limit, 'write failed'))
+                    continue
+                results += self._usages([key], [current], now, window, number, limit, lockout)
+        return results
+
+    def reset(self, keys, window):
+        number = int(time.time() // window)
+        self.cache.delete_many([
+            f'{key}:{suffix}' for key in keys for suffix in (number, number - 1, 'lock')
+        ])
+
+
+def default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'clinic-rate-limits')
+
+
+def configured_backend():
+    backend = getattr(settings, 'RATE_LIMIT_BACKEND', DEFAULT_BACKEND)
+    if backend not in BACKENDS:
+        raise ImproperlyConfigured(f"Unknown RATE_LIMIT_BACKEND {backend!r}; choose one of {', '.join(BACKENDS)}")
+    return backend
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                if configured_backend() == 'cache':
+                    _limiter = CacheRateLimiter(caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')])
+                else:
+                    _limiter = SharedMemoryRateLimiter(getattr(settings, 'RATE_LIMIT_PATH', '') or default_path())
+    return _limiter
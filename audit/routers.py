@@ -0,0 +1,53 @@
+"""
+Database router giving the audit trail its own database.
+
+When DATABASES defines an ``audit`` alias (AUDIT_DATABASE_URL), the audit app's
+tables and the database cache table live there: audit inserts and cache
+writes then take that database's write lock instead of the one clinical
+writes wait on. Audit rows refer to users by id only (no foreign key
+constraint), and code reading both sides must not join across the two:
+resolve usernames to ids first. Without the alias every model stays on
+``default``.
+
+Set up a new audit database with ``migrate --database audit`` and
+``createcachetable --database audit``.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+AUDIT_DB = 'audit'
+# 'django_cache' is the app label of the database cache backend's table.
+ROUTED_APPS = frozenset({'audit', 'django_cache'})
+
+
+def audit_db_configured():
+    return AUDIT_DB in settings.DATABASES
+
+
+class AuditRouter:
+    def _db(self, model, **hints):
+        if not audit_db_configured():
+            return None
+        if model._meta.app_label in ROUTED_APPS:
+            return AUDIT_DB
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == AUDIT_DB:
+            # e.g. the actor of an audit row: users stay on the default database.
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label in ROUTED_APPS or obj2._meta.app_label in ROUTED_APPS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not audit_db_configured():
+            return None
+        return (app_label in ROUTED_APPS) == (db == AUDIT_DB)
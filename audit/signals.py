@@ -1,7 +1,7 @@
 from django.contrib.auth.signals import user_logged_in, user_login_failed, user_logged_out
 from django.dispatch import receiver, Signal
-from django.core.cache import cache
-from .utils import log_action, get_client_ip, make_rate_limit_key, increment_rate_limit, normalize_rate_limit_username, sanitize_username_for_logging
+from .actions import AuditAction
+from .utils import log_action, get_client_ip, increment_rate_limit, reset_rate_limits, sanitize_username_for_logging
 
 LOCKOUT_THRESHOLD = 5
 LOCKOUT_TIME = 900
@@ -14,12 +14,8 @@ def log_user_login(sender, request, user, **kwargs):
     ip = get_client_ip(request)
     if ip:
         username = user.username if user else None
-        cache.delete(make_rate_limit_key('login_failures', ip))
-        cache.delete(make_rate_limit_key('2fa_failures', ip))
-        if username:
-            cache.delete(make_rate_limit_key('login_failures', ip, username=username))
-            cache.delete(make_rate_limit_key('2fa_failures', ip, username=username))
-    log_action(request, "LOGIN_SUCCESS", f"User: {user.username}", user_obj=user)
+        reset_rate_limits(ip, ('login_failures', '2fa_failures'), username=username)
+    log_action(request, AuditAction.LOGIN_SUCCESS, f"User: {user.username}", user_obj=user)
 
 
 @receiver(user_login_failed)
@@ -29,7 +25,7 @@ def log_user_login_failed(sender, credentials, request, **kwargs):
     
     increment_rate_limit(request, 'login_failures')
     
-    log_action(request, "LOGIN_FAILED", f"Attempted Username: {safe_username}")
+    log_action(request, AuditAction.LOGIN_FAILED, f"Attempted Username: {safe_username}")
 
 
 @receiver(twofa_verification_failed)
@@ -37,7 +33,7 @@ def log_2fa_verification_failed(sender, request, user, **kwargs):
     increment_rate_limit(request, '2fa_failures')
     log_action(
         request,
-        "2FA_VERIFY_FAILED",
+        AuditAction.TWO_FACTOR_VERIFY_FAILED,
         f"User: {user.username if user else 'unknown'}",
         user_obj=user
     )
@@ -46,6 +42,6 @@ def log_2fa_verification_failed(sender, request, user, **kwargs):
 @receiver(user_logged_out)
 def log_user_logout(sender, request, user, **kwargs):
     if user:
-        log_action(request, "LOGOUT", f"User: {user.username}", user_obj=user)
+        log_action(request, AuditAction.LOGOUT, f"User: {user.username}", user_obj=user)
     else:
-        log_action(request, "LOGOUT", "User: unknown")
\ No newline at end of file
+        log_action(request, AuditAction.LOGOUT, "User: unknown")
\ No newline at end of file
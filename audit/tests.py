@@ -0,0 +1,679 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import CustomUser, PatientProfile
+from audit import ratelimit
+from audit.actions import AuditAction
+from audit.archive import ArchiveQuery, AuditTrail, archive_old_entries
+from audit.chain import (
+    CHAIN_VERSION, GENESIS_HASH, MISMATCH, MISSING, UNREADABLE, chain_existing_rows, iter_chain_chunks,
+    verify_chain_rows,
+)
+from audit.models import AuditChainHead, AuditLog, PhiAccess
+from audit.pagination import decode_cursor, encode_cursor, keyset_page
+from audit.phi import access_summary, accesses, backfill_phi_access
+from audit.routers import AUDIT_DB, AuditRouter
+from audit.ratelimit import PROBES, CacheRateLimiter, SharedMemoryRateLimiter
+from audit.writer import AuditEvent, AuditWriter, PhiViewCoalescer, Spool, replay_orphaned_spools
+
+WINDOW = 60
+
+
+class FakeClock:
+    """time.time() replacement starting at the beginning of a window."""
+
+    def __init__(self, window=WINDOW):
+        self.now = (time.time() // window + 1) * window
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class GetSetLocMemCache(LocMemCache):
+    """A local-memory cache with BaseCache's get-then-set incr, like the database cache."""
+
+    incr = BaseCache.incr
+
+
+def _hit_in_process(path, slots, key, hits):
+    limiter = SharedMemoryRateLimiter(path, slots=slots)
+    for _ in range(hits):
+        limiter.hit(key, 10 ** 9)
+
+
+class RateLimiterBehaviour:
+    """Tests every backend must pass; subclasses provide make_limiter()."""
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        patcher = mock.patch('time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = self.make_limiter()
+
+    def hits(self, key, times, **kwargs):
+        return [self.limiter.hit(key, WINDOW, **kwargs) for _ in range(times)]
+
+    def test_counts_hits(self):
+        self.assertEqual([usage.count for usage in self.hits('a', 4)], [1, 2, 3, 4])
+        self.assertEqual(self.limiter.hit('b', WINDOW).count, 1)
+
+    def test_locks_out_past_the_limit(self):
+        usages = self.hits('a', 6, limit=5)
+        self.assertEqual([usage.blocked for usage in usages], [False] * 5 + [True])
+        self.assertEqual(usages[-1].retry_after, WINDOW)
+
+    def test_lockout_outlasts_the_window(self):
+        self.hits('a', 6, limit=5, lockout=lambda count: 10 * WINDOW)
+        self.clock.advance(3 * WINDOW)
+        usage = self.limiter.hit('a', WINDOW, limit=5)
+        self.assertEqual(usage.count, 1)
+        self.assertTrue(usage.blocked)
+        self.assertEqual(usage.retry_after, 7 * WINDOW)
+        self.clock.advance(7 * WINDOW)
+        self.assertFalse(self.limiter.hit('a', WINDOW, limit=5).blocked)
+
+    def test_window_rollover_weights_the_previous_window(self):
+        self.hits('a', 8)
+        self.clock.advance(WINDOW + WINDOW / 4)
+        # 8 hits, three quarters of whose window still overlaps, plus this one.
+        self.assertEqual(self.limiter.hit('a', WINDOW).count, 7)
+        self.clock.advance(WINDOW)
+        # The previous window now holds the single hit above.
+        self.assertEqual(self.limiter.hit('a', WINDOW).count, 2)
+        self.clock.advance(2 * WINDOW)
+        self.assertEqual(self.limiter.hit('a', WINDOW).count, 1)
+
+    def test_hit_many(self):
+        self.hits('a', 2)
+        usages = self.limiter.hit_many(['a', 'b', 'c'], WINDOW, limit=2)
+        self.assertEqual([usage.count for usage in usages], [3, 1, 1])
+        self.assertEqual([usage.blocked for usage in usages], [True, False, False])
+
+    def test_reset_clears_counts_and_lockouts(self):
+        self.hits('a', 6, limit=5)
+        self.hits('b', 2)
+        self.limiter.reset(['a', 'b'], WINDOW)
+        self.assertEqual(self.limiter.hit('a', WINDOW, limit=5), ratelimit.Usage(1, False, 0.0))
+        self.assertEqual(self.limiter.hit('b', WINDOW).count, 1)
+
+
+class ConcurrentHitsBehaviour:
+    """Hits from several threads on one key must all be counted."""
+
+    threads = 8
+    hits_per_thread = 200
+
+    def test_concurrent_hits_are_counted_exactly(self):
+        limiter = self.make_limiter()
+
+        def run(_):
+            for _ in range(self.hits_per_thread):
+                limiter.hit('shared', 10 ** 9)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(run, range(self.threads)))
+        self.assertEqual(limiter.hit('shared', 10 ** 9).count, self.threads * self.hits_per_thread + 1)
+
+
+class SharedMemoryRateLimiterTests(RateLimiterBehaviour, ConcurrentHitsBehaviour, SimpleTestCase):
+    def make_limiter(self, slots=1024):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'rate-limits')
+        return SharedMemoryRateLimiter(self.path, slots=slots)
+
+    @skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_hits_from_several_processes_are_counted_exactly(self):
+        context = multiprocessing.get_context('fork')
+        workers = [
+            context.Process(target=_hit_in_process, args=(self.path, self.limiter.slots, 'shared', 500))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(self.limiter.hit('shared', 10 ** 9).count, 2001)
+
+    def test_layout_change_starts_empty(self):
+        self.hits('a', 3)
+        self.assertEqual(SharedMemoryRateLimiter(self.path, slots=512).hit('a', WINDOW).count, 1)
+
+    def test_eviction_spares_lockouts(self):
+        # One probe range covers the whole table, so every key competes for it.
+        limiter = self.make_limiter(slots=PROBES)
+        for _ in range(3):
+            limiter.hit('victim', WINDOW, limit=2)
+        for index in range(50):
+            limiter.hit(f'attacker-{index}', WINDOW)
+        usage = limiter.hit('victim', WINDOW, limit=2)
+        self.assertTrue(usage.blocked)
+        self.assertEqual(usage.count, 4)
+
+    def test_eviction_takes_the_counter_closest_to_expiry(self):
+        limiter = self.make_limiter(slots=PROBES)
+        limiter.hit('old', WINDOW)
+        self.clock.advance(WINDOW)
+        for index in range(PROBES - 1):
+            limiter.hit(f'key-{index}', WINDOW)
+        limiter.hit('new', WINDOW)
+        self.assertEqual(limiter.hit('key-0', WINDOW).count, 2)
+        self.assertEqual(limiter.hit('old', WINDOW).count, 1)
+
+    def test_fails_closed_when_every_slot_holds_a_lockout(self):
+        limiter = self.make_limiter(slots=PROBES)
+        for index in range(PROBES):
+            limiter.hit_many([f'locked-{index}'] * 2, WINDOW, limit=1)
+        with self.assertLogs('audit.ratelimit', 'WARNING'):
+            usage = limiter.hit('new', WINDOW, limit=5)
+        self.assertTrue(usage.blocked)
+        self.assertTrue(limiter.hit('locked-0', WINDOW, limit=1).blocked)
+
+
+class AtomicIncrCacheRateLimiterTests(RateLimiterBehaviour, ConcurrentHitsBehaviour, SimpleTestCase):
+    def make_limiter(self):
+        limiter = CacheRateLimiter(LocMemCache('rate-limit-tests', {}))
+        limiter.cache.clear()
+        self.assertTrue(limiter.atomic_incr)
+        return limiter
+
+
+class MutexCacheRateLimiterTests(RateLimiterBehaviour, ConcurrentHitsBehaviour, SimpleTestCase):
+    threads = 4
+    hits_per_thread = 100
+
+    def make_limiter(self):
+        limiter = CacheRateLimiter(GetSetLocMemCache('rate-limit-mutex-tests', {}))
+        limiter.cache.clear()
+        self.assertFalse(limiter.atomic_incr)
+        return limiter
+
+    def test_fails_closed_while_the_mutex_is_held(self):
+        self.limiter.cache.add('a:mutex', 1)
+        with mock.patch.object(ratelimit, 'MUTEX_WAIT', 0.05), self.assertLogs('audit.ratelimit', 'WARNING'):
+            usage = self.limiter.hit('a', WINDOW, limit=5)
+        self.assertTrue(usage.blocked)
+
+    def test_fails_closed_when_the_count_is_not_stored(self):
+        with mock.patch.object(self.limiter.cache, 'set'), self.assertLogs('audit.ratelimit', 'WARNING'):
+            usage = self.limiter.hit('a', WINDOW, limit=5)
+        self.assertTrue(usage.blocked)
+
+
+class DatabaseCacheRateLimiterTests(RateLimiterBehaviour, TestCase):
+    def make_limiter(self):
+        return CacheRateLimiter(caches['default'])
+
+
+class CacheRateLimiterConfigurationTests(SimpleTestCase):
+    def test_refuses_caches_that_cannot_count(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for cache in (FileBasedCache(directory, {}), DummyCache('dummy', {})):
+                with self.assertRaises(ImproperlyConfigured):
+                    CacheRateLimiter(cache)
+
+
+class AuditRouterTests(SimpleTestCase):
+    router = AuditRouter()
+    cache_entry = mock.Mock(**{'_meta.app_label': 'django_cache'})
+
+    def with_audit_db(self):
+        return mock.patch.dict(settings.DATABASES, {AUDIT_DB: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+    def test_everything_stays_on_default_without_the_alias(self):
+        for model in (AuditLog, PhiAccess, self.cache_entry, CustomUser):
+            with self.subTest(model=model):
+                self.assertIsNone(self.router.db_for_read(model))
+                self.assertIsNone(self.router.db_for_write(model))
+        self.assertIsNone(self.router.allow_migrate(DEFAULT_DB_ALIAS, 'audit'))
+
+    def test_audit_tables_and_cache_move_to_the_alias(self):
+        with self.with_audit_db():
+            for model in (AuditLog, PhiAccess, self.cache_entry):
+                with self.subTest(model=model):
+                    self.assertEqual(self.router.db_for_read(model), AUDIT_DB)
+                    self.assertEqual(self.router.db_for_write(model), AUDIT_DB)
+            self.assertIsNone(self.router.db_for_read(CustomUser))
+            self.assertIsNone(self.router.db_for_write(PatientProfile))
+
+    def test_actor_of_an_audit_row_is_read_from_default(self):
+        log = AuditLog(actor_id=1)
+        log._state.db = AUDIT_DB
+        with self.with_audit_db():
+            self.assertEqual(self.router.db_for_read(CustomUser, instance=log), DEFAULT_DB_ALIAS)
+            self.assertTrue(self.router.allow_relation(log, CustomUser(pk=1)))
+        self.assertIsNone(self.router.allow_relation(CustomUser(pk=1), PatientProfile()))
+
+    def test_migrations_are_split_between_the_databases(self):
+        with self.with_audit_db():
+            for db, app_label, allowed in [
+                (AUDIT_DB, 'audit', True),
+                (AUDIT_DB, 'django_cache', True),
+                (AUDIT_DB, 'clinic', False),
+                (AUDIT_DB, 'accounts', False),
+                (DEFAULT_DB_ALIAS, 'audit', False),
+                (DEFAULT_DB_ALIAS, 'clinic', True),
+                (DEFAULT_DB_ALIAS, 'auth', True),
+            ]:
+                with self.subTest(db=db, app_label=app_label):
+                    self.assertIs(self.router.allow_migrate(db, app_label), allowed)
+
+
+class AuditWriterConfigurationTests(SimpleTestCase):
+    def test_coalescing_needs_a_spool(self):
+        with self.assertLogs('audit.writer', 'WARNING'):
+            self.assertIsNone(AuditWriter(coalesce_window=60).coalescer)
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNotNone(AuditWriter(spool_dir=directory, coalesce_window=60).coalescer)
+
+
+@override_settings(AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class SpoolReplayTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def event(self, resource):
+        return AuditEvent.create(None, AuditAction.LOGIN_FAILED, '10.0.0.1', resource, 'bad password')
+
+    def crashed_spool(self, *resources, acked=0):
+        """A spool file left behind by a process that died after committing ``acked`` events."""
+        spool = Spool(self.directory)
+        events = spool.append([self.event(resource) for resource in resources])
+        spool.ack(events[:acked])
+        spool._fh.close()
+        return spool.path
+
+    def resources(self):
+        return sorted(AuditLog.objects.values_list('resource', flat=True))
+
+    def test_next_writer_replays_unacknowledged_events(self):
+        path = self.crashed_spool('a', 'b', 'c', acked=1)
+        writer = AuditWriter(spool_dir=self.directory)
+        with self.assertLogs('audit.writer', 'WARNING'):
+            writer._write_batch([self.event('d')])
+        self.assertEqual(self.resources(), ['b', 'c', 'd'])
+        self.assertFalse(os.path.exists(path))
+        # Replay happens once per writer, and the new batch was acknowledged.
+        writer._write_batch([self.event('e')])
+        self.assertEqual(self.resources(), ['b', 'c', 'd', 'e'])
+        self.assertEqual(Spool.read(writer.spool.path), [])
+
+    def test_fully_acknowledged_spool_is_only_removed(self):
+        path = self.crashed_spool('a', 'b', acked=2)
+        self.assertEqual(os.path.getsize(path), 0)
+        self.assertEqual(replay_orphaned_spools(self.directory), 0)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(AuditLog.objects.count(), 0)
+
+    def test_line_torn_by_the_crash_is_skipped(self):
+        path = self.crashed_spool('a', 'b')
+        with open(path, 'ab') as fh:
+            fh.write(b'E 3 gAAAA')
+        with self.assertLogs('audit.writer', 'WARNING'):
+            self.assertEqual(replay_orphaned_spools(self.directory), 2)
+        self.assertEqual(self.resources(), ['a', 'b'])
+
+    @skipUnless(os.name == 'posix', "spool files are only locked on POSIX")
+    def test_spool_of_a_live_process_is_left_alone(self):
+        live = Spool(self.directory)
+        self.addCleanup(live._fh.close)
+        live.append([self.event('a')])
+        self.assertEqual(replay_orphaned_spools(self.directory), 0)
+        self.assertTrue(os.path.exists(live.path))
+        self.assertEqual(AuditLog.objects.count(), 0)
+
+
+VIEWS_START = timezone.now()
+
+
+def phi_view(seconds, patient_ids=(1, 2), details='page=1'):
+    """A doctor's dashboard view ``seconds`` after VIEWS_START."""
+    return AuditEvent.create(
+        None, AuditAction.VIEW_PATIENTS_DOCTOR_DASH, '10.0.0.1', 'dashboard', details, patient_ids,
+    )._replace(timestamp=VIEWS_START + timedelta(seconds=seconds))
+
+
+class PhiViewCoalescerTests(SimpleTestCase):
+    def test_identical_views_within_the_window_are_merged(self):
+        coalescer = PhiViewCoalescer(60)
+        for seconds in (0, 10, 59):
+            self.assertTrue(coalescer.add(phi_view(seconds)))
+        self.assertEqual(coalescer.release(now=phi_view(59).timestamp), [])
+        [(merged, members)] = coalescer.release(now=phi_view(60).timestamp)
+        self.assertEqual(len(members), 3)
+        self.assertEqual((merged.views, merged.last_timestamp), (3, phi_view(59).timestamp))
+        self.assertEqual((merged.timestamp, merged.details), (phi_view(0).timestamp, 'page=1'))
+        self.assertEqual(coalescer.merged, 2)
+        self.assertEqual(coalescer.pending(), 0)
+
+    def test_single_view_is_written_as_is(self):
+        coalescer = PhiViewCoalescer(60)
+        coalescer.add(phi_view(0))
+        [(merged, _)] = coalescer.drain()
+        self.assertEqual(merged, phi_view(0))
+        self.assertEqual((merged.views, merged.last_timestamp), (1, None))
+
+    def test_different_views_are_kept_apart(self):
+        coalescer = PhiViewCoalescer(60)
+        coalescer.add(phi_view(0))
+        coalescer.add(phi_view(1, patient_ids=(3,)))
+        coalescer.add(phi_view(2, details='page=2'))
+        # Outside the window: the first group is released, a new one starts.
+        coalescer.add(phi_view(61))
+        self.assertEqual(len(coalescer.release(now=phi_view(0).timestamp)), 1)
+        self.assertEqual(sorted(merged.views for merged, _ in coalescer.drain()), [1, 1, 1])
+
+    def test_other_events_are_not_held(self):
+        coalescer = PhiViewCoalescer(60)
+        self.assertFalse(coalescer.add(AuditEvent.create(None, AuditAction.LOGIN_FAILED, resource='login')))
+        self.assertFalse(coalescer.add(phi_view(0, patient_ids=())))
+        self.assertEqual(coalescer.pending(), 0)
+
+
+@override_settings(AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class CoalescedWriteTests(TestCase):
+    def test_merged_views_are_stored_in_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = AuditWriter(spool_dir=directory, coalesce_window=60)
+            writer._write_batch([phi_view(0), phi_view(5), phi_view(9)])
+            self.assertFalse(AuditLog.objects.exists())
+            writer.flush()
+            self.assertEqual(Spool.read(writer.spool.path), [])
+            writer.spool._fh.close()
+        log = AuditLog.objects.get()
+        self.assertEqual(log.details, 'page=1')
+        self.assertEqual((log.views, log.timestamp, log.last_timestamp), (3, phi_view(0).timestamp, phi_view(9).timestamp))
+        self.assertEqual(
+            sorted(PhiAccess.objects.values_list('patient_id', 'views', 'last_timestamp', 'sequence')),
+            [(1, 3, log.last_timestamp, log.sequence), (2, 3, log.last_timestamp, log.sequence)],
+        )
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class DeletedActorTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser('root', 'root@example.com', 'pw', role=CustomUser.Role.ADMIN)
+        user = CustomUser.objects.create_user('gone', 'gone@example.com', 'pw', role=CustomUser.Role.DOCTOR)
+        self.log = AuditLog(actor=user, actor_role=user.role, action=AuditAction.LOGIN_SUCCESS, resource='x')
+        self.log.save()
+        self.user_id = user.pk
+        user.delete()
+        self.client.force_login(self.admin)
+
+    def test_entry_keeps_the_actor_id(self):
+        log = AuditLog.objects.get(pk=self.log.pk)
+        self.assertEqual(log.actor_id, self.user_id)
+        self.assertEqual(log.actor_name, f"deleted user {self.user_id}")
+        self.assertIn(f"deleted user {self.user_id}", str(log))
+        log = AuditLog.objects.prefetch_related('actor').get(pk=self.log.pk)
+        self.assertEqual(log.actor_name, f"deleted user {self.user_id}")
+
+    def test_chain_still_verifies(self):
+        rows = [row for chunk in iter_chain_chunks() for row in chunk]
+        self.assertEqual(verify_chain_rows(rows, 0, GENESIS_HASH), (len(rows), []))
+
+    def test_pages_name_the_deleted_actor(self):
+        for url in (
+            reverse('admin:audit_auditlog_changelist'),
+            reverse('admin:audit_auditlog_search'),
+            reverse('clinic:audit_logs'),
+        ):
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), f"deleted user {self.user_id}")
+
+
+def chain_rows():
+    return [row for chunk in iter_chain_chunks() for row in chunk]
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class ChainVerificationTests(TestCase):
+    def setUp(self):
+        for index in range(6):
+            AuditLog(action=AuditAction.LOGIN_SUCCESS, ip_address='10.0.0.1', details=f'entry {index}').save()
+        self.rows = chain_rows()
+
+    def test_intact_chain_verifies(self):
+        self.assertEqual(verify_chain_rows(self.rows, 0, GENESIS_HASH), (6, []))
+        # A chunk verifies on its own from the row before it.
+        self.assertEqual(verify_chain_rows(self.rows[3:], *self.rows[2][:2]), (3, []))
+
+    def test_detects_an_edited_row(self):
+        AuditLog.objects.filter(sequence=3).update(details='entry forged')
+        self.assertEqual(verify_chain_rows(chain_rows(), 0, GENESIS_HASH), (6, [(3, MISMATCH)]))
+
+    def test_detects_a_deleted_row(self):
+        AuditLog.objects.filter(sequence=4).delete()
+        self.assertEqual(verify_chain_rows(chain_rows(), 0, GENESIS_HASH), (5, [(5, MISSING)]))
+
+    def test_detects_an_unreadable_row(self):
+        rows = [list(row) for row in self.rows]
+        rows[1][-1] = 'not a ciphertext'
+        self.assertEqual(verify_chain_rows(rows, 0, GENESIS_HASH), (6, [(2, UNREADABLE)]))
+
+    def test_role_and_view_count_are_hashed(self):
+        self.assertEqual({row[2] for row in self.rows}, {CHAIN_VERSION})
+        AuditLog.objects.filter(sequence=2).update(actor_role=CustomUser.Role.ADMIN)
+        AuditLog.objects.filter(sequence=4).update(views=5)
+        self.assertEqual(verify_chain_rows(chain_rows(), 0, GENESIS_HASH), (6, [(2, MISMATCH), (4, MISMATCH)]))
+
+    def test_rows_chained_before_versions_still_verify(self):
+        # As migrated: hashed without actor_role and view counts.
+        AuditLog.objects.update(chain_version=1)
+        chain_existing_rows(AuditLog, AuditChainHead)
+        self.assertNotEqual(chain_rows(), self.rows)
+        AuditLog(action=AuditAction.LOGOUT, actor_role=CustomUser.Role.NURSE).save()
+        rows = chain_rows()
+        self.assertEqual([row[2] for row in rows], [1] * 6 + [CHAIN_VERSION])
+        self.assertEqual(verify_chain_rows(rows, 0, GENESIS_HASH), (7, []))
+
+    def test_detects_a_changed_version(self):
+        AuditLog.objects.filter(sequence=3).update(chain_version=1)
+        AuditLog.objects.filter(sequence=5).update(chain_version=99)
+        self.assertEqual(verify_chain_rows(chain_rows(), 0, GENESIS_HASH), (6, [(3, MISMATCH), (5, MISMATCH)]))
+
+    def test_command_fails_on_a_broken_chain(self):
+        call_command('verify_audit_chain', workers=1, stdout=StringIO())
+        AuditLog.objects.filter(sequence=5).update(ip_address='10.0.0.2')
+        with self.assertRaisesMessage(CommandError, 'broken in 1 places'):
+            call_command('verify_audit_chain', workers=1, full=True, stdout=StringIO())
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class PhiAccessTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user('admin', 'admin@example.com', 'pw', role=CustomUser.Role.ADMIN)
+        self.nurse = CustomUser.objects.create_user('nurse', 'nurse@example.com', 'pw', role=CustomUser.Role.NURSE)
+        self.patients = [
+            CustomUser.objects.create_user(f'patient{i}', f'patient{i}@example.com', 'pw', role=CustomUser.Role.PATIENT)
+            for i in range(3)
+        ]
+        for patient in self.patients:
+            PatientProfile.objects.create(user=patient, phone='+1 555 0100', address='1 Main Street')
+
+    def view_patient_list(self, user):
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('clinic:admin_patient_list')).status_code, 200)
+        return AuditLog.objects.filter(action=AuditAction.VIEW_PATIENT_LIST_ADMIN).latest('sequence')
+
+    def test_one_row_per_patient_on_the_page(self):
+        log = self.view_patient_list(self.admin)
+        rows = PhiAccess.objects.filter(sequence=log.sequence)
+        self.assertEqual(sorted(row.patient_id for row in rows), sorted(p.pk for p in self.patients))
+        for row in rows:
+            self.assertEqual(
+                (row.actor_id, row.action, row.timestamp, row.last_timestamp, row.views),
+                (self.admin.pk, log.action, log.timestamp, log.timestamp, 1),
+            )
+
+    def test_reports_by_patient_and_by_actor(self):
+        self.view_patient_list(self.admin)
+        self.view_patient_list(self.admin)
+        patient = self.patients[0]
+        [(actor_id, views, first, last)] = access_summary(accesses(patient_ids=[patient.pk]), 'actor')
+        self.assertEqual((actor_id, views), (self.admin.pk, 2))
+        self.assertLessEqual(first, last)
+        by_patient = access_summary(accesses(actor_ids=[self.admin.pk]), 'patient')
+        self.assertEqual(sorted(row[0] for row in by_patient), sorted(p.pk for p in self.patients))
+        self.assertFalse(accesses(actor_ids=[self.nurse.pk]).exists())
+        self.assertFalse(accesses(patient_ids=[patient.pk], since=timezone.now()).exists())
+
+        out = StringIO()
+        call_command('phi_access_report', patient=patient.username, stdout=out)
+        self.assertIn('admin', out.getvalue())
+        self.assertIn('2 views', out.getvalue())
+
+    def test_backfill_from_the_details_of_older_entries(self):
+        AuditLog(
+            actor=self.nurse, actor_role=self.nurse.role, action=AuditAction.VIEW_PATIENTS_NURSE_DASH,
+            details='Patients: patient0, patient2, someone-deleted | extra',
+        ).save()
+        self.assertEqual(backfill_phi_access(dry_run=True), (1, 2))
+        self.assertFalse(PhiAccess.objects.exists())
+        self.assertEqual(backfill_phi_access(), (1, 2))
+        self.assertEqual(
+            sorted(accesses(actor_ids=[self.nurse.pk]).values_list('patient_id', flat=True)),
+            [self.patients[0].pk, self.patients[2].pk],
+        )
+        # Rerunning only looks at entries older than the rows already indexed.
+        self.assertEqual(backfill_phi_access(), (0, 0))
+
+
+class AuditEntriesFixture:
+    """Entries from three actors, old enough to archive and recent, with matching table and archive filters."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_patcher = override_settings(AUDIT_ARCHIVE_DIR=directory.name)
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.alice = CustomUser.objects.create_user('alice', 'alice@example.com', 'pw', role=CustomUser.Role.DOCTOR)
+        self.bob = CustomUser.objects.create_user('bob', 'bob@example.com', 'pw', role=CustomUser.Role.NURSE)
+        actors = [self.alice, self.bob, None]
+        actions = [AuditAction.LOGIN_SUCCESS, AuditAction.LOGOUT, AuditAction.LOGIN_FAILED]
+        now = timezone.now()
+        # 20 entries long ago (in pairs sharing a timestamp), then 9 recent ones.
+        timestamps = [now - timedelta(days=100, hours=10 - index // 2) for index in range(20)]
+        timestamps += [now - timedelta(minutes=10 - index) for index in range(9)]
+        for index, timestamp in enumerate(timestamps):
+            AuditLog(
+                actor=actors[index % 3], action=actions[index % 2 + (index % 5 == 0)],
+                details=f'entry {index}', timestamp=timestamp,
+            ).save()
+        self.filters = {
+            'all': ({}, {}),
+            'actor': ({'actor_id__in': [self.alice.pk]}, {'actor_ids': [self.alice.pk]}),
+            'action': ({'action__in': [AuditAction.LOGOUT]}, {'actions': [AuditAction.LOGOUT]}),
+            'range': (
+                {'timestamp__gte': timestamps[4], 'timestamp__lt': timestamps[24]},
+                {'start': timestamps[4], 'end': timestamps[24]},
+            ),
+            'combined': (
+                {'actor_id__in': [self.bob.pk], 'action__in': [AuditAction.LOGIN_SUCCESS]},
+                {'actor_ids': [self.bob.pk], 'actions': [AuditAction.LOGIN_SUCCESS]},
+            ),
+        }
+
+    def trail(self, name):
+        live, archived = self.filters[name]
+        return AuditTrail(AuditLog.objects.filter(**live), ArchiveQuery(**archived))
+
+    @staticmethod
+    def summary(entries):
+        return [(entry.pk, entry.timestamp, entry.actor_id, entry.action, entry.details) for entry in entries]
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=5)
+class ArchiveTests(AuditEntriesFixture, TestCase):
+    def test_archive_gives_the_same_results_as_the_table(self):
+        before = {
+            name: self.summary(AuditLog.objects.filter(**live).order_by('-timestamp', '-id'))
+            for name, (live, _) in self.filters.items()
+        }
+        archived, _ = archive_old_entries(older_than=timedelta(days=30))
+        self.assertEqual(archived, 20)
+        self.assertEqual(AuditLog.objects.count(), 9)
+        for name, expected in before.items():
+            with self.subTest(filter=name):
+                trail = self.trail(name)
+                self.assertEqual(trail.count(), len(expected))
+                self.assertEqual(self.summary(trail[0:len(expected)]), expected)
+                self.assertEqual(self.summary(trail[2:5]), expected[2:5])
+
+    def test_dry_run_archives_nothing(self):
+        archived, _ = archive_old_entries(older_than=timedelta(days=30), dry_run=True)
+        self.assertEqual(archived, 20)
+        self.assertEqual(AuditLog.objects.count(), 29)
+        self.assertEqual(ArchiveQuery().count(), 0)
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=5)
+class KeysetPaginationTests(AuditEntriesFixture, TestCase):
+    def walk(self, trail, per_page):
+        """Every entry, following next cursors from the newest page, then previous cursors back."""
+        pages = [keyset_page(trail, {}, per_page=per_page)]
+        self.assertFalse(pages[0].has_previous)
+        while pages[-1].has_next:
+            pages.append(keyset_page(trail, {'before': pages[-1].next_cursor}, per_page=per_page))
+        backwards = [pages[-1]]
+        while backwards[-1].has_previous:
+            backwards.append(keyset_page(trail, {'after': backwards[-1].previous_cursor}, per_page=per_page))
+        self.assertEqual(
+            [self.summary(page) for page in reversed(backwards)], [self.summary(page) for page in pages]
+        )
+        return [entry for page in pages for entry in page]
+
+    def test_cursor_round_trip(self):
+        entry = AuditLog.objects.first()
+        self.assertEqual(decode_cursor(encode_cursor(entry)), (entry.timestamp, entry.pk))
+        self.assertIsNone(decode_cursor('garbage'))
+
+    def test_pages_walk_the_table_in_order(self):
+        expected = self.summary(AuditLog.objects.order_by('-timestamp', '-id'))
+        for per_page in (1, 4, 7, 29, 50):
+            with self.subTest(per_page=per_page):
+                self.assertEqual(self.summary(self.walk(self.trail('all'), per_page)), expected)
+
+    def test_date_jumps_to_the_newest_entries_of_that_day(self):
+        day = AuditLog.objects.order_by('timestamp').first().timestamp
+        page = keyset_page(self.trail('all'), {'date': day.strftime('%Y-%m-%d')}, per_page=3)
+        self.assertTrue(all(entry.timestamp.date() <= day.date() for entry in page))
+        self.assertTrue(page.has_previous)
+
+    def test_pages_walk_across_the_archive(self):
+        expected = {
+            name: self.summary(AuditLog.objects.filter(**live).order_by('-timestamp', '-id'))
+            for name, (live, _) in self.filters.items()
+        }
+        archive_old_entries(older_than=timedelta(days=30))
+        for name, entries in expected.items():
+            with self.subTest(filter=name):
+                self.assertEqual(self.summary(self.walk(self.trail(name), 4)), entries)
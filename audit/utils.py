@@ -1,5 +1,9 @@
 from django.conf import settings
-from .models import AuditLog
+from .actions import AuditAction
+from .identifiers import seal_identifiers
+from .ratelimit import get_rate_limiter
+from .writer import AuditEvent, write_event
+import math
 import re
 from django.http import HttpResponse
 from django.shortcuts import render
@@ -52,79 +56,72 @@ def make_rate_limit_key(prefix, ip, username=None):
         return f"{prefix}_{ip_part}_{username_part}"
     return f"{prefix}_{ip_part}"
 
-def log_action(request, action, resource="", details="", user_obj=None):
+def log_action(request, action, resource="", details="", user_obj=None, patient_ids=()):
+    """
+    Record an audit event. The row is encrypted and inserted in the
+    background (see audit.writer); audit.writer.flush_audit_log() waits for it.
+    ``patient_ids`` are recorded as PhiAccess rows alongside it.
+    """
     ip = get_client_ip(request)
     actor = user_obj
     if not actor and request and hasattr(request, 'user') and request.user.is_authenticated:
         actor = request.user
-    
-    AuditLog.objects.create(
-        actor=actor,
-        action=action,
-        ip_address=ip,
-        resource=resource,
-        details=details
-    )
+
+    write_event(AuditEvent.create(
+        actor, action, ip_address=ip, resource=resource, details=details, patient_ids=patient_ids,
+    ))
 
 
 def _extract_patient_identifiers(patients, limit=10):
     """
-    Safely capture a limited set of patient identifiers (usernames) without
-    forcing evaluation of large querysets.
+    User ids of every patient in ``patients`` (PatientProfile or user objects)
+    and ``(id, username)`` for the first ``limit``, without querying for anything
+    the page does not load anyway: a queryset is evaluated once here and the
+    template rendering it reuses the result cache. Only usernames of profiles
+    whose user was not loaded with them are fetched, in one projection query;
+    select_related('user') avoids it.
     """
     if patients is None:
-        return [], False
-
-    usernames = []
-    truncated = False
-
-    try:
-        iterable = patients[: limit + 1]
-    except Exception:
-        iterable = patients
-
-    count = 0
-    for entry in iterable:
-        count += 1
-        username = None
-        if hasattr(entry, "user"):
-            username = getattr(entry.user, "username", None)
-        if username is None:
+        return [], [], False
+
+    ids = []
+    usernames = {}
+    for entry in patients:
+        patient_id = getattr(entry, "user_id", None)
+        if patient_id is not None:
+            user_field = getattr(type(entry), "user", None)
+            username = entry.user.username if user_field is not None and user_field.is_cached(entry) else None
+        else:
+            patient_id = getattr(entry, "pk", None)
             username = getattr(entry, "username", None)
-        if username:
-            username = str(username).strip()
-            if username and username not in usernames:
-                usernames.append(username)
-        if count > limit:
-            truncated = True
-            break
-    return usernames[:limit], truncated
+        if patient_id is None or patient_id in usernames:
+            continue
+        ids.append(patient_id)
+        usernames[patient_id] = username
+
+    shown = ids[:limit]
+    missing = [patient_id for patient_id in shown if not usernames[patient_id]]
+    if missing:
+        from accounts.models import CustomUser
+        usernames.update(CustomUser.objects.filter(pk__in=missing).values_list("pk", "username"))
+    names = [(patient_id, str(usernames.get(patient_id) or '').strip()) for patient_id in shown]
+    return ids, [(patient_id, name) for patient_id, name in names if name], len(ids) > limit
 
 
-def log_phi_view(request, action, resource="PHI_READ", patients=None, patient_usernames=None, extra_details=""):
+def log_phi_view(request, action, resource="PHI_READ", patients=None, patient_ids=None, extra_details=""):
     """
     Log read access to patient health information (PHI) using the existing
     audit log model. Captures the actor, IP (via log_action), and which patient
-    records were viewed (limited to avoid excess logging).
+    records were viewed: the usernames of the first ten in the details, each
+    sealed under its patient's data key (audit.identifiers), and the ids of
+    all of them (``patients`` plus ``patient_ids``) as PhiAccess rows.
     """
-    usernames = []
-
-    if patient_usernames:
-        for raw in patient_usernames:
-            if not raw:
-                continue
-            normalized = str(raw).strip()
-            if normalized and normalized not in usernames:
-                usernames.append(normalized)
-
-    extracted, truncated = _extract_patient_identifiers(patients, limit=10)
-    for uname in extracted:
-        if uname not in usernames:
-            usernames.append(uname)
+    extracted_ids, shown, truncated = _extract_patient_identifiers(patients, limit=10)
+    ids = list(dict.fromkeys([*(patient_ids or ()), *extracted_ids]))
 
     details_parts = []
-    if usernames:
-        details_parts.append(f"Patients: {', '.join(usernames)}")
+    if shown:
+        details_parts.append(f"Patients: {', '.join(seal_identifiers(shown))}")
         if truncated:
             details_parts.append("patient_list_truncated=True")
     if extra_details:
@@ -135,6 +132,7 @@ def log_phi_view(request, action, resource="PHI_READ", patients=None, patient_us
         action=action,
         resource=resource or "PHI_READ",
         details=" | ".join(details_parts),
+        patient_ids=ids,
     )
 
 
@@ -168,7 +166,6 @@ _RATE_LIMIT_THRESHOLDS = {
 
 
 def increment_rate_limit(request, prefix):
-    from django.core.cache import cache
     ip = get_client_ip(request)
     if not ip:
         return 0
@@ -191,11 +188,15 @@ def increment_rate_limit(request, prefix):
             pass  # nosec B110 - Intentional: rate limiting proceeds without username if lookup fails
     
     key = make_rate_limit_key(prefix, ip, username=username)
-    failures = cache.get(key, 0)
-    new_count = failures + 1
-    cache.set(key, new_count, RATE_LIMIT_TIMEOUT)
-    
-    return new_count
+    return get_rate_limiter().hit(key, RATE_LIMIT_TIMEOUT).count
+
+
+def reset_rate_limits(ip, prefixes, username=None):
+    """Clear the ip and ip+username buckets of ``prefixes`` in one step."""
+    keys = [make_rate_limit_key(prefix, ip) for prefix in prefixes]
+    if username:
+        keys += [make_rate_limit_key(prefix, ip, username=username) for prefix in prefixes]
+    get_rate_limiter().reset(keys, RATE_LIMIT_TIMEOUT)
 
 
 def _progressive_timeout(prefix, new_count, limit, base_timeout):
@@ -211,28 +212,30 @@ def _progressive_timeout(prefix, new_count, limit, base_timeout):
 
 def rate_limit_blocked_response(request, prefix, limit, *, identifier=None, template='429.html', base_timeout=RATE_LIMIT_TIMEOUT):
     """
-    Increment rate-limit bucket (ip + optional identifier). Apply progressive TTL
-    for login/2fa prefixes. If over limit, log once and return a 429 response.
+    Count a hit on the rate-limit bucket (ip + optional identifier) in a
+    ``base_timeout`` sliding window. Over the limit the bucket is locked out,
+    progressively longer for login/2fa prefixes; while it is, log and return
+    a 429 response.
     """
-    from django.core.cache import cache
-
     ip = get_client_ip(request)
     normalized_identifier = normalize_rate_limit_username(identifier)
     key = make_rate_limit_key(prefix, ip, username=normalized_identifier)
 
-    current = cache.get(key, 0)
-    new_count = current + 1
-    ttl = _progressive_timeout(prefix, new_count, limit, base_timeout)
-    cache.set(key, new_count, ttl)
+    usage = get_rate_limiter().hit(
+        key, base_timeout, limit=limit,
+        lockout=lambda count: _progressive_timeout(prefix, count, limit, base_timeout),
+    )
 
-    if new_count > limit:
+    if usage.blocked:
         safe_identifier = sanitize_username_for_logging(identifier or "")
         details = f"identifier={safe_identifier}, ip={ip}"
-        log_action(request, "RATE_LIMIT_BLOCK", resource=prefix, details=details)
+        log_action(request, AuditAction.RATE_LIMIT_BLOCK, resource=prefix, details=details)
         try:
-            return render(request, template, status=429)
+            response = render(request, template, status=429)
         except Exception:
-            return HttpResponse("Too Many Requests", status=429)
+            response = HttpResponse("Too Many Requests", status=429)
+        response['Retry-After'] = str(max(1, math.ceil(usage.retry_after)))
+        return response
 
     return None
 
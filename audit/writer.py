@@ -0,0 +1,439 @@
+"""
+Buffered, asynchronous audit-log writer.
+
+log_action() only builds an AuditEvent and queues it. A background thread
+encrypts queued events and inserts them with one bulk_create per batch of up
+to AUDIT_LOG_BATCH_SIZE events, at least every AUDIT_LOG_FLUSH_INTERVAL
+seconds, so requests no longer wait for audit encryption and inserts. The
+patients named by PHI-view events are inserted as PhiAccess rows in the same
+transaction. The queue is flushed at interpreter exit. When it is full, or
+with AUDIT_LOG_ASYNC off, events are written synchronously: an audit record
+is never dropped.
+
+With AUDIT_LOG_SPOOL_DIR set (the default), the background thread appends
+each batch (encrypted, in one write) to a spool file of the current process
+before inserting it, and acknowledges it there once it is committed; requests
+never touch the spool. Spool files left behind by a process that died are
+replayed by the next writer to start, so a crash during an insert, or while
+PHI views are held for coalescing, loses nothing; an event committed just
+before a crash may be written twice. Events still waiting in the queue (about
+AUDIT_LOG_FLUSH_INTERVAL seconds' worth) are only in memory and are lost when
+the process is killed, as is everything queued without a spool directory. The
+spool is written to the OS, not synced to disk, so a power loss can also lose
+its last moments. AUDIT_LOG_ASYNC=False closes both gaps at the cost of
+request latency.
+
+With AUDIT_PHI_COALESCE_WINDOW set, the writer holds PHI-view events for that
+many seconds and merges identical ones (a dashboard refreshed again and
+again) into one entry whose views and last_timestamp columns carry the view
+count and the last view's time, as do its PhiAccess rows.
+Held events stay in the spool until their merged entry is committed, so
+coalescing is off without a spool directory: a crash would lose up to a
+window of PHI views.
+"""
+import atexit
+import base64
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+
+from clinic.background import BackgroundWorker
+from clinic.keyring import get_key_ring
+
+from .actions import PHI_VIEW_ACTIONS, action_code
+from .chain import extend_chain
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_COALESCE_WINDOW = 60
+
+_PHI_VIEW_ACTIONS = frozenset(PHI_VIEW_ACTIONS)
+
+
+class AuditEvent(namedtuple(
+    'AuditEvent',
+    'actor_id action ip_address resource details timestamp event_id actor_role patient_ids views last_timestamp',
+    defaults=('', (), 1, None),
+)):
+    """
+    Everything an AuditLog row needs, captured when the action happens, and
+    the ids of the patients whose records were viewed (PhiAccess rows).
+    ``views`` and ``last_timestamp`` are set on coalesced PHI views.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, actor, action, ip_address=None, resource="", details="", patient_ids=()):
+        actor_id = getattr(actor, 'pk', None) if actor is not None else None
+        actor_role = getattr(actor, 'role', '') if actor is not None else ''
+        return cls(
+            actor_id, int(action_code(action)), ip_address, resource or "", details or "", timezone.now(), None,
+            actor_role or '', tuple(patient_ids),
+        )
+
+    def to_log(self):
+        from .models import AuditLog
+
+        return AuditLog(
+            actor_id=self.actor_id,
+            actor_role=self.actor_role,
+            action=action_code(self.action),
+            ip_address=self.ip_address,
+            resource=self.resource,
+            details=self.details,
+            timestamp=self.timestamp,
+            views=self.views,
+            last_timestamp=self.last_timestamp,
+        )
+
+    def to_json(self):
+        return json.dumps({
+            **self._asdict(),
+            'timestamp': self.timestamp.isoformat(),
+            'last_timestamp': self.last_timestamp.isoformat() if self.last_timestamp else None,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        data['timestamp'] = datetime.fromisoformat(data['timestamp'])
+        if data.get('last_timestamp'):
+            data['last_timestamp'] = datetime.fromisoformat(data['last_timestamp'])
+        data['patient_ids'] = tuple(data.get('patient_ids', ()))
+        return cls(**data)
+
+
+class PhiViewCoalescer:
+    """
+    Merges repeated PHI views: events with the same actor, action, patients
+    and details are held for ``window`` seconds from the first one and
+    written as a single event carrying the number of views and the time of
+    the last one (AuditLog.views and last_timestamp). Nothing is dropped: a group is released once
+    its window has passed, or by drain().
+    """
+
+    def __init__(self, window):
+        self.window = timedelta(seconds=window)
+        self._groups = {}
+        self._released = []
+        self._lock = threading.Lock()
+        self.merged = 0
+
+    @staticmethod
+    def _key(event):
+        return (
+            event.actor_id, event.action, event.actor_role, event.ip_address, event.resource, event.details,
+            frozenset(event.patient_ids),
+        )
+
+    def add(self, event):
+        """Hold ``event``; False if it is not a PHI view and must be written as is."""
+        if event.action not in _PHI_VIEW_ACTIONS or not event.patient_ids:
+            return False
+        key = self._key(event)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is not None and event.timestamp < group[0].timestamp + self.window:
+                group.append(event)
+                self.merged += 1
+                return True
+            if group is not None:
+                self._released.append(self._groups.pop(key))
+            self._groups[key] = [event]
+        return True
+
+    def release(self, now=None):
+        """Groups whose window has passed, as ``(merged event, member events)``."""
+        cutoff = (now or timezone.now()) - self.window
+        with self._lock:
+            groups, self._released = self._released, []
+            for key in [key for key, group in self._groups.items() if group[0].timestamp <= cutoff]:
+                groups.append(self._groups.pop(key))
+        return [(self._merge(group), group) for group in groups]
+
+    def drain(self):
+        with self._lock:
+            groups, self._released = self._released + list(self._groups.values()), []
+            self._groups.clear()
+        return [(self._merge(group), group) for group in groups]
+
+    def pending(self):
+        with self._lock:
+            return sum(len(group) for group in self._groups.values()) + sum(len(group) for group in self._released)
+
+    @staticmethod
+    def _merge(group):
+        first, last = group[0], group[-1]
+        if len(group) == 1:
+            return first
+        return first._replace(views=len(group), last_timestamp=last.timestamp)
+
+
+class Spool:
+    """
+    Append-only spool file of one process: ``E <id> <sealed event>`` lines
+    for queued events and ``A <id> ...`` lines once they are committed. The
+    file is emptied whenever everything in it has been acknowledged, and held
+    under an exclusive lock so other processes know it is in use.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, f"audit-{self.pid}-{os.urandom(4).hex()}.spool")
+        self._fh = open(self.path, 'ab')
+        if fcntl is not None:
+            fcntl.flock(self._fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._ids = itertools.count(1)
+        self._unacked = 0
+        self._lock = threading.Lock()
+
+    def append(self, events):
+        """Spool ``events`` with one write; returns them numbered for ack()."""
+        ring = get_key_ring()
+        events = [event._replace(event_id=next(self._ids)) for event in events]
+        lines = b''.join(
+            b'E %d %s\n' % (event.event_id, base64.urlsafe_b64encode(ring.seal(event.to_json().encode())))
+            for event in events
+        )
+        with self._lock:
+            self._fh.write(lines)
+            self._fh.flush()
+            self._unacked += len(events)
+        return events
+
+    def ack(self, events):
+        ids = [event.event_id for event in events if event.event_id is not None]
+        if not ids:
+            return
+        with self._lock:
+            self._unacked -= len(ids)
+            if self._unacked <= 0:
+                self._unacked = 0
+                self._fh.truncate(0)
+            else:
+                self._fh.write(b'A ' + b' '.join(b'%d' % event_id for event_id in ids) + b'\n')
+            self._fh.flush()
+
+    @staticmethod
+    def read(path):
+        """Events in a spool file that were never acknowledged."""
+        events = {}
+        acked = set()
+        with open(path, 'rb') as fh:
+            for line in fh:
+                kind, _, rest = line.rstrip(b'\n').partition(b' ')
+                try:
+                    if kind == b'E':
+                        event_id, _, sealed = rest.partition(b' ')
+                        plaintext = get_key_ring().decrypt(base64.urlsafe_b64decode(sealed))
+                        events[int(event_id)] = AuditEvent.from_json(plaintext)
+                    elif kind == b'A':
+                        acked.update(int(event_id) for event_id in rest.split())
+                except Exception:
+                    # A line torn by the crash; everything before it is intact.
+                    logger.warning("Skipping unreadable line in audit spool %s", path)
+        return [event._replace(event_id=None) for event_id, event in events.items() if event_id not in acked]
+
+
+def replay_orphaned_spools(directory, exclude=None):
+    """
+    Write the unacknowledged events of spool files no live process holds,
+    then remove the files. Returns the number of events written.
+    """
+    written = 0
+    for path in sorted(glob.glob(os.path.join(directory, 'audit-*.spool'))):
+        if path == exclude:
+            continue
+        with open(path, 'rb') as fh:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            events = Spool.read(path)
+            if events:
+                _insert(events)
+                written += len(events)
+                logger.warning("Replayed %d audit event(s) from %s", len(events), path)
+            os.remove(path)
+    return written
+
+
+def _create(events, logs):
+    from .models import AuditLog, PhiAccess
+
+    with transaction.atomic(using=router.db_for_write(AuditLog)):
+        extend_chain(logs)
+        AuditLog.objects.bulk_create(logs)
+        PhiAccess.objects.bulk_create(
+            PhiAccess(
+                patient_id=patient_id, actor_id=log.actor_id, action=log.action, timestamp=log.timestamp,
+                last_timestamp=event.last_timestamp or log.timestamp, views=event.views, sequence=log.sequence,
+            )
+            for event, log in zip(events, logs)
+            for patient_id in event.patient_ids
+        )
+
+
+def _insert(events):
+    try:
+        _create(events, [event.to_log() for event in events])
+        return
+    except IntegrityError:
+        pass
+    # Most likely an actor deleted before the batch was written, on a
+    # database still enforcing the foreign key: keep the record without it.
+    for event in events:
+        log = event.to_log()
+        try:
+            _create([event], [log])
+        except IntegrityError:
+            log.details = f"{log.details} | actor_id={log.actor_id} (deleted)".lstrip(" |")
+            log.actor_id = None
+            _create([event], [log])
+
+
+class AuditWriter:
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 maxsize=DEFAULT_QUEUE_SIZE, spool_dir=None, coalesce_window=0):
+        self.spool_dir = spool_dir or None
+        if self.spool_dir is None:
+            logger.warning(
+                "AUDIT_LOG_SPOOL_DIR is empty: queued audit entries are lost if this process crashes"
+            )
+        self._spool = None
+        self._spool_lock = threading.Lock()
+        self._replayed = False
+        self.written_sync = 0
+        if coalesce_window and self.spool_dir is None:
+            logger.warning("AUDIT_PHI_COALESCE_WINDOW is ignored: coalescing needs AUDIT_LOG_SPOOL_DIR")
+            coalesce_window = 0
+        self.coalescer = PhiViewCoalescer(coalesce_window) if coalesce_window else None
+        if self.coalescer is not None:
+            # Registered before the worker's own exit hook, so it runs after
+            # the queue has been drained into the coalescer.
+            atexit.register(self._write_held)
+        self.worker = BackgroundWorker(
+            'audit-writer', self._write_batch, batch_size=batch_size, flush_interval=flush_interval, maxsize=maxsize,
+            on_idle=self._write_released if self.coalescer is not None else None,
+        )
+
+    @property
+    def spool(self):
+        if self.spool_dir is None:
+            return None
+        if self._spool is None or self._spool.pid != os.getpid():
+            with self._spool_lock:
+                if self._spool is None or self._spool.pid != os.getpid():
+                    self._spool = Spool(self.spool_dir)
+        return self._spool
+
+    def write(self, event):
+        if not self.worker.submit(event):
+            self._write_batch([event])
+            self.written_sync += 1
+
+    def _replay_orphans(self, spool):
+        # Batches written synchronously by a request thread race the writer
+        # thread here; only one of them replays, before either inserts.
+        with self._spool_lock:
+            if not self._replayed:
+                self._replayed = True
+                replay_orphaned_spools(self.spool_dir, exclude=spool.path)
+
+    def _write_batch(self, events):
+        spool = self.spool
+        if spool is not None:
+            self._replay_orphans(spool)
+            events = spool.append(events)
+        groups = []
+        if self.coalescer is not None:
+            events = [event for event in events if not self.coalescer.add(event)]
+            groups = self.coalescer.release()
+        self._commit(events, groups)
+
+    def _write_released(self):
+        self._commit([], self.coalescer.release())
+
+    def _write_held(self):
+        self._commit([], self.coalescer.drain())
+
+    def _commit(self, events, groups):
+        """Insert ``events`` and merged PHI views, then acknowledge every member in the spool."""
+        if not events and not groups:
+            return
+        _insert(events + [merged for merged, _ in groups])
+        spool = self.spool
+        if spool is not None:
+            spool.ack(events + [member for _, members in groups for member in members])
+
+    def flush(self, timeout=None):
+        """Wait for the queue, then write held PHI views without waiting for their window."""
+        done = self.worker.flush(timeout)
+        if self.coalescer is not None:
+            self._write_held()
+        return done
+
+    def stats(self):
+        return {
+            'pending': self.worker.pending(),
+            'held': self.coalescer.pending() if self.coalescer is not None else 0,
+            'coalesced': self.coalescer.merged if self.coalescer is not None else 0,
+            'written': self.worker.processed,
+            'written_sync': self.written_sync,
+            'dropped': self.worker.dropped,
+            'failed_batches': self.worker.failed_batches,
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = AuditWriter(
+                    batch_size=getattr(settings, 'AUDIT_LOG_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                    flush_interval=getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+                    maxsize=getattr(settings, 'AUDIT_LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE),
+                    spool_dir=getattr(settings, 'AUDIT_LOG_SPOOL_DIR', None),
+                    coalesce_window=getattr(settings, 'AUDIT_PHI_COALESCE_WINDOW', DEFAULT_COALESCE_WINDOW),
+                )
+    return _writer
+
+
+def write_event(event):
+    """Record ``event``, in the background unless AUDIT_LOG_ASYNC is off."""
+    if getattr(settings, 'AUDIT_LOG_ASYNC', True):
+        get_audit_writer().write(event)
+    else:
+        _insert([event])
+
+
+def flush_audit_log(timeout=None):
+    """Block until every queued audit event has been written."""
+    if _writer is None:
+        return True
+    return _writer.flush(timeout)
@@ -0,0 +1,123 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWorker:
+    """
+    A single daemon thread that drains a bounded queue and hands items to
+    ``handle_batch`` in groups of up to ``batch_size``, at least every
+    ``flush_interval`` seconds. Producers never block: ``submit`` returns
+    False when the queue is full. Pending items are flushed at interpreter
+    exit. ``on_idle``, if given, is called from the thread whenever
+    ``flush_interval`` passes without items.
+    """
+
+    def __init__(self, name, handle_batch, batch_size=100, flush_interval=1.0, maxsize=10000, on_idle=None):
+        self.name = name
+        self.handle_batch = handle_batch
+        self.on_idle = on_idle
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.dropped = 0
+        self.processed = 0
+        self.failed_batches = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, item):
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """Block until every item submitted so far has been handled."""
+        if self._thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _process(self, batch):
+        try:
+            self.handle_batch(batch)
+            self.processed += len(batch)
+        except Exception:
+            self.failed_batches += 1
+            logger.exception("Background worker %s failed to process %d item(s)", self.name, len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                batch = self._next_batch()
+                if batch:
+                    self._process(batch)
+                elif self.on_idle is not None:
+                    try:
+                        self.on_idle()
+                    except Exception:
+                        logger.exception("Background worker %s failed while idle", self.name)
+            remaining = self._drain()
+            for start in range(0, len(remaining), self.batch_size):
+                self._process(remaining[start:start + self.batch_size])
+        finally:
+            connections.close_all()
@@ -0,0 +1,796 @@
+"""
+Reusable micro-benchmarks for the field encryption subsystem. Everything that
+touches the database runs inside a transaction that is rolled back, so the
+benchmarks are safe to point at a copy of production data; the audit database
+layout and rate-limiter benchmarks use throwaway files (and one temporary
+cache key).
+"""
+import time
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    try:
+        with transaction.atomic():
+            yield
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+
+def seed_patients(rows, prefix="bench"):
+    """
+    Insert ``rows`` patients with a full set of encrypted PII. Passwords are
+    left unusable so seeding does not pay for Argon2 hashing.
+    """
+    from datetime import date
+    from accounts.models import CustomUser, PatientProfile, hash_email
+
+    users = []
+    for i in range(rows):
+        email = f"{prefix}{i}@example.com"
+        users.append(CustomUser(
+            username=f"{prefix}_{i}",
+            email=email,
+            email_hash=hash_email(email),
+            first_name=f"First{i}",
+            last_name=f"Last{i}",
+            password="!",
+            role=CustomUser.Role.PATIENT,
+        ))
+    users = CustomUser.objects.bulk_create(users, batch_size=500)
+    PatientProfile.objects.bulk_create(
+        [
+            PatientProfile(
+                user=user,
+                phone=f"+1-555-{i:07d}",
+                address=f"{i} Example Street, Springfield",
+                date_of_birth=date(1950 + i % 50, 1 + i % 12, 1 + i % 28),
+            )
+            for i, user in enumerate(users)
+        ],
+        batch_size=500,
+    )
+    return users
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def read_patients(profiles):
+    """Read every encrypted value of each profile and its user, decrypting whatever is still pending."""
+    for profile in profiles:
+        profile.phone, profile.address, profile.date_of_birth
+        profile.user.email, profile.user.first_name, profile.user.last_name
+
+
+def bench_batch_decryption(rows=2000, chunk_size=500, repeat=3, seed=True):
+    """
+    Compare loading PatientProfile rows (with their user) and reading every
+    encrypted value through the default per-attribute decryption against
+    ``decrypt_in_batches()``. Each row carries six encrypted values in four
+    columns. Data keys are only cached once their transaction commits, so
+    inside the rolled-back transaction this measures a cold data key cache.
+    """
+    from accounts.models import PatientProfile
+
+    results = {}
+    with rolled_back():
+        if seed:
+            seed_patients(rows)
+        qs = PatientProfile.objects.select_related('user').order_by('pk')
+        count = qs.count()
+        if not count:
+            return results
+
+        per_field = best_of(repeat, lambda: read_patients(qs.all()))
+        batched = best_of(
+            repeat, lambda: read_patients(qs.decrypt_in_batches(chunk_size=chunk_size))
+        )
+
+    results['rows'] = count
+    results['per_field'] = {'seconds': per_field, 'rows_per_second': count / per_field}
+    results['batched'] = {
+        'seconds': batched,
+        'rows_per_second': count / batched,
+        'chunk_size': chunk_size,
+    }
+    return results
+
+
+def _make_tokens(key, start, count):
+    from cryptography.fernet import Fernet
+
+    fernet = Fernet(key)
+    return [(pk, fernet.encrypt(f"+1-555-{pk:07d}".encode()).decode()) for pk in range(start, start + count)]
+
+
+def bench_rotation(rows=1_000_000, chunk_size=1000, workers=None):
+    """
+    Measure the CPU side of rotate_keys: push ``rows`` single-column chunks of
+    old-key tokens through the same worker function and process pool the
+    command uses. No database is touched; the command itself reports the
+    end-to-end rate including reads and bulk updates.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    from cryptography.fernet import Fernet
+    from clinic.management.commands.rotate_keys import _init_worker, rotate_rows
+
+    workers = workers or os.cpu_count() or 1
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    starts = range(0, rows, chunk_size)
+
+    initargs = ([(1, old_key)], (2, new_key))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+        chunks = list(pool.map(
+            _make_tokens, [old_key] * len(starts), starts, [min(chunk_size, rows - s) for s in starts]
+        ))
+        start = time.perf_counter()
+        updated = sum(len(updates) for updates, _, _ in pool.map(rotate_rows, chunks))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'rows': rows,
+        'updated': updated,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'chunk_size': chunk_size,
+        'workers': workers,
+    }
+
+
+SAMPLE_PAYLOADS = {
+    'phone (20 B)': '+1-555-0100 ext. 123',
+    'ip / audit details (100 B)': (
+        'Patients: jdoe, asmith, bwong, cnguyen, dpatel, emartin | page=3 | ip=203.0.113.42'
+    ).ljust(100, ' '),
+    'note (5000 chars)': (
+        'Patient presents with intermittent chest pain radiating to the left arm. '
+        'ECG shows normal sinus rhythm; troponin negative. Plan: stress test, '
+        'continue aspirin 81 mg daily, follow up in two weeks. '
+    ) * 26,
+}
+
+
+def bench_storage(iterations=2000):
+    """
+    Stored size and decrypt cost of each sample payload in a text column versus
+    a binary column, both with the primary key and configured engine.
+    """
+    from clinic.keyring import get_key_ring
+
+    ring = get_key_ring()
+    results = []
+    for label, text in SAMPLE_PAYLOADS.items():
+        data = text[:5000].encode()
+        token = ring.encrypt(data).decode()
+        sealed = ring.seal(data)
+        text_seconds = best_of(3, lambda: [ring.decrypt(token) for _ in range(iterations)])
+        binary_seconds = best_of(3, lambda: [ring.decrypt(sealed) for _ in range(iterations)])
+        results.append({
+            'payload': label,
+            'plaintext_bytes': len(data),
+            'text_bytes': len(token),
+            'binary_bytes': len(sealed),
+            'saving': 1 - len(sealed) / len(token),
+            'text_decrypt_us': text_seconds / iterations * 1e6,
+            'binary_decrypt_us': binary_seconds / iterations * 1e6,
+        })
+    return results
+
+
+def bench_engines(iterations=2000):
+    """
+    Encrypt and decrypt cost per engine and sample payload, using the
+    configured keys. Text-column output is measured since that is what most
+    encrypted columns store; ``stored_bytes`` is the resulting token length.
+    """
+    from clinic.keyring import ENGINE_CHOICES, KeyRing, get_key_ring
+
+    keys = get_key_ring().key_material
+    results = []
+    for label, text in SAMPLE_PAYLOADS.items():
+        data = text[:5000].encode()
+        for engine in ENGINE_CHOICES:
+            ring = KeyRing(keys, engine=engine)
+            token = ring.encrypt_text(data)
+            encrypt_seconds = best_of(3, lambda: [ring.encrypt_text(data) for _ in range(iterations)])
+            decrypt_seconds = best_of(3, lambda: [ring.decrypt(token) for _ in range(iterations)])
+            results.append({
+                'payload': label,
+                'engine': engine,
+                'stored_bytes': len(token),
+                'encrypt_us': encrypt_seconds / iterations * 1e6,
+                'decrypt_us': decrypt_seconds / iterations * 1e6,
+                'decrypt_mb_per_second': len(data) * iterations / decrypt_seconds / 1e6,
+            })
+    return results
+
+
+SAMPLE_PROFILE = {
+    'phone': '+1-555-0100 ext. 123',
+    'address': '742 Evergreen Terrace, Apt 3B, Springfield, OR 97403',
+    'date_of_birth': '1984-03-12',
+}
+
+
+def bench_packing(iterations=2000):
+    """
+    A patient's phone, address and date of birth as three text-column tokens
+    versus one EncryptedPackedField record: stored bytes and the cost of
+    decrypting all three values.
+    """
+    import json
+    from clinic.keyring import get_key_ring
+
+    ring = get_key_ring()
+    tokens = [ring.encrypt_text(value.encode()) for value in SAMPLE_PROFILE.values()]
+    record = json.dumps(SAMPLE_PROFILE, ensure_ascii=False, separators=(',', ':')).encode()
+    sealed = ring.seal(record)
+
+    separate_seconds = best_of(3, lambda: [
+        [ring.decrypt(token) for token in tokens] for _ in range(iterations)
+    ])
+    packed_seconds = best_of(3, lambda: [json.loads(ring.decrypt(sealed)) for _ in range(iterations)])
+    separate_bytes = sum(len(token) for token in tokens)
+    return {
+        'values': len(tokens),
+        'separate_bytes': separate_bytes,
+        'packed_bytes': len(sealed),
+        'saving': 1 - len(sealed) / separate_bytes,
+        'separate_decrypt_us': separate_seconds / iterations * 1e6,
+        'packed_decrypt_us': packed_seconds / iterations * 1e6,
+    }
+
+
+CLINICAL_SENTENCES = [
+    "Patient is a {age}-year-old {sex} presenting with {complaint} for the past {days} days.",
+    "Reports {severity} {complaint}, worse with exertion and partially relieved by rest.",
+    "Denies fever, chills, nausea, vomiting, shortness of breath or recent travel.",
+    "Past medical history significant for {history}.",
+    "Current medications: {drug} {dose} mg {frequency}, {drug2} {dose2} mg {frequency}.",
+    "Vitals: BP {sys}/{dia} mmHg, HR {hr} bpm, RR {rr}/min, SpO2 {spo2}% on room air, temp {temp} C.",
+    "On examination the patient is alert and oriented, in no acute distress.",
+    "Heart sounds regular without murmurs; lungs clear to auscultation bilaterally.",
+    "Abdomen soft, non-tender, no organomegaly; bowel sounds present.",
+    "Labs: Hb {hb} g/dL, WBC {wbc} x10^9/L, creatinine {cr} mg/dL, HbA1c {a1c}%.",
+    "ECG shows normal sinus rhythm at {hr} bpm without acute ST changes.",
+    "Assessment: {diagnosis}, {status}.",
+    "Plan: continue {drug} {dose} mg {frequency}; start {drug2} {dose2} mg {frequency}.",
+    "Ordered {test} and referred to {specialty} for further evaluation.",
+    "Counselled on diet, exercise and medication adherence; patient verbalised understanding.",
+    "Follow up in {weeks} weeks or sooner if symptoms worsen.",
+]
+CLINICAL_TERMS = {
+    'sex': ['male', 'female'],
+    'complaint': ['chest pain', 'headache', 'lower back pain', 'cough', 'fatigue', 'dizziness', 'joint swelling'],
+    'severity': ['mild', 'moderate', 'severe', 'intermittent'],
+    'history': ['hypertension and type 2 diabetes', 'asthma', 'hyperlipidaemia', 'hypothyroidism', 'CKD stage 2'],
+    'drug': ['metformin', 'lisinopril', 'atorvastatin', 'amlodipine', 'levothyroxine', 'aspirin'],
+    'drug2': ['omeprazole', 'metoprolol', 'sertraline', 'salbutamol', 'furosemide', 'losartan'],
+    'frequency': ['once daily', 'twice daily', 'at night', 'as needed'],
+    'diagnosis': ['essential hypertension', 'stable angina', 'type 2 diabetes', 'mechanical back pain', 'viral URTI'],
+    'status': ['well controlled', 'suboptimally controlled', 'improving', 'stable'],
+    'test': ['a lipid panel', 'an echocardiogram', 'a chest X-ray', 'an MRI of the lumbar spine', 'a stress test'],
+    'specialty': ['cardiology', 'endocrinology', 'physiotherapy', 'nephrology', 'rheumatology'],
+}
+
+
+def clinical_note(length, seed=0):
+    """Free-text clinical note of about ``length`` characters, varied like real notes."""
+    import random
+
+    rng = random.Random(seed)
+    sentences = []
+    size = 0
+    while size < length:
+        values = {name: rng.choice(options) for name, options in CLINICAL_TERMS.items()}
+        values.update(
+            age=rng.randint(18, 90), days=rng.randint(1, 21), dose=rng.choice([5, 10, 20, 40, 500]),
+            dose2=rng.choice([25, 50, 100]), sys=rng.randint(105, 170), dia=rng.randint(60, 100),
+            hr=rng.randint(55, 110), rr=rng.randint(12, 22), spo2=rng.randint(92, 100),
+            temp=round(rng.uniform(36.1, 38.4), 1), hb=round(rng.uniform(10.5, 16.5), 1),
+            wbc=round(rng.uniform(4.0, 12.0), 1), cr=round(rng.uniform(0.6, 1.6), 2),
+            a1c=round(rng.uniform(5.2, 9.8), 1), weeks=rng.randint(1, 12),
+        )
+        sentence = rng.choice(CLINICAL_SENTENCES).format(**values)
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return ' '.join(sentences)[:length]
+
+
+def audit_patient_list(patients, seed=0):
+    """AuditLog.details of a listing page: the usernames of the patients shown."""
+    import random
+
+    rng = random.Random(seed)
+    first = ['james', 'maria', 'wei', 'fatima', 'olga', 'john', 'aisha', 'lucas', 'mei', 'david']
+    last = ['smith', 'garcia', 'chen', 'khan', 'ivanova', 'brown', 'okafor', 'silva', 'wong', 'cohen']
+    names = [f"{rng.choice(first)}.{rng.choice(last)}{rng.randint(1, 999)}" for _ in range(patients)]
+    return f"Patients: {', '.join(names)}"
+
+
+def bench_compression(iterations=500):
+    """
+    Stored size and encrypt/decrypt cost of realistic clinical notes and audit
+    details with no compression, zlib and lzma, in a text column (base64url)
+    and a binary column.
+    """
+    from clinic.keyring import get_key_ring
+
+    ring = get_key_ring()
+    payloads = {
+        'diagnosis (300 chars)': clinical_note(300, seed=1),
+        'note (1500 chars)': clinical_note(1500, seed=2),
+        'note (5000 chars)': clinical_note(5000, seed=3),
+        'audit details (25 patients)': audit_patient_list(25, seed=4),
+    }
+    results = []
+    for label, text in payloads.items():
+        data = text.encode()
+        for method in (None, 'zlib', 'lzma'):
+            sealed = ring.seal(data, method)
+            token = ring.encrypt_text(data, method)
+            encrypt_seconds = best_of(3, lambda: [ring.seal(data, method) for _ in range(iterations)])
+            decrypt_seconds = best_of(3, lambda: [ring.decrypt(sealed) for _ in range(iterations)])
+            results.append({
+                'payload': label,
+                'compression': method or 'none',
+                'plaintext_bytes': len(data),
+                'binary_bytes': len(sealed),
+                'text_bytes': len(token),
+                'ratio': len(sealed) / len(data),
+                'encrypt_us': encrypt_seconds / iterations * 1e6,
+                'decrypt_us': decrypt_seconds / iterations * 1e6,
+            })
+    return results
+
+
+def summarize(samples_ns, per=1):
+    """
+    Latency percentiles (in microseconds) and throughput of per-call timings
+    in nanoseconds. ``per`` divides each sample, e.g. by the rows a query
+    returned, to report per-row figures.
+    """
+    samples = sorted(sample / per for sample in samples_ns)
+    count = len(samples)
+
+    def percentile(p):
+        return samples[min(count - 1, int(p / 100 * count))] / 1000
+
+    total = sum(samples)
+    return {
+        'samples': count,
+        'mean_us': total / count / 1000,
+        'p50_us': percentile(50),
+        'p90_us': percentile(90),
+        'p99_us': percentile(99),
+        'max_us': samples[-1] / 1000,
+        'ops_per_second': count / total * 1e9 if total else 0.0,
+    }
+
+
+def time_calls(fn, iterations, warmup=10):
+    """Per-call timings of ``fn()`` in nanoseconds, after a few warm-up calls."""
+    clock = time.perf_counter_ns
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = clock()
+        fn()
+        samples.append(clock() - start)
+    return samples
+
+
+FIELD_PAYLOAD_SIZES = (16, 256, 4096)
+
+
+def _bench_fields():
+    """The encrypted field classes as declared on the models, keyed by label."""
+    from clinic.encrypted_fields import (
+        EncryptedBinaryTextField, EncryptedCharField, EncryptedDateField, EncryptedTextField,
+    )
+
+    fields = {
+        'EncryptedCharField': EncryptedCharField(max_length=500),
+        'EncryptedTextField': EncryptedTextField(),
+        'EncryptedTextField(zlib)': EncryptedTextField(compress='zlib'),
+        'EncryptedBinaryTextField(zlib)': EncryptedBinaryTextField(compress='zlib'),
+        'EncryptedDateField': EncryptedDateField(),
+    }
+    for name, field in fields.items():
+        field.set_attributes_from_name(name)
+    return fields
+
+
+def bench_fields(iterations=2000, sizes=FIELD_PAYLOAD_SIZES):
+    """
+    Encrypt (get_prep_value) and decrypt (from_db_value) latency of each
+    encrypted field class per payload size, under the configured key ring and
+    engine. Text payloads are clinical notes so compression behaves as it
+    would on real data; EncryptedCharField stops at its 500-character limit
+    and EncryptedDateField always stores a date.
+    """
+    from datetime import date
+
+    results = []
+    for label, field in _bench_fields().items():
+        if label == 'EncryptedDateField':
+            payloads = [('date', date(1984, 3, 12))]
+        else:
+            payloads = [
+                (f"{size} chars", clinical_note(size, seed=size))
+                for size in sizes if size <= (field.max_length or size)
+            ]
+        for payload, value in payloads:
+            token = field.get_prep_value(value)
+            encrypt = summarize(time_calls(lambda: field.get_prep_value(value), iterations))
+            decrypt = summarize(time_calls(lambda: field.from_db_value(token, None, None), iterations))
+            results.append({
+                'field': label,
+                'payload': payload,
+                'stored_bytes': len(token),
+                'encrypt': encrypt,
+                'decrypt': decrypt,
+            })
+    return results
+
+
+def _queryset_scenarios():
+    """``{label: (queryset, values a page reads from each row)}``"""
+    from accounts.models import CustomUser, PatientProfile
+    from audit.models import AuditLog
+
+    return {
+        'patients (CustomUser)': (
+            CustomUser.objects.filter(role=CustomUser.Role.PATIENT).order_by('pk'),
+            lambda user: (user.email, user.first_name, user.last_name),
+        ),
+        'profiles + user': (
+            PatientProfile.objects.select_related('user').order_by('pk'),
+            lambda profile: (
+                profile.phone, profile.address, profile.date_of_birth,
+                profile.user.first_name, profile.user.last_name,
+            ),
+        ),
+        'audit log page': (
+            AuditLog.objects.prefetch_related('actor').order_by('-timestamp')[:50],
+            lambda entry: (entry.resource, entry.details, entry.ip_address, entry.actor and entry.actor.first_name),
+        ),
+    }
+
+
+def bench_querysets(rows=1000, repeat=20, seed=True):
+    """
+    The decryption cost of realistic querysets: each query is timed once
+    reading the encrypted values a page would show, and once with
+    raw_ciphertexts() without reading them. Encrypted querysets decrypt on
+    first access, so the difference is what from_db_value and the field
+    descriptors add, reported per row.
+    """
+    from audit.actions import AuditAction
+    from audit.models import AuditLog
+    from clinic.encrypted_fields import raw_ciphertexts
+
+    results = []
+    with rolled_back():
+        if seed:
+            users = seed_patients(rows)
+            AuditLog.objects.bulk_create(
+                [
+                    AuditLog(
+                        actor=users[i % len(users)],
+                        action=AuditAction.VIEW_PATIENT_LIST_ADMIN,
+                        resource='Patient list',
+                        ip_address='203.0.113.42',
+                        details=audit_patient_list(25, seed=i),
+                    )
+                    for i in range(rows)
+                ],
+                batch_size=500,
+            )
+        for label, (qs, read) in _queryset_scenarios().items():
+            count = len(qs.all())
+            if not count:
+                continue
+            decrypted = time_calls(lambda: [read(obj) for obj in qs.all()], repeat, warmup=1)
+
+            def raw():
+                with raw_ciphertexts():
+                    list(qs.all())
+
+            undecrypted = time_calls(raw, repeat, warmup=1)
+            results.append({
+                'queryset': label,
+                'rows': count,
+                'decrypted': summarize(decrypted, per=count),
+                'raw': summarize(undecrypted, per=count),
+                'decrypt_us_per_row': (
+                    (sorted(decrypted)[len(decrypted) // 2] - sorted(undecrypted)[len(undecrypted) // 2])
+                    / count / 1000
+                ),
+            })
+    return results
+
+
+def bench_otp(iterations=20):
+    """
+    Cost of the second-factor code path: hashing a code with make_password
+    (the first configured PASSWORD_HASHERS entry), verifying a right and a
+    wrong code, and hash_email for comparison.
+    """
+    from django.contrib.auth.hashers import check_password, get_hasher
+    from accounts.models import hash_email
+    from accounts.utils import generate_otp_code, hash_otp_code
+
+    code = generate_otp_code()
+    encoded = hash_otp_code(code)
+    wrong = f"{(int(code) + 1) % 10**6:06d}"
+    return {
+        'hasher': get_hasher().algorithm,
+        'hash_otp_code': summarize(time_calls(lambda: hash_otp_code(code), iterations, warmup=1)),
+        'verify_valid': summarize(time_calls(lambda: check_password(code, encoded), iterations, warmup=1)),
+        'verify_invalid': summarize(time_calls(lambda: check_password(wrong, encoded), iterations, warmup=1)),
+        'hash_email': summarize(time_calls(lambda: hash_email('Patient.Name@Example.com'), iterations * 100)),
+    }
+
+
+AUDIT_DB_LAYOUTS = ('no audit writes', 'shared file', 'separate file')
+
+
+def _sqlite_connect(path):
+    import sqlite3
+
+    # Like Django's SQLite backend: autocommit, explicit transactions, 5 s busy timeout.
+    return sqlite3.connect(path, timeout=5, isolation_level=None)
+
+
+def _write_transaction(connection, sql, params, many=False):
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if many:
+            connection.executemany(sql, params)
+        else:
+            connection.execute(sql, params)
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def _wait_until(moment):
+    delay = moment - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _clinical_worker(path, start_at, seconds, first_pk, step, rows, diagnosis):
+    """One request process: update appointments one transaction at a time. Returns latencies in ns."""
+    connection = _sqlite_connect(path)
+    samples = []
+    pk = first_pk
+    _wait_until(start_at)
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        begin = time.perf_counter_ns()
+        _write_transaction(
+            connection, 'UPDATE appointment SET status = ?, diagnosis = ? WHERE id = ?',
+            ('CONFIRMED', diagnosis, pk % rows),
+        )
+        samples.append(time.perf_counter_ns() - begin)
+        pk += step
+    connection.close()
+    return samples
+
+
+def _audit_worker(path, start_at, seconds, rate, batch, details):
+    """The audit writer: insert ``batch`` rows at a time, ``rate`` rows per second. Returns rows written."""
+    connection = _sqlite_connect(path)
+    written = 0
+    _wait_until(start_at)
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        _write_transaction(
+            connection, 'INSERT INTO audit (timestamp, action, details) VALUES (?, ?, ?)',
+            [(time.time(), 500, details)] * batch, many=True,
+        )
+        written += batch
+        # Falls behind rather than sleeping when the inserts cannot keep up.
+        delay = started + written / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    connection.close()
+    return written
+
+
+def bench_audit_database(seconds=3.0, processes=4, audit_rate=2000, audit_batch=200, rows=1000, directory=None):
+    """
+    Clinical write throughput and latency while an audit writer process
+    inserts ``audit_rate`` sealed entries per second in batches of
+    ``audit_batch``, with the audit table in the clinical SQLite file and
+    in a file of its own (AUDIT_DATABASE_URL), against a baseline without
+    audit writes. ``processes`` request processes each commit one
+    appointment update per transaction for ``seconds``. Runs on throwaway
+    SQLite files in a temporary directory under ``directory``, which should
+    be on the disk the databases live on: lock hold times include fsync.
+    """
+    import multiprocessing
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from clinic.keyring import get_key_ring
+
+    ring = get_key_ring()
+    details = ring.seal(audit_patient_list(25).encode(), 'zlib')
+    diagnosis = ring.seal(clinical_note(1000).encode())
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with ProcessPoolExecutor(max_workers=processes + 1, mp_context=context) as pool:
+        # Start every worker process before the first timed run.
+        list(pool.map(time.sleep, [0.1] * (processes + 1)))
+        for layout in AUDIT_DB_LAYOUTS:
+            with tempfile.TemporaryDirectory(dir=directory) as tmp:
+                clinical_path = os.path.join(tmp, 'clinical.sqlite3')
+                audit_path = clinical_path if layout == 'shared file' else os.path.join(tmp, 'audit.sqlite3')
+                connection = _sqlite_connect(clinical_path)
+                connection.execute('CREATE TABLE appointment (id INTEGER PRIMARY KEY, status TEXT, diagnosis BLOB)')
+                _write_transaction(
+                    connection, 'INSERT INTO appointment (id, status, diagnosis) VALUES (?, ?, ?)',
+                    [(pk, 'REQUESTED', diagnosis) for pk in range(rows)], many=True,
+                )
+                connection.close()
+                connection = _sqlite_connect(audit_path)
+                connection.execute(
+                    'CREATE TABLE audit (id INTEGER PRIMARY KEY, timestamp REAL, action INTEGER, details BLOB)'
+                )
+                connection.close()
+
+                start_at = time.time() + 0.5
+                clinical = [
+                    pool.submit(_clinical_worker, clinical_path, start_at, seconds, i, processes, rows, diagnosis)
+                    for i in range(processes)
+                ]
+                audit = None
+                if layout != 'no audit writes':
+                    audit = pool.submit(_audit_worker, audit_path, start_at, seconds, audit_rate, audit_batch, details)
+                samples = [sample for future in clinical for sample in future.result()]
+                written = audit.result() if audit is not None else 0
+
+            results.append({
+                'layout': layout,
+                'processes': processes,
+                'seconds': seconds,
+                'clinical_per_second': len(samples) / seconds,
+                'clinical': summarize(samples),
+                'audit_rows_per_second': written / seconds,
+                'audit_rate': audit_rate if audit is not None else 0,
+            })
+    return results
+
+
+# Longer than any run, so every hit lands in one window and the count is exact.
+RATE_LIMIT_BENCH_WINDOW = 10 ** 9
+
+
+def _rate_limit_worker(backend, path, key, hits, start_at):
+    """Hit ``key`` ``hits`` times; returns per-hit latencies in ns and the hits refused uncounted."""
+    if backend != 'get-set':
+        from django.core.cache import caches
+
+        from audit.ratelimit import CacheRateLimiter, SharedMemoryRateLimiter
+
+        limiter = SharedMemoryRateLimiter(path) if backend == 'local' else CacheRateLimiter(caches['default'])
+        refused = 0
+
+        def hit():
+            nonlocal refused
+            # With no limit, only a hit that could not be counted is blocked.
+            refused += limiter.hit(key, RATE_LIMIT_BENCH_WINDOW).blocked
+    else:
+        from django.core.cache import cache
+        refused = 0
+
+        def hit():
+            # What audit.utils did before the rate-limit engine.
+            cache.set(key, cache.get(key, 0) + 1, 3600)
+    _wait_until(start_at)
+    samples = time_calls(hit, hits, warmup=0)
+    return samples, refused
+
+
+def _count_in_threads(limiter, key, threads, hits):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(_):
+        return time_calls(lambda: limiter.hit(key, RATE_LIMIT_BENCH_WINDOW), hits, warmup=0)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return [sample for samples in pool.map(run, range(threads)) for sample in samples]
+
+
+def bench_rate_limiter(processes=4, hits=2000, directory=None):
+    """
+    Concurrency check of the rate-limit engine: ``processes`` processes (or
+    threads, for the per-process locmem cache) hit one key ``hits`` times
+    each at the same moment, and the final count must equal the hits made,
+    less those refused because they could not be counted (which fail
+    closed). The cache backend and the old get-then-set use the configured
+    cache; the latter's difference is the number of lost updates.
+    """
+    import multiprocessing
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    import django
+    from django.core.cache import cache, caches
+    from django.core.cache.backends.locmem import LocMemCache
+
+    from audit.ratelimit import CacheRateLimiter, SharedMemoryRateLimiter
+
+    expected = processes * hits
+    results = []
+
+    def record(backend, samples, counted, refused, elapsed):
+        results.append({
+            'backend': backend,
+            'workers': processes,
+            'hits': len(samples),
+            'counted': counted,
+            'refused': refused,
+            'lost': expected - counted - refused,
+            'hits_per_second': len(samples) / elapsed,
+            'latency': summarize(samples),
+        })
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(dir=directory) as tmp, \
+            ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=django.setup) as pool:
+        list(pool.map(time.sleep, [0.1] * processes))
+        path = os.path.join(tmp, 'rate-limits')
+        key = f'bench-rate-limit-{os.getpid()}'
+        for backend, worker_backend in (('local', 'local'), ('cache', 'cache'), ('cache get/set', 'get-set')):
+            start_at = time.time() + 0.5
+            futures = [
+                pool.submit(_rate_limit_worker, worker_backend, path, key, hits, start_at)
+                for _ in range(processes)
+            ]
+            outcomes = [future.result() for future in futures]
+            samples = [sample for worker_samples, _ in outcomes for sample in worker_samples]
+            refused = sum(worker_refused for _, worker_refused in outcomes)
+            elapsed = time.time() - start_at
+            if backend == 'local':
+                # The next hit sees every hit before it.
+                counted = SharedMemoryRateLimiter(path).hit(key, RATE_LIMIT_BENCH_WINDOW).count - 1
+            elif backend == 'cache':
+                limiter = CacheRateLimiter(caches['default'])
+                counted = limiter.hit(key, RATE_LIMIT_BENCH_WINDOW).count - 1
+                limiter.reset([key], RATE_LIMIT_BENCH_WINDOW)
+            else:
+                counted = cache.get(key, 0)
+                cache.delete(key)
+            record(backend, samples, counted, refused, elapsed)
+
+    limiter = CacheRateLimiter(LocMemCache('bench-rate-limit', {}))
+    started = time.time()
+    samples = _count_in_threads(limiter, key, processes, hits)
+    elapsed = time.time() - started
+    record('cache (locmem, threads)', samples, limiter.hit(key, RATE_LIMIT_BENCH_WINDOW).count - 1, 0, elapsed)
+    return results
@@ -0,0 +1,255 @@
+"""
+Keyed-HMAC blind indexes for searching encrypted columns.
+
+Encrypted values are randomized, so SQL cannot match them. For every
+registered field the normalized value is split into terms (words or a digit
+string), each prefix of each term is hashed with a secret HMAC key, and the
+tokens are stored in BlindIndexEntry. A search hashes the term the same way,
+which turns it into an indexed lookup on that table.
+
+The HMAC key is FIELD_BLIND_INDEX_KEY. When that is empty it is derived from
+each key on the encryption key ring: entries are written with the primary key,
+lookups try every key on the ring, and rotate_keys rebuilds the index under
+the new key.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import re
+import unicodedata
+from functools import lru_cache
+
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.apps import apps
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+
+from .encrypted_columns import DEFAULT_CHUNK_SIZE, iter_raw_chunks
+from .encrypted_fields import storage_field
+from .keyring import get_key_ring
+
+logger = logging.getLogger(__name__)
+
+MAX_PREFIX_LENGTH = 16
+TOKEN_BYTES = 16
+
+
+def words(value):
+    """Case-folded, accent-stripped alphanumeric words."""
+    value = unicodedata.normalize('NFKD', value)
+    value = ''.join(ch for ch in value if not unicodedata.combining(ch)).casefold()
+    return re.findall(r'[^\W_]+', value)
+
+
+def digits(value):
+    """The digits of the value as a single term (phone numbers)."""
+    value = re.sub(r'\D', '', value)
+    return [value] if value else []
+
+
+# kind -> (normalizer, shortest prefix that is indexed and searchable)
+KINDS = {
+    'words': (words, 2),
+    'digits': (digits, 3),
+}
+
+_registry = {}
+
+
+def register(model_label, **fields):
+    """
+    Maintain a blind index for ``fields`` of the model, given as
+    ``field_name=kind``. Call from AppConfig.ready().
+    """
+    model = apps.get_model(model_label)
+    for name, kind in fields.items():
+        if kind not in KINDS:
+            raise ValueError(f"Unknown blind index kind {kind!r}")
+        model._meta.get_field(name)
+    _registry.setdefault(model._meta.label_lower, {}).update(fields)
+    uid = f'blind_index:{model._meta.label_lower}'
+    post_save.connect(_index_on_save, sender=model, dispatch_uid=uid)
+    post_delete.connect(_delete_on_delete, sender=model, dispatch_uid=uid)
+
+
+def indexed_fields(model):
+    return dict(_registry.get(model._meta.label_lower, {}))
+
+
+def indexed_models():
+    return [apps.get_model(label) for label in _registry]
+
+
+@lru_cache(maxsize=32)
+def derive_index_key(encryption_key):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b'clinic.blind_index',
+    ).derive(base64.urlsafe_b64decode(encryption_key))
+
+
+def uses_derived_key():
+    return not getattr(settings, 'FIELD_BLIND_INDEX_KEY', '')
+
+
+def index_keys():
+    """HMAC keys tried on lookup; the first one is used for writing."""
+    key = getattr(settings, 'FIELD_BLIND_INDEX_KEY', '')
+    if key:
+        return [key.encode() if isinstance(key, str) else key]
+    return [derive_index_key(material) for _, material in get_key_ring().key_material]
+
+
+def _token(key, label, name, prefix):
+    message = f"{label}.{name}\x00{prefix}".encode()
+    return hmac.new(key, message, hashlib.sha256).digest()[:TOKEN_BYTES].hex()
+
+
+def _value_tokens(key, label, name, value):
+    normalize, min_length = KINDS[_registry[label][name]]
+    tokens = set()
+    for term in normalize(value):
+        for length in range(min_length, min(len(term), MAX_PREFIX_LENGTH) + 1):
+            tokens.add(_token(key, label, name, term[:length]))
+    return tokens
+
+
+def search_q(model, fields, term, lookup='pk'):
+    """
+    Q object matching rows where every term of ``term`` is a prefix of a term
+    in one of the indexed ``fields`` of ``model``. ``lookup`` is the path from
+    the queried model to ``model`` (e.g. "patient_profile"). Matches nothing
+    when ``term`` has nothing long enough to search for.
+    """
+    from .models import BlindIndexEntry
+
+    label = model._meta.label_lower
+    spec = _registry.get(label, {})
+    keys = index_keys()
+    per_term = {}
+    for name in fields:
+        normalize, min_length = KINDS[spec[name]]
+        for search_term in normalize(term or ''):
+            if len(search_term) < min_length:
+                continue
+            prefix = search_term[:MAX_PREFIX_LENGTH]
+            tokens = [_token(key, label, name, prefix) for key in keys]
+            per_term.setdefault(search_term, Q())
+            per_term[search_term] |= Q(field=name, token__in=tokens)
+    if not per_term:
+        return Q(pk__in=[])
+
+    q = Q()
+    for condition in per_term.values():
+        object_ids = BlindIndexEntry.objects.filter(condition, model=label).values('object_id')
+        q &= Q(**{f'{lookup}__in': object_ids})
+    return q
+
+
+def index_instance(instance, names=None):
+    """Replace the index entries of ``instance`` for ``names`` (default: all)."""
+    from .models import BlindIndexEntry
+
+    label = instance._meta.label_lower
+    spec = _registry.get(label, {})
+    key = index_keys()[0]
+    replaced = []
+    entries = []
+    for name in spec:
+        field = instance._meta.get_field(name)
+        column = storage_field(field)
+        if names is not None and name not in names and column.name not in names:
+            continue
+        if column.attname not in instance.__dict__:
+            continue  # deferred and never loaded, so unchanged
+        value = getattr(instance, name)
+        if value == field.unavailable_value:
+            continue  # keep the existing entries rather than losing them
+        replaced.append(name)
+        if value in (None, ''):
+            continue
+        entries.extend(
+            BlindIndexEntry(model=label, object_id=instance.pk, field=name, token=token)
+            for token in _value_tokens(key, label, name, str(field.to_plaintext(value)))
+        )
+    if not replaced:
+        return
+
+    db = instance._state.db
+    with transaction.atomic(using=db):
+        BlindIndexEntry.objects.using(db).filter(
+            model=label, object_id=instance.pk, field__in=replaced
+        ).delete()
+        BlindIndexEntry.objects.using(db).bulk_create(entries)
+
+
+def _index_on_save(sender, instance, update_fields=None, **kwargs):
+    index_instance(instance, names=update_fields)
+
+
+def _delete_on_delete(sender, instance, using=None, **kwargs):
+    from .models import BlindIndexEntry
+
+    BlindIndexEntry.objects.using(using).filter(
+        model=instance._meta.label_lower, object_id=instance.pk
+    ).delete()
+
+
+def rebuild(model, chunk_size=DEFAULT_CHUNK_SIZE, decryptor=None, index_key=None):
+    """
+    Recompute the index of every row of ``model`` from the stored tokens, a
+    chunk of rows per transaction, and drop entries of rows that no longer
+    exist. ``decryptor`` (a KeyRing) and
+    ``index_key`` default to the configured key ring and index key. Returns
+    ``(rows, failures)``.
+    """
+    from .models import BlindIndexEntry
+
+    label = model._meta.label_lower
+    fields = [model._meta.get_field(name) for name in _registry[label]]
+    # Packed members share the column of their record; decrypt it once per row.
+    columns = list(dict.fromkeys(storage_field(field) for field in fields))
+    decryptor = decryptor or get_key_ring()
+    index_key = index_key or index_keys()[0]
+    db = router.db_for_write(model)
+    rows_done = failures = 0
+
+    for rows in iter_raw_chunks(model, columns, chunk_size=chunk_size, using=db):
+        entries = []
+        for pk, *stored in rows:
+            plaintexts = {}
+            for column, ciphertext in zip(columns, stored):
+                if not ciphertext:
+                    continue
+                try:
+                    plaintexts[column] = decryptor.decrypt(ciphertext).decode('utf-8')
+                except InvalidToken:
+                    failures += 1
+                    logger.warning("Blind index rebuild could not decrypt %s.%s for pk %s", label, column.name, pk)
+            for field in fields:
+                column = storage_field(field)
+                plaintext = plaintexts.get(column)
+                if plaintext and column is not field:
+                    plaintext = json.loads(plaintext).get(field.name)
+                if not plaintext:
+                    continue
+                entries.extend(
+                    BlindIndexEntry(model=label, object_id=pk, field=field.name, token=token)
+                    for token in _value_tokens(index_key, label, field.name, plaintext)
+                )
+        with transaction.atomic(using=db):
+            BlindIndexEntry.objects.using(db).filter(
+                model=label, object_id__in=[row[0] for row in rows]
+            ).delete()
+            BlindIndexEntry.objects.using(db).bulk_create(entries, batch_size=1000)
+        rows_done += len(rows)
+
+    BlindIndexEntry.objects.using(db).filter(model=label).exclude(
+        object_id__in=model._base_manager.using(db).values('pk')
+    ).delete()
+    return rows_done, failures
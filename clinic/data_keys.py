@@ -0,0 +1,333 @@
+"""
+Per-patient data encryption keys.
+
+Every patient gets a random 256-bit data key, stored in the DataKey table
+wrapped by the master key ring like any other encrypted column. Fields
+declared with ``data_key="<owner id attname>"`` (e.g. "patient_id") encrypt
+under the owner's data key; the envelope records the data key id, so values
+decrypt without knowing which row they came from.
+
+Rotating the master key therefore only rewrites the key table (rotate_keys
+skips values under a data key), and destroying a patient's data key makes
+every value encrypted under it unreadable at once (crypto-shredding).
+Up to FIELD_DATA_KEY_CACHE_SIZE unwrapped keys are kept in an in-process
+LRU; entries expire after FIELD_DATA_KEY_CACHE_TTL seconds. Destroying a key also replaces a
+revocation token in the shared Django cache; every process compares it with
+the token it last saw at most every FIELD_DATA_KEY_SYNC_INTERVAL seconds and
+drops all its unwrapped keys when it changed (or is missing), so a destroyed
+key stops decrypting everywhere within that interval.
+"""
+import base64
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, router, transaction
+
+from . import envelope
+
+logger = logging.getLogger(__name__)
+
+DATA_KEY_SIZE = 32
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 300
+DEFAULT_SYNC_INTERVAL = 1.0
+REVOCATION_KEY = 'clinic:data-keys:revoked'
+
+
+class UnwrappedKey:
+    def __init__(self, key_id, owner_id, key):
+        self.key_id = key_id
+        self.owner_id = owner_id
+        self._key = key
+        self._engines = {}
+
+    def engine(self, engine_id):
+        engine = self._engines.get(engine_id)
+        if engine is None:
+            engine_class = envelope.ENGINES.get(engine_id)
+            if engine_class is None:
+                raise InvalidToken
+            engine = self._engines[engine_id] = engine_class(self._key)
+        return engine
+
+
+class DataKeyCache:
+    """
+    Bounded LRU of unwrapped data keys by key id, with an owner index. With a
+    ``shared`` cache, lookups first check the revocation token there (at
+    most every ``sync_interval`` seconds) and empty the LRU when it changed.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, shared=None,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self._synced = None
+
+    def sync(self, force=False):
+        """Empty the cache if a data key was destroyed since the last sync."""
+        if self.shared is None:
+            return
+        now = time.monotonic()
+        if not force and self._synced is not None and now - self._synced < self.sync_interval:
+            return
+        self._synced = now
+        try:
+            token = self.shared.get(REVOCATION_KEY)
+            if token is None:
+                # Never set, or evicted: start a new token, forgetting every key.
+                self.shared.add(REVOCATION_KEY, os.urandom(8).hex(), timeout=None)
+                token = self.shared.get(REVOCATION_KEY)
+        except Exception:
+            logger.warning("Could not read the data key revocation token", exc_info=True)
+            token = None
+        if token is None or token != self._token:
+            self.clear()
+        self._token = token
+
+    def revoke(self):
+        """Tell every process sharing the cache to forget its unwrapped keys."""
+        if self.shared is not None:
+            self.shared.set(REVOCATION_KEY, os.urandom(8).hex(), timeout=None)
+
+    def get(self, key_id):
+        self.sync()
+        with self._lock:
+            entry = self._entries.get(key_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    self._remove(key_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_id)
+            self.hits += 1
+            return entry[1]
+
+    def get_for_owner(self, owner_id):
+        with self._lock:
+            key_id = self._owners.get(owner_id)
+        return self.get(key_id) if key_id is not None else None
+
+    def put(self, data_key):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[data_key.key_id] = (time.monotonic(), data_key)
+            self._entries.move_to_end(data_key.key_id)
+            self._owners[data_key.owner_id] = data_key.key_id
+            while len(self._entries) > self.maxsize:
+                key_id = next(iter(self._entries))
+                self._remove(key_id)
+
+    def discard_owner(self, owner_id):
+        with self._lock:
+            key_id = self._owners.get(owner_id)
+            if key_id is not None:
+                self._remove(key_id)
+
+    def _remove(self, key_id):
+        _, data_key = self._entries.pop(key_id)
+        if self._owners.get(data_key.owner_id) == key_id:
+            del self._owners[data_key.owner_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_data_key_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DataKeyCache(
+                    maxsize=getattr(settings, 'FIELD_DATA_KEY_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+                    ttl=getattr(settings, 'FIELD_DATA_KEY_CACHE_TTL', DEFAULT_CACHE_TTL),
+                    shared=caches['default'],
+                    sync_interval=getattr(settings, 'FIELD_DATA_KEY_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL),
+                )
+    return _cache
+
+
+def _remember(data_key):
+    """Cache ``data_key`` once the transaction that read or created its row commits."""
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    # A key whose row is rolled back must not stay usable: values sealed
+    # with it could never be decrypted again.
+    transaction.on_commit(lambda: cache.put(data_key), using=router.db_for_write(DataKey))
+
+
+def _unwrap(key_id, owner_id, token, ring):
+    from .keyring import get_key_ring
+
+    rings = [ring] if ring is not None else []
+    rings += [get_key_ring()] if ring is not get_key_ring() else []
+    for candidate in rings:
+        try:
+            key = base64.urlsafe_b64decode(candidate.decrypt(token))
+        except InvalidToken:
+            continue
+        return UnwrappedKey(key_id, owner_id, key)
+    logger.error("Data key %s could not be unwrapped with the master key ring", key_id)
+    raise InvalidToken
+
+
+def load_data_key(key_id, ring=None):
+    """
+    The unwrapped data key ``key_id``. ``ring`` is tried before the
+    configured key ring (rotate_keys unwraps with the key it rotates to).
+    Raises InvalidToken when the key has been destroyed.
+    """
+    from .encrypted_fields import raw_ciphertexts
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    data_key = cache.get(key_id)
+    if data_key is not None:
+        return data_key
+    with raw_ciphertexts():
+        row = DataKey.objects.filter(pk=key_id).values_list('owner_id', 'wrapped_key').first()
+    if row is None or not row[1]:
+        raise InvalidToken
+    data_key = _unwrap(key_id, row[0], row[1], ring)
+    _remember(data_key)
+    return data_key
+
+
+def load_data_keys(key_ids, ring=None):
+    """
+    load_data_key() for several keys, with one query for those not cached.
+    Returns ``{key_id: UnwrappedKey}`` without the keys that have been
+    destroyed or cannot be unwrapped.
+    """
+    from .encrypted_fields import raw_ciphertexts
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    found = {}
+    for key_id in key_ids:
+        data_key = cache.get(key_id)
+        if data_key is not None:
+            found[key_id] = data_key
+    missing = [key_id for key_id in key_ids if key_id not in found]
+    if not missing:
+        return found
+    with raw_ciphertexts():
+        rows = list(DataKey.objects.filter(pk__in=missing).values_list('pk', 'owner_id', 'wrapped_key'))
+    for key_id, owner_id, token in rows:
+        if not token:
+            continue
+        try:
+            data_key = _unwrap(key_id, owner_id, token, ring)
+        except InvalidToken:
+            continue
+        _remember(data_key)
+        found[key_id] = data_key
+    return found
+
+
+def key_for_owner(owner_id):
+    """The owner's data key, created on first use."""
+    from .encrypted_fields import raw_ciphertexts
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    data_key = cache.get_for_owner(owner_id)
+    if data_key is not None:
+        return data_key
+    with raw_ciphertexts():
+        row = DataKey.objects.filter(owner_id=owner_id).values_list('pk', 'wrapped_key').first()
+    if row is not None:
+        data_key = _unwrap(row[0], owner_id, row[1], None)
+    else:
+        key = os.urandom(DATA_KEY_SIZE)
+        try:
+            with transaction.atomic():
+                row = DataKey.objects.create(owner_id=owner_id, wrapped_key=base64.urlsafe_b64encode(key).decode())
+            data_key = UnwrappedKey(row.pk, owner_id, key)
+        except IntegrityError:
+            # Created concurrently by another request; use that one.
+            return key_for_owner(owner_id)
+    _remember(data_key)
+    return data_key
+
+
+def keys_for_owners(owner_ids):
+    """
+    key_for_owner() for several owners, with one query for the keys not
+    cached. Returns ``{owner_id: UnwrappedKey}``.
+    """
+    from .encrypted_fields import raw_ciphertexts
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    found = {}
+    for owner_id in owner_ids:
+        data_key = cache.get_for_owner(owner_id)
+        if data_key is not None:
+            found[owner_id] = data_key
+    missing = [owner_id for owner_id in owner_ids if owner_id not in found]
+    if not missing:
+        return found
+    with raw_ciphertexts():
+        rows = list(DataKey.objects.filter(owner_id__in=missing).values_list('pk', 'owner_id', 'wrapped_key'))
+    for key_id, owner_id, token in rows:
+        data_key = _unwrap(key_id, owner_id, token, None)
+        _remember(data_key)
+        found[owner_id] = data_key
+    for owner_id in missing:
+        if owner_id not in found:
+            found[owner_id] = key_for_owner(owner_id)
+    return found
+
+
+def destroy_data_key(owner_id):
+    """
+    Crypto-shred everything encrypted under the owner's data key: delete the
+    key row and forget the cached key, here at once and in other processes
+    once the deletion is committed. Returns True if there was a key.
+    """
+    from .models import DataKey
+
+    cache = get_data_key_cache()
+    cache.discard_owner(owner_id)
+    deleted, _ = DataKey.objects.filter(owner_id=owner_id).delete()
+    if deleted:
+        # After the commit, so a process that sees the new token cannot read the row.
+        transaction.on_commit(cache.revoke, using=router.db_for_write(DataKey))
+    return bool(deleted)
+
+
+def get_data_key_cache_stats():
+    cache = get_data_key_cache()
+    lookups = cache.hits + cache.misses
+    return {
+        'size': len(cache),
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'hit_rate': cache.hits / lookups if lookups else 0.0,
+    }
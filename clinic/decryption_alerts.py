@@ -0,0 +1,129 @@
+"""
+Decryption-failure alerting that never blocks the request that hit the
+failure.
+
+Failures are counted per model, field and error type. The first failure of
+a kind within FIELD_DECRYPTION_ALERT_INTERVAL seconds schedules an alert;
+later ones are only counted and reported with the next alert. Alerts are
+mailed to ADMINS from a background worker that combines everything queued
+within a few seconds into one message.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.core.mail import mail_admins
+
+from .background import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALERT_INTERVAL = 900
+
+_lock = threading.Lock()
+_failures = Counter()
+_unreported = Counter()
+_last_error = {}
+_last_alert = {}
+_stats = {'alerts_sent': 0, 'alerts_suppressed': 0}
+
+
+def alert_interval():
+    return getattr(settings, 'FIELD_DECRYPTION_ALERT_INTERVAL', DEFAULT_ALERT_INTERVAL)
+
+
+def _failure_key(field, exc):
+    model = getattr(field, 'model', None)
+    label = model._meta.label if model is not None else type(field).__name__
+    return label, getattr(field, 'name', None) or '?', type(exc).__name__
+
+
+def record_failure(field, exc):
+    """Count a failed decryption of ``field`` and alert if none was sent recently."""
+    key = _failure_key(field, exc)
+    now = time.monotonic()
+    with _lock:
+        _failures[key] += 1
+        _unreported[key] += 1
+        _last_error[key] = str(exc)
+        due = now - _last_alert.get(key, float('-inf')) >= alert_interval()
+        if due:
+            _last_alert[key] = now
+        else:
+            _stats['alerts_suppressed'] += 1
+    if not due:
+        return
+
+    label, name, _ = key
+    if isinstance(exc, InvalidToken):
+        logger.critical(
+            f"CRITICAL: Decryption failed for {label}.{name} (InvalidToken). "
+            "This indicates FIELD_ENCRYPTION_KEY has been rotated or data is corrupted. "
+            "IMMEDIATE ACTION REQUIRED: Check encryption key configuration."
+        )
+    else:
+        logger.critical(
+            f"CRITICAL: Unexpected error decrypting {label}.{name}: {exc}. "
+            "IMMEDIATE ACTION REQUIRED: Investigate encryption subsystem."
+        )
+    _alert_worker.submit(key)
+
+
+def _format_alert(key, count, total, error):
+    label, name, error_type = key
+    if error_type == InvalidToken.__name__:
+        warning = (
+            "This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
+            "or the encrypted data is corrupted."
+        )
+    else:
+        warning = "This indicates an issue with the encryption subsystem."
+    return (
+        f"{label}.{name}: {count} failure(s) since the last alert, {total} since startup\n"
+        f"  Error Type: {error_type}\n"
+        f"  Error Details: {error}\n"
+        f"  {warning}"
+    )
+
+
+def _send_alerts(keys):
+    with _lock:
+        report = [
+            (key, _unreported.pop(key, 0), _failures[key], _last_error.get(key))
+            for key in dict.fromkeys(keys)
+        ]
+    mail_admins(
+        subject=f"CRITICAL: Decryption Failure Detected ({len(report)} field(s))",
+        message=(
+            "Decryption failures have occurred.\n\n"
+            + "\n\n".join(_format_alert(*item) for item in report)
+            + "\n\nIMMEDIATE ACTION REQUIRED: Verify encryption key configuration.\n"
+            f"Further failures of the same kind are counted and reported at most "
+            f"once every {alert_interval()} seconds."
+        ),
+        fail_silently=True,
+    )
+    with _lock:
+        _stats['alerts_sent'] += 1
+
+
+_alert_worker = BackgroundWorker('decryption-alerts', _send_alerts, batch_size=50, flush_interval=5.0, maxsize=1000)
+
+
+def get_decryption_failure_stats():
+    """Failure counters since startup, overall and per "<model>.<field>"."""
+    with _lock:
+        by_field = Counter()
+        for (label, name, _), count in _failures.items():
+            by_field[f"{label}.{name}"] += count
+        stats = dict(_stats)
+        stats['failures'] = sum(_failures.values())
+        stats['unreported'] = sum(_unreported.values())
+    stats['by_field'] = dict(by_field)
+    stats['alerts_pending'] = _alert_worker.pending()
+    stats['alerts_dropped'] = _alert_worker.dropped
+    return stats
+
@@ -0,0 +1,123 @@
+"""
+Helpers for maintenance jobs that operate on every encrypted column: finding
+them through the model registry and streaming their raw tokens in primary-key
+order without building model instances or decrypting anything.
+"""
+import json
+
+from django.apps import apps
+
+from .encrypted_fields import EncryptedFieldMixin, raw_ciphertexts
+from .keyring import get_key_ring
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def discover_encrypted_columns(labels=None):
+    """
+    Return ``[(model, [encrypted fields])]`` for every concrete model that
+    declares at least one encrypted column. ``labels`` may restrict the result
+    to app labels ("audit") or model labels ("accounts.CustomUser").
+    """
+    wanted = {label.lower() for label in labels} if labels else None
+    columns = []
+    for model in apps.get_models():
+        opts = model._meta
+        if opts.proxy or not opts.managed:
+            continue
+        if wanted is not None and opts.app_label.lower() not in wanted and opts.label_lower not in wanted:
+            continue
+        fields = [
+            field for field in opts.local_concrete_fields
+            if isinstance(field, EncryptedFieldMixin)
+        ]
+        if fields:
+            columns.append((model, fields))
+    return columns
+
+
+def iter_raw_chunks(model, fields, chunk_size=DEFAULT_CHUNK_SIZE, start_after=None, using=None):
+    """
+    Yield lists of ``(pk, token, token, ...)`` tuples, one token per field,
+    using keyset pagination on the primary key so each query is an index range
+    scan no matter how deep into the table it is. Tokens are Ciphertext or
+    BinaryCiphertext values, or None/''/b'' for empty values.
+    """
+    attnames = [field.attname for field in fields]
+    manager = model._base_manager
+    if using:
+        manager = manager.db_manager(using)
+    last_pk = start_after
+    while True:
+        qs = manager.order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        with raw_ciphertexts():
+            rows = list(qs.values_list('pk', *attnames)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+        if len(rows) < chunk_size:
+            return
+
+
+def copy_encrypted_column(model, source, target, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Decrypt ``source`` and write it re-encrypted into ``target`` on every row,
+    for RunPython migrations that move an encrypted column to another storage
+    format. ``model`` may be a historical model. A value that cannot be
+    decrypted aborts the migration instead of being lost.
+    """
+    manager = model._base_manager
+    last_pk = None
+    while True:
+        qs = manager.order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        rows = list(qs.values_list('pk', source)[:chunk_size])
+        if not rows:
+            return
+        manager.bulk_update([model(pk=pk, **{target: value}) for pk, value in rows], [target], batch_size=100)
+        last_pk = rows[-1][0]
+
+
+def pack_encrypted_columns(model, sources, target, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Decrypt the ``sources`` columns of every row and write their plaintexts
+    as one record into the EncryptedPackedField ``target``. Empty values are
+    left out of the record. Stored tokens are decrypted directly, so a value
+    that cannot be decrypted aborts the migration instead of being packed as
+    a placeholder.
+    """
+    ring = get_key_ring()
+    fields = [model._meta.get_field(name) for name in sources]
+    for rows in iter_raw_chunks(model, fields, chunk_size=chunk_size):
+        objs = []
+        for pk, *tokens in rows:
+            plaintexts = (
+                (field.name, ring.decrypt(token).decode('utf-8'))
+                for field, token in zip(fields, tokens) if token
+            )
+            record = {name: value for name, value in plaintexts if value}
+            objs.append(model(pk=pk, **{target: record}))
+        model._base_manager.bulk_update(objs, [target], batch_size=100)
+
+
+def unpack_encrypted_columns(model, source, targets, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The reverse of pack_encrypted_columns: one column per member of ``source``."""
+    ring = get_key_ring()
+    fields = [model._meta.get_field(name) for name in targets]
+    for rows in iter_raw_chunks(model, [model._meta.get_field(source)], chunk_size=chunk_size):
+        objs = []
+        for pk, token in rows:
+            record = json.loads(ring.decrypt(token).decode('utf-8')) if token else {}
+            values = {}
+            for field in fields:
+                plaintext = record.get(field.name)
+                if plaintext is None:
+                    values[field.name] = None if field.null else ''
+                else:
+                    values[field.name] = field.from_plaintext(plaintext)
+            objs.append(model(pk=pk, **values))
+        model._base_manager.bulk_update(objs, targets, batch_size=100)
@@ -1,277 +1,512 @@
-import os
+import copy
+import hashlib
+import json
 import logging
-from cryptography.fernet import Fernet, InvalidToken
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from itertools import islice
+
+from cryptography.fernet import InvalidToken
+from django import forms
 from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import ModelIterable
+from django.db.models.query_utils import DeferredAttribute
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.core.mail import mail_admins
+from django.core.exceptions import FieldError, ValidationError
+
+from . import envelope
+from .data_keys import key_for_owner
+from .decryption_alerts import record_failure
+from .keyring import get_key_ring, lazy_reencryption_enabled, queue_reencryption
 logger = logging.getLogger(__name__)
 
+DATA_UNAVAILABLE_PLACEHOLDER = "[DATA_UNAVAILABLE]"
+DEFAULT_DECRYPT_CHUNK_SIZE = 500
+DEFAULT_DECRYPTION_CACHE_SIZE = 1024
+DEFAULT_COMPRESS_MIN_SIZE = 256
+# Instance attribute linking rows loaded by the same query chunk.
+PEERS_ATTR = '_encrypted_peers'
+# Instance attribute mapping attname -> (stored token, value it decrypted to).
+ORIGINALS_ATTR = '_encrypted_originals'
+# Instance attribute holding the unencrypted column values as loaded.
+LOADED_ATTR = '_loaded_values'
+# Returned by EncryptedFieldMixin.stored_value() for a modified attribute.
+CHANGED = object()
+
+# Set while an EncryptedQuerySet builds a chunk of rows; encrypted fields then
+# hand back the stored token instead of decrypting it.
+_defer_decryption = contextvars.ContextVar('defer_decryption', default=False)
+# The DecryptionCache of the request being served, if any.
+_decryption_cache = contextvars.ContextVar('decryption_cache', default=None)
+# Owner id whose data key the value being saved is encrypted under, if any.
+_data_key_owner = contextvars.ContextVar('data_key_owner', default=None)
+
 
 def get_encryption_key():
-    key = os.environ.get('FIELD_ENCRYPTION_KEY')
-    if not key:
-        key = getattr(settings, 'FIELD_ENCRYPTION_KEY', None)
-    if not key:
-        raise ImproperlyConfigured(
-            "FIELD_ENCRYPTION_KEY must be set in environment variables or Django settings"
-        )
-    
-    if isinstance(key, str):
-        key = key.encode()
-    
-    return Fernet(key)
+    """
+    MultiFernet over every key on the ring: encrypts with the newest key and
+    decrypts with any of them.
+    """
+    return get_key_ring().fernet
 
 
-class EncryptedTextField(models.TextField):
-    def __init__(self, *args, **kwargs):
+class DecryptionCache:
+    """
+    Bounded LRU of plaintexts keyed by a digest of the ciphertext. One instance
+    lives for exactly one request (see DecryptionCacheMiddleware) so decrypted
+    PHI never outlives the response it was rendered into.
+    """
+
+    def __init__(self, maxsize=DEFAULT_DECRYPTION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.blake2b(token, digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            plaintext = self._entries.get(key)
+            if plaintext is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return plaintext
+
+    def put(self, key, plaintext):
+        with self._lock:
+            self._entries[key] = plaintext
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache_totals = {'requests': 0, 'hits': 0, 'misses': 0}
+_cache_totals_lock = threading.Lock()
+
+
+def get_decryption_cache_stats():
+    """
+    Process-wide hit/miss counters accumulated from every finished request
+    cache. Each hit is one Fernet decryption that did not have to happen.
+    """
+    with _cache_totals_lock:
+        stats = dict(_cache_totals)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+@contextmanager
+def decryption_cache(maxsize=None):
+    """
+    Activate a DecryptionCache for the duration of the block. The cache is
+    emptied on exit, and a size of 0 disables caching entirely.
+    """
+    if maxsize is None:
+        maxsize = getattr(settings, 'FIELD_DECRYPTION_CACHE_SIZE', DEFAULT_DECRYPTION_CACHE_SIZE)
+    if maxsize <= 0:
+        yield None
+        return
+
+    cache = DecryptionCache(maxsize)
+    token = _decryption_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _decryption_cache.reset(token)
+        cache.clear()
+        with _cache_totals_lock:
+            _cache_totals['requests'] += 1
+            _cache_totals['hits'] += cache.hits
+            _cache_totals['misses'] += cache.misses
+
+
+@contextmanager
+def raw_ciphertexts():
+    """
+    Within the block encrypted columns come back as the stored Ciphertext
+    tokens (for model instances and values()/values_list() alike) instead of
+    being decrypted. Used by maintenance jobs that work on raw tokens.
+    """
+    token = _defer_decryption.set(True)
+    try:
+        yield
+    finally:
+        _defer_decryption.reset(token)
+
+
+class Ciphertext(str):
+    """
+    A token exactly as stored in the database whose decryption has been
+    postponed. get_prep_value writes it back untouched, which is how stored
+    tokens are matched and copied without a decrypt/encrypt round trip.
+    """
+    __slots__ = ()
+
+
+class BinaryCiphertext(bytes):
+    """Ciphertext for columns that store the binary envelope."""
+
+
+CIPHERTEXT_TYPES = (Ciphertext, BinaryCiphertext)
+
+
+def _remember_original(instance, field, token, value):
+    instance.__dict__.setdefault(ORIGINALS_ATTR, {})[field.attname] = (token, copy.copy(value))
+
+
+def as_ciphertext(value):
+    """Mark a stored value (text token or binary envelope) as Ciphertext."""
+    if isinstance(value, CIPHERTEXT_TYPES):
+        return value
+    if isinstance(value, str):
+        return Ciphertext(value)
+    return BinaryCiphertext(value)
+
+
+class DecryptingAttribute(DeferredAttribute):
+    """
+    Model attribute for encrypted fields. The instance may hold the stored
+    Ciphertext; it is decrypted on first read and the plaintext replaces it.
+    A deferred column is fetched for every row that was loaded alongside the
+    instance in one query, not row by row.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        attname = self.field.attname
+        if attname not in data and not self._load_for_peers(instance):
+            super().__get__(instance, cls)
+        value = data[attname]
+        if isinstance(value, CIPHERTEXT_TYPES):
+            token, value = value, self.field.decrypt(value)
+            data[attname] = value
+            _remember_original(instance, self.field, token, value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+    def _load_for_peers(self, instance):
+        peers = instance.__dict__.get(PEERS_ATTR)
+        if not peers or instance.pk is None:
+            return False
+        attname = self.field.attname
+        missing = {
+            obj.pk: obj for obj in peers
+            if attname not in obj.__dict__ and obj.pk is not None
+        }
+        manager = type(instance)._base_manager.db_manager(instance._state.db)
+        with raw_ciphertexts():
+            for pk, value in manager.filter(pk__in=list(missing)).values_list('pk', attname):
+                missing[pk].__dict__[attname] = value
+        return attname in instance.__dict__
+
+
+class EncryptedFieldMixin:
+    """
+    Shared encrypt/decrypt behaviour for the Encrypted*Field classes. Subclasses
+    only describe how plaintext maps to and from their Python type.
+    """
+    descriptor_class = DecryptingAttribute
+    unavailable_value = DATA_UNAVAILABLE_PLACEHOLDER
+
+    def __init__(self, *args, compress=None, compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, data_key=None, **kwargs):
+        """
+        ``compress`` ("zlib" or "lzma") compresses plaintexts of at least
+        ``compress_min_size`` bytes before encryption; the envelope header
+        records it, so values written with any setting stay readable.
+
+        ``data_key`` names the attribute holding the id of the user whose
+        data key (clinic.data_keys) saved values are encrypted under, e.g.
+        "patient_id"; without it values use the master key.
+        """
+        if compress not in (None, *envelope.COMPRESSION_FLAGS):
+            raise ValueError(f"Unknown compression {compress!r}")
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.data_key = data_key
         super().__init__(*args, **kwargs)
-        self._fernet = None
-    
-    def _get_fernet(self):
-        if self._fernet is None:
-            self._fernet = get_encryption_key()
-        return self._fernet
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.data_key is not None:
+            kwargs['data_key'] = self.data_key
+        if self.compress is not None:
+            kwargs['compress'] = self.compress
+            if self.compress_min_size != DEFAULT_COMPRESS_MIN_SIZE:
+                kwargs['compress_min_size'] = self.compress_min_size
+        return name, path, args, kwargs
+
+    def compression_for(self, data):
+        if self.compress is not None and len(data) >= self.compress_min_size:
+            return self.compress
+        return None
+
+    def empty_db_value(self, value):
+        return value
+
+    def to_plaintext(self, value):
+        return value
+
+    def from_plaintext(self, plaintext):
+        return plaintext
+
     def from_db_value(self, value, expression, connection):
-        if value is None:
-            return value
-        DATA_UNAVAILABLE_PLACEHOLDER = "[DATA_UNAVAILABLE]"
-        
+        if not value:
+            return self.empty_db_value(value)
+        if _defer_decryption.get():
+            return as_ciphertext(value)
+        return self.decrypt(value)
+
+    def decrypt(self, value):
+        return self._decrypt(value, _decryption_cache.get())
+
+    def _decrypt(self, value, cache):
+        if cache is not None:
+            key = cache.make_key(value)
+            plaintext = cache.get(key)
+            if plaintext is not None:
+                return self.from_plaintext(plaintext)
         try:
-            fernet = self._get_fernet()
-            decrypted = fernet.decrypt(value.encode())
-            return decrypted.decode('utf-8')
+            ring = get_key_ring()
+            plaintext, key_id = ring.decrypt_with_key_id(value)
+            plaintext = plaintext.decode('utf-8')
         except InvalidToken as e:
-            logger.critical(
-                "CRITICAL: Decryption failed for encrypted field (InvalidToken). "
-                "This indicates FIELD_ENCRYPTION_KEY has been rotated or data is corrupted. "
-                "IMMEDIATE ACTION REQUIRED: Check encryption key configuration."
-            )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedTextField.\n\n"
-                        f"Error Type: InvalidToken\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or the encrypted data is corrupted.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Verify encryption key configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return DATA_UNAVAILABLE_PLACEHOLDER
+            self._report_decryption_failure(e)
+            return self.unavailable_value
         except Exception as e:
+            self._report_decryption_failure(e)
+            return self.unavailable_value
+        if lazy_reencryption_enabled() and not ring.is_current(value, key_id):
+            queue_reencryption(self, value)
+        if cache is not None:
+            cache.put(key, plaintext)
+        return self.from_plaintext(plaintext)
+
+    def _decrypt_many(self, values, cache):
+        """
+        _decrypt() for a column of stored values, e.g. this field across a
+        chunk of rows. Cache lookups aside, the values go to
+        KeyRing.decrypt_many() together, so the data keys they need are
+        loaded in one query.
+        """
+        results = [None] * len(values)
+        keys = {}
+        misses = []
+        for index, value in enumerate(values):
+            if cache is not None:
+                key = keys[index] = cache.make_key(value)
+                plaintext = cache.get(key)
+                if plaintext is not None:
+                    results[index] = self.from_plaintext(plaintext)
+                    continue
+            misses.append(index)
+        if not misses:
+            return results
+        try:
+            ring = get_key_ring()
+            opened = ring.decrypt_many([values[index] for index in misses])
+        except Exception as e:
+            opened = [e] * len(misses)
+        reencrypt = lazy_reencryption_enabled()
+        for index, result in zip(misses, opened):
+            if not isinstance(result, Exception):
+                plaintext, key_id = result
+                try:
+                    plaintext = plaintext.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    result = e
+            if isinstance(result, Exception):
+                self._report_decryption_failure(result)
+                results[index] = self.unavailable_value
+                continue
+            value = values[index]
+            if reencrypt and not ring.is_current(value, key_id):
+                queue_reencryption(self, value)
+            if cache is not None:
+                cache.put(keys[index], plaintext)
+            results[index] = self.from_plaintext(plaintext)
+        return results
+
+    def _report_decryption_failure(self, exc):
+        record_failure(self, exc)
+
+    def seal(self, ring, data, data_key=None):
+        return ring.encrypt_text(data, self.compression_for(data), data_key)
+
+    def encrypt(self, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        owner_id = _data_key_owner.get()
+        data_key = key_for_owner(owner_id) if owner_id is not None else None
+        try:
+            return self.seal(get_key_ring(), value, data_key)
+        except Exception:
             logger.critical(
-                f"CRITICAL: Unexpected error decrypting field: {e}. "
-                "IMMEDIATE ACTION REQUIRED: Investigate encryption subsystem."
+                f"CRITICAL: Encryption failed for {type(self).__name__}. "
+                "IMMEDIATE ACTION REQUIRED: Check FIELD_ENCRYPTION_KEY configuration.",
+                exc_info=True
             )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedTextField.\n\n"
-                        f"Error Type: {type(e).__name__}\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or there is an issue with the encryption subsystem.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Investigate encryption configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return DATA_UNAVAILABLE_PLACEHOLDER
-    
-    def to_python(self, value):
-        if isinstance(value, str) or value is None:
+            raise ValueError("Encryption failed.")
+
+    def stored_value(self, instance):
+        """
+        What to write for this column when the attribute still holds the value
+        it was loaded or last saved with (normally the stored token, so it is
+        not re-encrypted), or CHANGED.
+        """
+        value = instance.__dict__.get(self.attname)
+        if isinstance(value, CIPHERTEXT_TYPES):
             return value
-        return str(value)
+        original = instance.__dict__.get(ORIGINALS_ATTR, {}).get(self.attname)
+        if original is not None and original[1] == value:
+            return original[0]
+        return CHANGED
+
+    def pre_save(self, model_instance, add):
+        stored = self.stored_value(model_instance)
+        if stored is not CHANGED:
+            return stored
+        value = super().pre_save(model_instance, add)
+        owner_id = getattr(model_instance, self.data_key) if self.data_key else None
+        reset = _data_key_owner.set(owner_id)
+        try:
+            token = self.get_prep_value(value)
+        finally:
+            _data_key_owner.reset(reset)
+        token = as_ciphertext(token) if token else value
+        _remember_original(model_instance, self, token, value)
+        return token
+
     def get_prep_value(self, value):
         if value is None:
             return None
-        if value == "[DATA_UNAVAILABLE]":
+        if value == DATA_UNAVAILABLE_PLACEHOLDER:
             raise ValidationError(
                 "Cannot save placeholder value '[DATA_UNAVAILABLE]'. "
                 "This indicates a decryption failure. Original encrypted data "
                 "would be permanently lost if saved. Contact system administrator."
             )
-        
-        if isinstance(value, str):
-            value = value.encode('utf-8')
-        
-        try:
-            fernet = self._get_fernet()
-            encrypted = fernet.encrypt(value)
-            return encrypted.decode('utf-8')
-        except Exception:
-            logger.critical(
-                "CRITICAL: Encryption failed for encrypted field. "
-                "IMMEDIATE ACTION REQUIRED: Check FIELD_ENCRYPTION_KEY configuration.",
-                exc_info=True
-            )
-            raise ValueError("Encryption failed.")
+        if isinstance(value, Ciphertext):
+            return str(value)
+        if isinstance(value, BinaryCiphertext):
+            return bytes(value)
+        return self.encrypt(self.to_plaintext(value))
+
+
+class EncryptedTextField(EncryptedFieldMixin, models.TextField):
+    def to_python(self, value):
+        if isinstance(value, str) or value is None:
+            return value
+        return str(value)
 
 
-class EncryptedCharField(models.CharField):
+class EncryptedCharField(EncryptedFieldMixin, models.CharField):
     def __init__(self, *args, **kwargs):
         if 'max_length' not in kwargs or kwargs['max_length'] < 255:
             kwargs['max_length'] = 255
         super().__init__(*args, **kwargs)
-        self._fernet = None
-    
-    def _get_fernet(self):
-        if self._fernet is None:
-            self._fernet = get_encryption_key()
-        return self._fernet
-    def from_db_value(self, value, expression, connection):
-        if value is None or value == '':
-            return value
-        DATA_UNAVAILABLE_PLACEHOLDER = "[DATA_UNAVAILABLE]"
-        
-        try:
-            fernet = self._get_fernet()
-            decrypted = fernet.decrypt(value.encode())
-            return decrypted.decode('utf-8')
-        except InvalidToken as e:
-            logger.critical(
-                "CRITICAL: Decryption failed for EncryptedCharField (InvalidToken). "
-                "IMMEDIATE ACTION REQUIRED: Check encryption key configuration."
-            )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedCharField.\n\n"
-                        f"Error Type: InvalidToken\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or the encrypted data is corrupted.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Verify encryption key configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return DATA_UNAVAILABLE_PLACEHOLDER
-        except Exception as e:
-            logger.critical(
-                f"CRITICAL: Unexpected error decrypting EncryptedCharField: {e}."
-            )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedCharField.\n\n"
-                        f"Error Type: {type(e).__name__}\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or there is an issue with the encryption subsystem.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Investigate encryption configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return DATA_UNAVAILABLE_PLACEHOLDER
-    
+
     def to_python(self, value):
         if isinstance(value, str) or value is None:
             return value
         return str(value)
+
     def get_prep_value(self, value):
-        if value is None or value == '':
+        if value == '':
             return value
-        if value == "[DATA_UNAVAILABLE]":
-            raise ValidationError(
-                "Cannot save placeholder value '[DATA_UNAVAILABLE]'. "
-                "This indicates a decryption failure. Original encrypted data "
-                "would be permanently lost if saved. Contact system administrator."
-            )
-        
-        if isinstance(value, str):
-            value = value.encode('utf-8')
-        
-        try:
-            fernet = self._get_fernet()
-            encrypted = fernet.encrypt(value)
-            return encrypted.decode('utf-8')
-        except Exception:
-            logger.critical(
-                "CRITICAL: Encryption failed for EncryptedCharField. "
-                "IMMEDIATE ACTION REQUIRED: Check FIELD_ENCRYPTION_KEY configuration.",
-                exc_info=True
-            )
-            raise ValueError("Encryption failed.")
+        return super().get_prep_value(value)
+
+
+class EncryptedBinaryTextField(EncryptedFieldMixin, models.BinaryField):
+    """
+    Text encrypted into the compact binary envelope (clinic.envelope) and
+    stored as raw bytes: no base64, and a one-byte key id instead of Fernet's
+    version byte and timestamp. Behaves like a TextField everywhere else.
+    """
+    empty_values = [None, '', b'']
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if kwargs.get('editable'):
+            del kwargs['editable']
+        else:
+            kwargs['editable'] = False
+        return name, path, args, kwargs
 
+    def seal(self, ring, data, data_key=None):
+        return ring.seal(data, self.compression_for(data), data_key)
+
+    def empty_db_value(self, value):
+        return None if value is None else ''
+
+    def get_default(self):
+        return models.Field.get_default(self)
+
+    def get_prep_value(self, value):
+        if value in ('', b''):
+            return b''
+        return super().get_prep_value(value)
+
+    def to_python(self, value):
+        if isinstance(value, str) or value is None:
+            return value
+        return str(value)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{'widget': forms.Textarea, **kwargs})
+
+
+class EncryptedDateField(EncryptedFieldMixin, models.CharField):
+    unavailable_value = None
 
-class EncryptedDateField(models.CharField):
     def __init__(self, *args, **kwargs):
         kwargs['max_length'] = 255
         kwargs.pop('auto_now', None)
         kwargs.pop('auto_now_add', None)
         super().__init__(*args, **kwargs)
-        self._fernet = None
-    
-    def _get_fernet(self):
-        if self._fernet is None:
-            self._fernet = get_encryption_key()
-        return self._fernet
-    def from_db_value(self, value, expression, connection):
-        from datetime import date
-        if value is None or value == '':
-            return None
-        
-        try:
-            fernet = self._get_fernet()
-            decrypted = fernet.decrypt(value.encode()).decode('utf-8')
-            return date.fromisoformat(decrypted)
-        except InvalidToken as e:
-            logger.critical(
-                "CRITICAL: Decryption failed for EncryptedDateField (InvalidToken). "
-                "IMMEDIATE ACTION REQUIRED: Check encryption key configuration."
-            )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedDateField.\n\n"
-                        f"Error Type: InvalidToken\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or the encrypted data is corrupted.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Verify encryption key configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return None
-        except Exception as e:
-            logger.critical(
-                f"CRITICAL: Unexpected error decrypting EncryptedDateField: {e}."
-            )
-            try:
-                mail_admins(
-                    subject="CRITICAL: Decryption Failure Detected",
-                    message=(
-                        "A decryption failure has occurred in EncryptedDateField.\n\n"
-                        f"Error Type: {type(e).__name__}\n"
-                        f"Error Details: {e}\n\n"
-                        "WARNING: This indicates the FIELD_ENCRYPTION_KEY may be incorrect "
-                        "or there is an issue with the encryption subsystem.\n\n"
-                        "IMMEDIATE ACTION REQUIRED: Investigate encryption configuration."
-                    ),
-                    fail_silently=True,
-                )
-            except Exception:
-                pass  # nosec B110 - Defensive: mail_admins already has fail_silently=True
-            return None
-    
+
+    def empty_db_value(self, value):
+        return None
+
+    def to_plaintext(self, value):
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+    def from_plaintext(self, plaintext):
+        return date.fromisoformat(plaintext)
+
     def to_python(self, value):
-        from datetime import date
         if value is None or value == '':
             return None
         if isinstance(value, date):
@@ -282,33 +517,366 @@ class EncryptedDateField(models.CharField):
             except ValueError:
                 return None
         return None
-    
+
+
+class EncryptedPackedField(EncryptedFieldMixin, models.BinaryField):
+    """
+    Several values encrypted together as one JSON record in a single binary
+    envelope, so a row pays for one IV, one tag and one decryption instead of
+    one per value. The values are declared as Packed*Field members with
+    ``packed_in`` naming this field and behave like ordinary attributes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', dict)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if kwargs.get('default') is dict:
+            del kwargs['default']
+        return name, path, args, kwargs
+
+    def seal(self, ring, data, data_key=None):
+        return ring.seal(data, self.compression_for(data), data_key)
+
+    def empty_db_value(self, value):
+        return {}
+
+    def to_plaintext(self, value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+    def from_plaintext(self, plaintext):
+        return json.loads(plaintext)
+
     def get_prep_value(self, value):
-        from datetime import date
-        if value is None:
-            return None
-        
-        if value == "[DATA_UNAVAILABLE]":
-            raise ValidationError(
-                "Cannot save placeholder value '[DATA_UNAVAILABLE]'. "
-                "This indicates a decryption failure. Original encrypted data "
-                "would be permanently lost if saved. Contact system administrator."
-            )
-        
-        if isinstance(value, date):
-            value = value.isoformat()
-        
+        if value in ({}, '', b''):
+            return b''
+        return super().get_prep_value(value)
+
+    def to_python(self, value):
         if isinstance(value, str):
-            value = value.encode('utf-8')
-        
+            return json.loads(value) if value else {}
+        return value or {}
+
+    def value_to_string(self, obj):
+        return self.to_plaintext(self.value_from_object(obj))
+
+
+class PackedAttribute:
+    """Reads and writes one member of an EncryptedPackedField record."""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        record = getattr(instance, self.field.packed_in)
+        if not isinstance(record, dict):
+            return self.field.unavailable_value
+        return self.field.from_plaintext(record.get(self.field.name))
+
+    def __set__(self, instance, value):
+        name = self.field.name
+        record = getattr(instance, self.field.packed_in)
+        if not isinstance(record, dict):
+            return  # the record failed to decrypt; saving it raises instead
+        record = {key: item for key, item in record.items() if key != name}
+        value = self.field.to_plaintext(value)
+        if value not in (None, ''):
+            record[name] = value
+        setattr(instance, self.field.packed_in, record)
+
+
+class PackedMemberMixin:
+    """
+    A virtual field stored inside the EncryptedPackedField named by
+    ``packed_in``. It has no column of its own, so it cannot be filtered or
+    ordered on, but model forms, the admin and full_clean() treat it like the
+    regular field it extends.
+    """
+    unavailable_value = DATA_UNAVAILABLE_PLACEHOLDER
+
+    def __init__(self, *args, packed_in, **kwargs):
+        self.packed_in = packed_in
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['packed_in'] = self.packed_in
+        return name, path, args, kwargs
+
+    @property
+    def packed_field(self):
+        return self.model._meta.get_field(self.packed_in)
+
+    def get_attname_column(self):
+        return self.get_attname(), None
+
+    def get_col(self, alias, output_field=None):
+        raise FieldError(
+            f"{self.model._meta.label}.{self.name} is stored inside {self.packed_in!r} and cannot be used "
+            "in queries; search it through clinic.blind_index."
+        )
+
+    def contribute_to_class(self, cls, name, private_only=False):
+        super().contribute_to_class(cls, name, private_only=True)
+        setattr(cls, self.attname, PackedAttribute(self))
+
+    def to_plaintext(self, value):
+        return self.to_python(value)
+
+    def from_plaintext(self, value):
+        if value is None and not self.null:
+            return ''
+        return value
+
+
+class PackedCharField(PackedMemberMixin, models.CharField):
+    pass
+
+
+class PackedTextField(PackedMemberMixin, models.TextField):
+    pass
+
+
+class PackedDateField(PackedMemberMixin, models.DateField):
+    unavailable_value = None
+
+    def to_plaintext(self, value):
+        value = self.to_python(value)
+        return value.isoformat() if value else None
+
+    def from_plaintext(self, value):
+        if not value:
+            return None
         try:
-            fernet = self._get_fernet()
-            encrypted = fernet.encrypt(value)
-            return encrypted.decode('utf-8')
-        except Exception:
-            logger.critical(
-                "CRITICAL: Encryption failed for EncryptedDateField. "
-                "IMMEDIATE ACTION REQUIRED: Check FIELD_ENCRYPTION_KEY configuration.",
-                exc_info=True
-            )
-            raise ValueError("Encryption failed.")
+            return date.fromisoformat(value)
+        except ValueError:
+            return None
+
+
+def storage_field(field):
+    """The field whose column holds ``field``'s value."""
+    return field.packed_field if isinstance(field, PackedMemberMixin) else field
+
+
+def _snapshot_loaded_values(instance, names=None):
+    data = instance.__dict__
+    loaded = data.setdefault(LOADED_ATTR, {})
+    for field in instance._meta.concrete_fields:
+        if names is not None and field.name not in names and field.attname not in names:
+            continue
+        if field.attname in data and not isinstance(field, EncryptedFieldMixin):
+            loaded[field.attname] = data[field.attname]
+
+
+class ChangeTrackingMixin:
+    """
+    Model mixin that turns a plain save() of a loaded instance into
+    save(update_fields=<fields that changed>), adding auto_now fields when
+    anything changed and skipping the query when nothing did. Encrypted
+    values compare by plaintext, so reading them is not a change, and an
+    unchanged one keeps its stored token instead of being re-encrypted.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        _snapshot_loaded_values(instance)
+        data = instance.__dict__
+        for field in instance._meta.concrete_fields:
+            if not isinstance(field, EncryptedFieldMixin) or field.attname not in data:
+                continue
+            value = data[field.attname]
+            if not isinstance(value, CIPHERTEXT_TYPES):
+                # Empty, or already decrypted by from_db_value; either way writing
+                # it back as is stores the same plaintext.
+                _remember_original(instance, field, value, value)
+        return instance
+
+    def changed_fields(self):
+        """Names of the loaded concrete fields whose value differs from the stored one."""
+        data = self.__dict__
+        loaded = data.get(LOADED_ATTR, {})
+        changed = []
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname not in data:
+                continue
+            if isinstance(field, EncryptedFieldMixin):
+                if field.stored_value(self) is CHANGED:
+                    changed.append(field.name)
+                continue
+            value = data[field.attname]
+            # Containers can be changed in place, so they are always written.
+            if field.attname not in loaded or loaded[field.attname] != value or isinstance(value, (dict, list)):
+                changed.append(field.name)
+        return changed
+
+    def save(self, *args, **kwargs):
+        if (
+            not args
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+            and kwargs.get('using') in (None, self._state.db)
+            and not self._state.adding
+            and LOADED_ATTR in self.__dict__
+        ):
+            changed = self.changed_fields()
+            if changed:
+                changed += [
+                    field.name for field in self._meta.concrete_fields
+                    if getattr(field, 'auto_now', False) and field.name not in changed
+                ]
+            kwargs['update_fields'] = changed
+        super().save(*args, **kwargs)
+        _snapshot_loaded_values(self, kwargs.get('update_fields'))
+
+
+def _iter_related_instances(instances):
+    seen = set()
+    stack = list(instances)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        yield obj
+        stack.extend(
+            related for related in obj._state.fields_cache.values()
+            if isinstance(related, models.Model)
+        )
+
+
+def decrypt_instances(instances):
+    """
+    Resolve every postponed Ciphertext on ``instances`` (including rows pulled
+    in through select_related) a column at a time: each field decrypts its
+    values from all the rows together (EncryptedFieldMixin._decrypt_many).
+    """
+    columns = {}
+    for obj in _iter_related_instances(instances):
+        for field in obj._meta.concrete_fields:
+            if not isinstance(field, EncryptedFieldMixin):
+                continue
+            value = obj.__dict__.get(field.attname)
+            if isinstance(value, CIPHERTEXT_TYPES):
+                columns.setdefault(field, []).append((obj, value))
+
+    cache = _decryption_cache.get()
+    for field, pending in columns.items():
+        values = field._decrypt_many([token for _, token in pending], cache)
+        for (obj, token), value in zip(pending, values):
+            obj.__dict__[field.attname] = value
+            _remember_original(obj, field, token, value)
+
+
+def _link_peers(instances):
+    groups = {}
+    for obj in _iter_related_instances(instances):
+        groups.setdefault(type(obj), []).append(obj)
+    for peers in groups.values():
+        for obj in peers:
+            obj.__dict__[PEERS_ATTR] = peers
+
+
+def _encrypted_paths(model, select_related, prefix=''):
+    for field in model._meta.concrete_fields:
+        if isinstance(field, EncryptedFieldMixin):
+            yield prefix + field.name
+    if isinstance(select_related, dict):
+        for name, nested in select_related.items():
+            related_model = model._meta.get_field(name).related_model
+            yield from _encrypted_paths(related_model, nested, f"{prefix}{name}__")
+
+
+def _storage_path(model, path):
+    *relations, name = path.split(LOOKUP_SEP)
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    return LOOKUP_SEP.join(relations + [storage_field(model._meta.get_field(name)).name])
+
+
+class LazyDecryptModelIterable(ModelIterable):
+    """
+    Builds model instances with decryption postponed, so each encrypted
+    attribute holds its Ciphertext until the DecryptingAttribute descriptor
+    decrypts it on first access. When the query defers columns, rows of the
+    same chunk are linked so a deferred column is loaded for all of them at
+    once.
+    """
+
+    def __iter__(self):
+        chunk_size = self.queryset._decrypt_chunk_size
+        names, defer = self.queryset.query.deferred_loading
+        link = bool(names) or not defer
+        rows = super().__iter__()
+        while True:
+            with raw_ciphertexts():
+                chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            if link:
+                _link_peers(chunk)
+            self.prepare_chunk(chunk)
+            yield from chunk
+
+    def prepare_chunk(self, chunk):
+        pass
+
+
+class BatchDecryptModelIterable(LazyDecryptModelIterable):
+    """
+    Decrypts each chunk of rows column by column before handing it out
+    instead of leaving every value to its descriptor.
+    """
+
+    def prepare_chunk(self, chunk):
+        decrypt_instances(chunk)
+
+
+class EncryptedQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._iterable_class = LazyDecryptModelIterable
+        self._decrypt_chunk_size = DEFAULT_DECRYPT_CHUNK_SIZE
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._decrypt_chunk_size = self._decrypt_chunk_size
+        return clone
+
+    def decrypt_in_batches(self, chunk_size=DEFAULT_DECRYPT_CHUNK_SIZE):
+        """
+        Decrypt encrypted columns a chunk of rows at a time instead of once per
+        attribute on first access: each column of the chunk is decrypted in one
+        go, loading the data keys it needs with a single query. Only affects
+        querysets that return model instances.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer.")
+        clone = self._chain()
+        clone._decrypt_chunk_size = chunk_size
+        if issubclass(clone._iterable_class, ModelIterable):
+            clone._iterable_class = BatchDecryptModelIterable
+        return clone
+
+    def defer_encrypted(self, *keep):
+        """
+        Defer every encrypted column of the model and of the relations already
+        added with select_related(), except the ``keep`` paths ("email",
+        "patient_profile__phone"). A deferred column is fetched the first time
+        it is read, with one query for the whole chunk of rows. Keeping a
+        packed member keeps the record it is stored in.
+        """
+        keep = {_storage_path(self.model, path) for path in keep}
+        names = [
+            name for name in _encrypted_paths(self.model, self.query.select_related)
+            if name not in keep
+        ]
+        return self.defer(*names) if names else self._chain()
+
+
+class EncryptedManager(models.Manager.from_queryset(EncryptedQuerySet)):
+    pass
@@ -0,0 +1,237 @@
+"""
+Compact ciphertext envelope used by every encryption engine except Fernet.
+
+    [magic][key id][engine][flags] body
+
+The four header bytes are authenticated together with the body, so a key id,
+engine or flags byte cannot be swapped without the value failing to decrypt.
+The flags byte records whether the plaintext was compressed (zlib or lzma)
+before encryption, so compressed and uncompressed values read the same way,
+and whether the value is encrypted under a per-patient data key
+(clinic.data_keys) instead of a ring key; such bodies start with the 8-byte
+data key id, which is authenticated with the header. Unlike a
+Fernet token there is no base64, version byte or timestamp, and the key id
+picks the decryption key directly instead of trying every key on the ring.
+Binary columns store the envelope as is; text columns store it base64url
+encoded, which always starts with TEXT_PREFIX and so never looks like a Fernet
+token ("gAAAAA...").
+"""
+import base64
+import hashlib
+import hmac
+import lzma
+import os
+import zlib
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = 0xC1
+HEADER_SIZE = 4
+TEXT_PREFIX = base64.urlsafe_b64encode(bytes((MAGIC,))).decode()[0]
+
+
+FLAG_ZLIB = 0x01
+FLAG_LZMA = 0x02
+FLAG_DATA_KEY = 0x04
+KNOWN_FLAGS = FLAG_ZLIB | FLAG_LZMA | FLAG_DATA_KEY
+DATA_KEY_ID_SIZE = 8
+COMPRESSION_FLAGS = {'zlib': FLAG_ZLIB, 'lzma': FLAG_LZMA}
+# Raw streams: the AEAD tag already protects the data, so the container
+# headers and checksums of the zlib and xz formats would only add bytes.
+_LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+
+def compress(data, method):
+    """
+    Return ``(flags, payload)`` for ``data`` compressed with ``method``
+    ("zlib", "lzma" or None). Data that does not shrink is left as it is.
+    """
+    if method is None:
+        return 0, data
+    if method == 'zlib':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        packed = compressor.compress(data) + compressor.flush()
+    elif method == 'lzma':
+        packed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    else:
+        raise ValueError(f"Unknown compression {method!r}")
+    if len(packed) >= len(data):
+        return 0, data
+    return COMPRESSION_FLAGS[method], packed
+
+
+def decompress(flags, data):
+    if flags & FLAG_ZLIB:
+        return zlib.decompress(data, -15)
+    if flags & FLAG_LZMA:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    return data
+
+
+def compression_of(token):
+    """Compression recorded in a binary or text envelope, or None."""
+    if isinstance(token, str):
+        if not is_text_envelope(token):
+            return None
+        flags = parse_header(from_text(token[:8]))[2]
+    elif is_envelope(token):
+        flags = token[3]
+    else:
+        return None
+    for method, flag in COMPRESSION_FLAGS.items():
+        if flags & flag:
+            return method
+    return None
+
+
+def pack_header(key_id, engine_id, flags=0):
+    return bytes((MAGIC, key_id, engine_id, flags))
+
+
+def parse_header(data):
+    """Return ``(key_id, engine_id, flags)``; raises InvalidToken for anything else."""
+    if len(data) < HEADER_SIZE or data[0] != MAGIC or data[3] & ~KNOWN_FLAGS:
+        raise InvalidToken
+    return data[1], data[2], data[3]
+
+
+def data_key_id(token):
+    """Id of the data key a binary or text envelope is encrypted under, or None."""
+    if isinstance(token, str):
+        if not is_text_envelope(token):
+            return None
+        token = from_text(token[:16])
+    elif not is_envelope(token):
+        return None
+    if not token[3] & FLAG_DATA_KEY:
+        return None
+    id_bytes = bytes(token[HEADER_SIZE:HEADER_SIZE + DATA_KEY_ID_SIZE])
+    if len(id_bytes) != DATA_KEY_ID_SIZE:
+        raise InvalidToken
+    return int.from_bytes(id_bytes, 'big')
+
+
+def is_envelope(token):
+    return isinstance(token, (bytes, bytearray, memoryview)) and len(token) > 0 and token[0] == MAGIC
+
+
+def is_text_envelope(token):
+    return token[:1] == TEXT_PREFIX
+
+
+def to_text(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def from_text(token):
+    try:
+        return base64.urlsafe_b64decode(token)
+    except ValueError:
+        raise InvalidToken
+
+
+def peek_engine_id(token):
+    """Engine byte of a binary or text envelope without decoding the body."""
+    if isinstance(token, str):
+        token = from_text(token[:8])
+    return parse_header(token)[1]
+
+
+class AesCbcHmacEngine:
+    """
+    Fernet's primitives (AES-128-CBC, then HMAC-SHA256 over header, IV and
+    ciphertext, truncated to 128 bits) keyed with the two halves of a Fernet
+    key, so the configured keys work unchanged.
+    """
+    engine_id = 1
+    name = 'aes-cbc-hmac'
+    iv_size = 16
+    tag_size = 16
+
+    def __init__(self, key):
+        if len(key) != 32:
+            raise ValueError("AES-CBC-HMAC needs a 32-byte key")
+        self._signing_key = key[:16]
+        self._encryption_key = key[16:]
+
+    def _tag(self, header, payload):
+        mac = hmac.new(self._signing_key, header, hashlib.sha256)
+        mac.update(payload)
+        return mac.digest()[:self.tag_size]
+
+    def seal(self, header, plaintext):
+        iv = os.urandom(self.iv_size)
+        padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        padded = padder.update(plaintext) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(self._encryption_key), modes.CBC(iv)).encryptor()
+        payload = iv + encryptor.update(padded) + encryptor.finalize()
+        return payload + self._tag(header, payload)
+
+    def open(self, header, body):
+        body = memoryview(body)
+        if len(body) < self.iv_size + self.tag_size + 16:
+            raise InvalidToken
+        payload, tag = body[:-self.tag_size], body[-self.tag_size:]
+        if not hmac.compare_digest(self._tag(header, payload), tag):
+            raise InvalidToken
+        decryptor = Cipher(
+            algorithms.AES(self._encryption_key), modes.CBC(bytes(payload[:self.iv_size]))
+        ).decryptor()
+        padded = decryptor.update(payload[self.iv_size:]) + decryptor.finalize()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        try:
+            return unpadder.update(padded) + unpadder.finalize()
+        except ValueError:
+            raise InvalidToken
+
+
+class _AeadEngine:
+    """
+    ``nonce || ciphertext || 16-byte tag`` with the header as associated data.
+    The engine key is derived from the configured key with HKDF so no two
+    engines ever share key material. Nonces are random, which is safe for far
+    more values than a key encrypts before it is rotated.
+    """
+    nonce_size = 12
+    tag_size = 16
+    aead_class = None
+
+    def __init__(self, key):
+        engine_key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=f'clinic.envelope.{self.name}'.encode(),
+        ).derive(key)
+        self._aead = self.aead_class(engine_key)
+
+    def seal(self, header, plaintext):
+        nonce = os.urandom(self.nonce_size)
+        return nonce + self._aead.encrypt(nonce, plaintext, header)
+
+    def open(self, header, body):
+        body = memoryview(body)
+        if len(body) < self.nonce_size + self.tag_size:
+            raise InvalidToken
+        try:
+            return self._aead.decrypt(body[:self.nonce_size], body[self.nonce_size:], header)
+        except InvalidTag:
+            raise InvalidToken
+
+
+class AesGcmEngine(_AeadEngine):
+    engine_id = 2
+    name = 'aes-gcm'
+    aead_class = AESGCM
+
+
+class ChaCha20Poly1305Engine(_AeadEngine):
+    engine_id = 3
+    name = 'chacha20-poly1305'
+    aead_class = ChaCha20Poly1305
+
+
+ENGINES = {engine.engine_id: engine for engine in (AesCbcHmacEngine, AesGcmEngine, ChaCha20Poly1305Engine)}
+ENGINES_BY_NAME = {engine.name: engine for engine in ENGINES.values()}
@@ -0,0 +1,359 @@
+"""
+Versioned key ring for field encryption.
+
+Keys are configured newest first, either through FIELD_ENCRYPTION_KEYS
+("<key id>:<fernet key>" entries) or the single legacy FIELD_ENCRYPTION_KEY.
+Values are always written with the newest key and read with any key still on
+the ring, so a new key can be deployed without taking the application down.
+Rows that are read under an older key can be queued for re-encryption in the
+background (FIELD_ENCRYPTION_LAZY_REENCRYPT).
+
+New values are written with FIELD_ENCRYPTION_ENGINE: "aes-gcm" or
+"chacha20-poly1305" (compact envelopes from clinic.envelope, base64url encoded
+in text columns) or "fernet" (Fernet tokens in text columns, AES-CBC-HMAC
+envelopes in binary ones). Every format stays readable whatever the setting.
+
+Values can also be encrypted under a per-patient data key (clinic.data_keys)
+instead of the primary key; the ring only unwraps those keys.
+"""
+import base64
+import os
+import logging
+import threading
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import envelope
+from .background import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_ID = 255
+LEGACY_KEY_ID = 1
+FERNET = 'fernet'
+DEFAULT_ENGINE = 'aes-gcm'
+ENGINE_CHOICES = [FERNET] + list(envelope.ENGINES_BY_NAME)
+
+
+def parse_key_entries(entries):
+    """
+    Turn "<id>:<key>" strings (newest first) into ``[(key_id, key_bytes)]``.
+    Entries without an id are numbered so that the first one is the newest.
+    """
+    entries = [entry.strip() for entry in entries if entry and entry.strip()]
+    parsed = []
+    for position, entry in enumerate(entries):
+        key_id, sep, key = entry.partition(':')
+        if sep:
+            try:
+                key_id = int(key_id)
+            except ValueError:
+                raise ImproperlyConfigured(f"Invalid encryption key id {key_id!r}; key ids must be integers")
+        else:
+            key_id, key = len(entries) - position, entry
+        if not 0 <= key_id <= MAX_KEY_ID:
+            raise ImproperlyConfigured(f"Encryption key id {key_id} is outside 0-{MAX_KEY_ID}")
+        parsed.append((key_id, key.strip().encode()))
+
+    key_ids = [key_id for key_id, _ in parsed]
+    if len(set(key_ids)) != len(key_ids):
+        raise ImproperlyConfigured("Encryption key ids must be unique")
+    return parsed
+
+
+class KeyRing:
+    def __init__(self, keys, engine=DEFAULT_ENGINE):
+        if not keys:
+            raise ImproperlyConfigured("The encryption key ring needs at least one key")
+        if engine not in ENGINE_CHOICES:
+            raise ImproperlyConfigured(
+                f"Unknown encryption engine {engine!r}; choose one of {', '.join(ENGINE_CHOICES)}"
+            )
+        self.engine = engine
+        self.key_material = list(keys)
+        try:
+            self.keys = [(key_id, Fernet(key)) for key_id, key in keys]
+            raw_keys = [(key_id, base64.urlsafe_b64decode(key)) for key_id, key in keys]
+        except (ValueError, TypeError) as e:
+            raise ImproperlyConfigured(f"Invalid field encryption key: {e}")
+        self._engines = {
+            (key_id, engine_id): engine_class(raw)
+            for key_id, raw in raw_keys
+            for engine_id, engine_class in envelope.ENGINES.items()
+        }
+        self.primary_id, self.primary = self.keys[0]
+        self.fernet = MultiFernet([fernet for _, fernet in self.keys])
+        # Binary columns cannot hold Fernet tokens; they use Fernet's primitives.
+        self._binary_engine_id = envelope.ENGINES_BY_NAME.get(engine, envelope.AesCbcHmacEngine).engine_id
+        self._text_engine_id = None if engine == FERNET else self._binary_engine_id
+
+    @property
+    def key_ids(self):
+        return [key_id for key_id, _ in self.keys]
+
+    def encrypt(self, data):
+        """Encrypt for a text column; returns the token as ASCII bytes."""
+        return self.encrypt_text(data).encode()
+
+    def encrypt_text(self, data, compression=None, data_key=None):
+        """
+        Encrypt for a text column. ``compression`` ("zlib" or "lzma") is
+        ignored by the fernet engine, whose tokens have nowhere to record it;
+        values under a ``data_key`` (an UnwrappedKey) always use an envelope.
+        """
+        if self._text_engine_id is None and data_key is None:
+            return self.primary.encrypt(data).decode()
+        engine_id = self._text_engine_id or self._binary_engine_id
+        return envelope.to_text(self._seal(data, engine_id, compression, data_key))
+
+    def seal(self, data, compression=None, data_key=None):
+        """Encrypt into a binary envelope under the primary key or ``data_key``."""
+        return self._seal(data, self._binary_engine_id, compression, data_key)
+
+    def _seal(self, data, engine_id, compression=None, data_key=None):
+        flags, data = envelope.compress(data, compression)
+        if data_key is None:
+            header = envelope.pack_header(self.primary_id, engine_id, flags)
+            return header + self._engines[(self.primary_id, engine_id)].seal(header, data)
+        header = envelope.pack_header(0, engine_id, flags | envelope.FLAG_DATA_KEY)
+        header += data_key.key_id.to_bytes(envelope.DATA_KEY_ID_SIZE, 'big')
+        return header + data_key.engine(engine_id).seal(header, data)
+
+    def decrypt(self, token):
+        return self.decrypt_with_key_id(token)[0]
+
+    def decrypt_with_key_id(self, token):
+        """
+        Return ``(plaintext, key_id)`` for any stored value: a Fernet token or
+        text envelope (str or ASCII bytes) or a binary envelope. Raises
+        InvalidToken if no key fits.
+        """
+        return self._open_any(self._unwrap_token(token))
+
+    def decrypt_many(self, tokens):
+        """
+        decrypt_with_key_id() for a column of values at once. The data keys
+        they are sealed under are loaded together, with at most one query,
+        instead of once per value. Returns a list holding ``(plaintext,
+        key_id)`` or, for a value that cannot be decrypted, the exception.
+        """
+        from .data_keys import load_data_keys
+
+        opened = []
+        data_key_ids = set()
+        for token in tokens:
+            try:
+                data = self._unwrap_token(token)
+                if not isinstance(data, str) and envelope.parse_header(data)[2] & envelope.FLAG_DATA_KEY:
+                    data_key_ids.add(envelope.data_key_id(data))
+            except InvalidToken as e:
+                data = e
+            opened.append(data)
+        data_keys = load_data_keys(data_key_ids, ring=self) if data_key_ids else {}
+        results = []
+        for data in opened:
+            if isinstance(data, Exception):
+                results.append(data)
+                continue
+            try:
+                results.append(self._open_any(data, data_keys))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _unwrap_token(self, token):
+        """The binary envelope held by a stored value, or the Fernet token (str) if it is not one."""
+        if not isinstance(token, str):
+            if envelope.is_envelope(token):
+                return token
+            try:
+                token = bytes(token).decode('ascii')
+            except UnicodeDecodeError:
+                raise InvalidToken
+        if envelope.is_text_envelope(token):
+            return envelope.from_text(token)
+        return token
+
+    def _open_any(self, data, data_keys=None):
+        if not isinstance(data, str):
+            return self._open(data, data_keys)
+        token = data.encode()
+        for key_id, fernet in self.keys:
+            try:
+                return fernet.decrypt(token), key_id
+            except InvalidToken:
+                continue
+        raise InvalidToken
+
+    def _open(self, data, data_keys=None):
+        key_id, engine_id, flags = envelope.parse_header(data)
+        if flags & envelope.FLAG_DATA_KEY:
+            return self._open_with_data_key(data, engine_id, flags, data_keys)
+        data = memoryview(data)
+        header, body = bytes(data[:envelope.HEADER_SIZE]), data[envelope.HEADER_SIZE:]
+        # The header names the key; the others are only tried when the ids were
+        # assigned differently (e.g. keys passed to rotate_keys without ids).
+        candidates = [key_id] if key_id in self.key_ids else []
+        candidates += [other for other in self.key_ids if other != key_id]
+        for candidate in candidates:
+            engine = self._engines.get((candidate, engine_id))
+            if engine is None:
+                raise InvalidToken
+            try:
+                plaintext = engine.open(header, body)
+            except InvalidToken:
+                continue
+            return envelope.decompress(flags, plaintext), candidate
+        raise InvalidToken
+
+    def _open_with_data_key(self, data, engine_id, flags, data_keys=None):
+        from .data_keys import load_data_key
+
+        size = envelope.HEADER_SIZE + envelope.DATA_KEY_ID_SIZE
+        data = memoryview(data)
+        header, body = bytes(data[:size]), data[size:]
+        if data_keys is None:
+            data_key = load_data_key(envelope.data_key_id(header), ring=self)
+        else:
+            # Preloaded by decrypt_many(); a missing key has been destroyed.
+            data_key = data_keys.get(envelope.data_key_id(header))
+            if data_key is None:
+                raise InvalidToken
+        plaintext = data_key.engine(engine_id).open(header, body)
+        # Data keys do not depend on the master key, so the value is current
+        # as far as key rotation is concerned.
+        return envelope.decompress(flags, plaintext), self.primary_id
+
+    def is_current(self, token, key_id):
+        """
+        True when ``token`` (decrypted with ``key_id``) already uses the primary
+        key and the configured engine, i.e. re-encrypting it would change nothing.
+        """
+        if key_id != self.primary_id:
+            return False
+        if isinstance(token, str):
+            if envelope.is_text_envelope(token):
+                expected = self._text_engine_id
+                if expected is None and envelope.data_key_id(token) is not None:
+                    expected = self._binary_engine_id
+                return envelope.peek_engine_id(token) == expected
+            return self._text_engine_id is None
+        if envelope.is_envelope(token):
+            return envelope.peek_engine_id(token) == self._binary_engine_id
+        return self._text_engine_id is None
+
+    def reencrypt(self, token, plaintext, data_key=None):
+        """
+        Encrypt ``plaintext`` under the primary key and configured engine, for
+        the same kind of column ``token`` came from and with the same
+        compression. A value under a data key stays under it unless another
+        ``data_key`` is given.
+        """
+        from .data_keys import load_data_key
+
+        compression = envelope.compression_of(token)
+        data_key_id = envelope.data_key_id(token)
+        if data_key is None and data_key_id is not None:
+            data_key = load_data_key(data_key_id, ring=self)
+        if isinstance(token, str):
+            return self.encrypt_text(plaintext, compression, data_key)
+        if envelope.is_envelope(token):
+            return self.seal(plaintext, compression, data_key)
+        return self.encrypt_text(plaintext, compression, data_key).encode()
+
+    def rotate(self, token):
+        return self.reencrypt(token, self.decrypt(token))
+
+
+_key_ring = None
+_key_ring_lock = threading.Lock()
+
+
+def _configured_key_entries():
+    keys = os.environ.get('FIELD_ENCRYPTION_KEYS')
+    if keys:
+        return keys.split(',')
+    keys = getattr(settings, 'FIELD_ENCRYPTION_KEYS', None)
+    if keys:
+        return list(keys)
+
+    key = os.environ.get('FIELD_ENCRYPTION_KEY')
+    if not key:
+        key = getattr(settings, 'FIELD_ENCRYPTION_KEY', None)
+    if not key:
+        raise ImproperlyConfigured(
+            "FIELD_ENCRYPTION_KEY must be set in environment variables or Django settings"
+        )
+    if isinstance(key, bytes):
+        key = key.decode()
+    return [f"{LEGACY_KEY_ID}:{key}"]
+
+
+def configured_engine():
+    return getattr(settings, 'FIELD_ENCRYPTION_ENGINE', DEFAULT_ENGINE)
+
+
+def get_key_ring():
+    global _key_ring
+    if _key_ring is None:
+        with _key_ring_lock:
+            if _key_ring is None:
+                _key_ring = KeyRing(parse_key_entries(_configured_key_entries()), engine=configured_engine())
+    return _key_ring
+
+
+def reset_key_ring():
+    """Forget the cached ring so the next use re-reads the configuration."""
+    global _key_ring
+    with _key_ring_lock:
+        _key_ring = None
+
+
+def _reencrypt_batch(items):
+    from .encrypted_fields import as_ciphertext
+
+    ring = get_key_ring()
+    for field, token in items:
+        _pending.discard((field.model._meta.label, field.attname, token))
+        try:
+            new_token = ring.rotate(token)
+        except InvalidToken:
+            continue
+        # Match on the exact stored token: if the row changed in the meantime
+        # nothing is updated and the newer value wins.
+        updated = field.model._base_manager.filter(
+            **{field.attname: as_ciphertext(token)}
+        ).update(**{field.attname: as_ciphertext(new_token)})
+        _reencryption_stats['reencrypted'] += updated
+
+
+_reencryption_worker = BackgroundWorker('field-reencryption', _reencrypt_batch, batch_size=200)
+_reencryption_stats = {'queued': 0, 'reencrypted': 0}
+_pending = set()
+
+
+def lazy_reencryption_enabled():
+    return getattr(settings, 'FIELD_ENCRYPTION_LAZY_REENCRYPT', False)
+
+
+def queue_reencryption(field, token):
+    """Schedule a value not yet on the primary key and engine for re-encryption."""
+    if isinstance(token, memoryview):
+        token = bytes(token)
+    marker = (field.model._meta.label, field.attname, token)
+    if marker in _pending:
+        return
+    _pending.add(marker)
+    if _reencryption_worker.submit((field, token)):
+        _reencryption_stats['queued'] += 1
+    else:
+        _pending.discard(marker)
+
+
+def get_reencryption_stats():
+    stats = dict(_reencryption_stats)
+    stats['pending'] = _reencryption_worker.pending()
+    stats['dropped'] = _reencryption_worker.dropped
+    return stats
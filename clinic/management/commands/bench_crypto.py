@@ -0,0 +1,317 @@
+import json
+import platform
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from audit.writer import DEFAULT_BATCH_SIZE
+from clinic import benchmarks
+from clinic.keyring import configured_engine
+
+SCENARIOS = [
+    'batch-decrypt', 'rotation', 'storage', 'engines', 'packing', 'compression', 'fields', 'querysets', 'otp',
+    'audit-db', 'rate-limit',
+]
+# Run by --scenario suite: the per-field, queryset and OTP micro-benchmarks.
+SUITE = ['fields', 'querysets', 'otp']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the field encryption subsystem (database scenarios run inside a rolled-back transaction)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario',
+            choices=SCENARIOS + ['suite'],
+            default='batch-decrypt',
+            help='batch-decrypt: per-field vs batched queryset decryption; '
+                 'rotation: rotate_keys re-encryption throughput; '
+                 'storage: text vs binary column encoding; '
+                 'engines: encrypt/decrypt cost of each cipher engine per payload size; '
+                 'packing: separate encrypted columns vs one packed record per row; '
+                 'compression: size and cost of zlib/lzma on realistic clinical text; '
+                 'fields: encrypt/decrypt latency percentiles of each encrypted field class per payload size; '
+                 'querysets: from_db_value cost per row of realistic querysets; '
+                 'otp: OTP hashing and verification cost; '
+                 'audit-db: clinical write throughput with audit writes in the same SQLite file vs a separate one; '
+                 'rate-limit: concurrent hits on one rate-limit key per backend, checking none are lost; '
+                 'suite: fields, querysets and otp'
+        )
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=None,
+            help='Number of synthetic rows (default: 2000 for batch-decrypt, 1000 for querysets, 1000000 for rotation)'
+        )
+        parser.add_argument(
+            '--no-seed',
+            action='store_true',
+            help='Benchmark the rows already in the database instead of seeding'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Rows per decryption batch or rotation chunk'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Processes for rotation (default: CPU count) or request processes for audit-db and '
+                 'rate-limit (default: 4)'
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=3.0,
+            help='Duration of each audit-db run'
+        )
+        parser.add_argument(
+            '--audit-rate',
+            type=int,
+            default=2000,
+            help='Audit rows per second the audit-db writer inserts'
+        )
+        parser.add_argument(
+            '--directory',
+            default=None,
+            help='Where audit-db and rate-limit create their throwaway files (default: the temporary '
+                 'directory); use the disk the databases live on'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Report the best of this many runs'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=None,
+            help='Timed calls per measurement for fields/querysets/otp (default: 2000, 20 and 20), '
+                 'or hits per worker for rate-limit (default: 2000)'
+        )
+        parser.add_argument(
+            '--json',
+            metavar='PATH',
+            default=None,
+            help='Also write the results as JSON to PATH ("-" for stdout) for comparing runs'
+        )
+
+    def handle(self, *args, **options):
+        if options['rows'] is not None and options['rows'] < 1:
+            raise CommandError("--rows must be positive")
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+        if options['iterations'] is not None and options['iterations'] < 1:
+            raise CommandError("--iterations must be positive")
+        if options['audit_rate'] < 1 or options['seconds'] <= 0:
+            raise CommandError("--audit-rate and --seconds must be positive")
+
+        scenarios = SUITE if options['scenario'] == 'suite' else [options['scenario']]
+        if options['json'] == '-':
+            # Keep stdout parseable; the human-readable report goes to stderr.
+            self.stdout = self.stderr
+        results = {}
+        for index, scenario in enumerate(scenarios):
+            if len(scenarios) > 1:
+                self.stdout.write(("\n" if index else "") + self.style.MIGRATE_HEADING(f"== {scenario} =="))
+            results[scenario] = getattr(self, '_' + scenario.replace('-', '_'))(options)
+
+        if options['json']:
+            self._write_json(options['json'], results)
+
+    def _write_json(self, path, results):
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'engine': configured_engine(),
+            'results': results,
+        }
+        if path == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(path, 'w') as fh:
+                json.dump(report, fh, indent=2)
+            self.stdout.write(f"\nResults written to {path}")
+
+    def _latency(self, label, stats):
+        self.stdout.write(
+            f"  {label:<16} p50 {stats['p50_us']:9.1f} us  p90 {stats['p90_us']:9.1f} us  "
+            f"p99 {stats['p99_us']:9.1f} us  ({stats['ops_per_second']:,.0f}/s)"
+        )
+
+    def _fields(self, options):
+        results = benchmarks.bench_fields(iterations=options['iterations'] or 2000)
+        field = None
+        for result in results:
+            if result['field'] != field:
+                field = result['field']
+                self.stdout.write(field)
+            self.stdout.write(f" {result['payload']} -> {result['stored_bytes']} bytes stored")
+            self._latency('encrypt', result['encrypt'])
+            self._latency('decrypt', result['decrypt'])
+        return results
+
+    def _querysets(self, options):
+        results = benchmarks.bench_querysets(
+            rows=options['rows'] or 1000,
+            repeat=options['iterations'] or 20,
+            seed=not options['no_seed'],
+        )
+        if not results:
+            self.stdout.write(self.style.WARNING("No rows to benchmark."))
+        for result in results:
+            self.stdout.write(f"{result['queryset']} ({result['rows']} rows, per row)")
+            self._latency('decrypted', result['decrypted'])
+            self._latency('raw', result['raw'])
+            self.stdout.write(self.style.SUCCESS(
+                f"  decryption: {result['decrypt_us_per_row']:.1f} us/row"
+            ))
+        return results
+
+    def _otp(self, options):
+        results = benchmarks.bench_otp(iterations=options['iterations'] or 20)
+        self.stdout.write(f"OTP hasher: {results['hasher']}")
+        for label in ('hash_otp_code', 'verify_valid', 'verify_invalid', 'hash_email'):
+            self._latency(label, results[label])
+        return results
+
+    def _audit_db(self, options):
+        results = benchmarks.bench_audit_database(
+            seconds=options['seconds'],
+            processes=options['workers'] or 4,
+            audit_rate=options['audit_rate'],
+            audit_batch=DEFAULT_BATCH_SIZE,
+            rows=options['rows'] or 1000,
+            directory=options['directory'],
+        )
+        baseline = results[0]['clinical_per_second']
+        for result in results:
+            self.stdout.write(
+                f"{result['layout']:<16} {result['clinical_per_second']:8,.0f} clinical tx/s "
+                f"({result['clinical_per_second'] / baseline:4.0%} of baseline)  "
+                f"audit {result['audit_rows_per_second']:7,.0f} of {result['audit_rate']:,} rows/s"
+            )
+            self._latency('clinical tx', result['clinical'])
+        shared, separate = results[1], results[2]
+        self.stdout.write(self.style.SUCCESS(
+            f"  separate audit database: {separate['clinical_per_second'] / shared['clinical_per_second']:.2f}x "
+            f"clinical throughput, p99 {shared['clinical']['p99_us']:,.0f} -> {separate['clinical']['p99_us']:,.0f} us"
+        ))
+        return results
+
+    def _rate_limit(self, options):
+        results = benchmarks.bench_rate_limiter(
+            processes=options['workers'] or 4,
+            hits=options['iterations'] or 2000,
+            directory=options['directory'],
+        )
+        for result in results:
+            style = self.style.SUCCESS if result['lost'] == 0 else self.style.WARNING
+            self.stdout.write(style(
+                f"{result['backend']:<24} {result['hits_per_second']:9,.0f} hits/s  "
+                f"counted {result['counted']:,} of {result['hits']:,} "
+                f"({result['refused']:,} refused, {result['lost']:,} lost)"
+            ))
+            self._latency('hit', result['latency'])
+        return results
+
+    def _rotation(self, options):
+        results = benchmarks.bench_rotation(
+            rows=options['rows'] or 1_000_000,
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+        )
+        self.stdout.write(
+            f"Rotated {results['updated']:,} of {results['rows']:,} tokens in {results['seconds']:.2f}s "
+            f"(chunk={results['chunk_size']}, workers={results['workers']})"
+        )
+        self.stdout.write(self.style.SUCCESS(f"  {results['rows_per_second']:,.0f} rows/s"))
+        return results
+
+    def _storage(self, options):
+        results = benchmarks.bench_storage()
+        for result in results:
+            self.stdout.write(f"{result['payload']} ({result['plaintext_bytes']} bytes of plaintext)")
+            self.stdout.write(
+                f"  text:   {result['text_bytes']:>6} bytes  {result['text_decrypt_us']:8.1f} us/decrypt"
+            )
+            self.stdout.write(
+                f"  binary: {result['binary_bytes']:>6} bytes  {result['binary_decrypt_us']:8.1f} us/decrypt"
+            )
+            self.stdout.write(self.style.SUCCESS(f"  {result['saving']:.0%} smaller"))
+        return results
+
+    def _engines(self, options):
+        payload = None
+        results = benchmarks.bench_engines()
+        for result in results:
+            if result['payload'] != payload:
+                payload = result['payload']
+                self.stdout.write(payload)
+            self.stdout.write(
+                f"  {result['engine']:<18} {result['stored_bytes']:>6} bytes  "
+                f"encrypt {result['encrypt_us']:7.1f} us  decrypt {result['decrypt_us']:7.1f} us  "
+                f"({result['decrypt_mb_per_second']:,.1f} MB/s)"
+            )
+        return results
+
+    def _packing(self, options):
+        result = benchmarks.bench_packing()
+        self.stdout.write(f"Patient profile ({result['values']} values)")
+        self.stdout.write(
+            f"  separate columns: {result['separate_bytes']:>4} bytes  "
+            f"{result['separate_decrypt_us']:7.1f} us/row"
+        )
+        self.stdout.write(
+            f"  packed record:    {result['packed_bytes']:>4} bytes  "
+            f"{result['packed_decrypt_us']:7.1f} us/row"
+        )
+        self.stdout.write(self.style.SUCCESS(f"  {result['saving']:.0%} smaller"))
+        return result
+
+    def _compression(self, options):
+        payload = None
+        results = benchmarks.bench_compression()
+        for result in results:
+            if result['payload'] != payload:
+                payload = result['payload']
+                self.stdout.write(f"{payload} ({result['plaintext_bytes']} bytes of plaintext)")
+            self.stdout.write(
+                f"  {result['compression']:<5} binary {result['binary_bytes']:>5} bytes ({result['ratio']:4.0%})  "
+                f"text {result['text_bytes']:>5} bytes  "
+                f"encrypt {result['encrypt_us']:7.1f} us  decrypt {result['decrypt_us']:7.1f} us"
+            )
+        return results
+
+    def _batch_decrypt(self, options):
+        results = benchmarks.bench_batch_decryption(
+            rows=options['rows'] or 2000,
+            chunk_size=options['chunk_size'],
+            repeat=options['repeat'],
+            seed=not options['no_seed'],
+        )
+        if not results:
+            self.stdout.write(self.style.WARNING("No PatientProfile rows to benchmark."))
+            return results
+
+        per_field = results['per_field']
+        batched = results['batched']
+        self.stdout.write(f"Rows: {results['rows']} (6 encrypted values in 4 columns per row)")
+        self.stdout.write(
+            f"  per-attribute (lazy):    {per_field['seconds']:.3f}s  "
+            f"{per_field['rows_per_second']:,.0f} rows/s"
+        )
+        self.stdout.write(
+            f"  decrypt_in_batches:      {batched['seconds']:.3f}s  "
+            f"{batched['rows_per_second']:,.0f} rows/s "
+            f"(chunk={batched['chunk_size']})"
+        )
+        speedup = batched['rows_per_second'] / per_field['rows_per_second']
+        self.stdout.write(self.style.SUCCESS(f"  speedup: {speedup:.2f}x"))
+        return results
@@ -0,0 +1,95 @@
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from clinic import envelope
+from clinic.data_keys import key_for_owner
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE, discover_encrypted_columns, iter_raw_chunks
+from clinic.encrypted_fields import as_ciphertext
+from clinic.keyring import get_key_ring
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt values of fields declared with a data_key that are still under the master key '
+        'under their patient\'s data key, so they can be crypto-shredded and no longer need '
+        'rewriting when the master key rotates'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models',
+            nargs='*',
+            default=None,
+            help='Restrict to these app labels or app_label.Model names'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows per chunk (one transaction per chunk)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the values that would be re-encrypted without changing anything'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        columns = [
+            (model, [field for field in fields if field.data_key])
+            for model, fields in discover_encrypted_columns(options['models'])
+        ]
+        columns = [(model, fields) for model, fields in columns if fields]
+        if not columns:
+            raise CommandError("No fields with a data key found")
+        if dry_run:
+            self.stdout.write(self.style.WARNING("DRY RUN MODE - No changes will be made"))
+
+        ring = get_key_ring()
+        total_updated = total_errors = 0
+        for model, fields in columns:
+            self.stdout.write(f"\nProcessing {model._meta.label}: {', '.join(f.name for f in fields)}")
+            updated = skipped = errors = 0
+            for field in fields:
+                owner = model._meta.get_field(field.data_key)
+                for rows in iter_raw_chunks(model, [owner, field], chunk_size=chunk_size):
+                    with transaction.atomic():
+                        for pk, owner_id, token in rows:
+                            if not token or owner_id is None or envelope.data_key_id(token) is not None:
+                                skipped += 1
+                                continue
+                            try:
+                                plaintext = ring.decrypt(token)
+                            except InvalidToken:
+                                errors += 1
+                                self.stdout.write(self.style.ERROR(
+                                    f"  Failed to decrypt {field.name} for {model._meta.label} {pk}"
+                                ))
+                                continue
+                            if dry_run:
+                                updated += 1
+                                continue
+                            new_token = ring.reencrypt(token, plaintext, key_for_owner(owner_id))
+                            # Matching on the stored token keeps a concurrent edit.
+                            updated += model._base_manager.filter(
+                                pk=pk, **{field.attname: as_ciphertext(token)}
+                            ).update(**{field.attname: as_ciphertext(new_token)})
+            self.stdout.write(f"  Re-encrypted: {updated}")
+            self.stdout.write(f"  Unchanged:    {skipped} (empty or already under a data key)")
+            if errors:
+                self.stdout.write(self.style.ERROR(f"  Errors:       {errors}"))
+            total_updated += updated
+            total_errors += errors
+
+        self.stdout.write("\n" + "-" * 50)
+        self.stdout.write(f"Total values re-encrypted: {total_updated}")
+        if total_errors:
+            self.stdout.write(self.style.WARNING(f"Total errors: {total_errors}"))
+        elif not dry_run:
+            self.stdout.write(self.style.SUCCESS("All values with a data key are now encrypted under it."))
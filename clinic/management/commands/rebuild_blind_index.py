@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from clinic import blind_index
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the searchable blind index of encrypted fields from the stored values. '
+        'Run after enabling the index, changing FIELD_BLIND_INDEX_KEY or bulk-loading rows'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models',
+            nargs='*',
+            default=None,
+            help='Restrict to these app labels or app_label.Model names'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows per chunk (one transaction per chunk)'
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        wanted = {label.lower() for label in options['models']} if options['models'] else None
+        models = [
+            model for model in blind_index.indexed_models()
+            if wanted is None or model._meta.app_label in wanted or model._meta.label_lower in wanted
+        ]
+        if not models:
+            raise CommandError("No blind-indexed models found")
+
+        total_failures = 0
+        for model in models:
+            fields = ', '.join(blind_index.indexed_fields(model))
+            self.stdout.write(f"Rebuilding {model._meta.label} ({fields})...")
+            rows, failures = blind_index.rebuild(model, chunk_size=options['chunk_size'])
+            total_failures += failures
+            self.stdout.write(f"  {rows} rows indexed")
+            if failures:
+                self.stdout.write(self.style.ERROR(f"  {failures} values could not be decrypted"))
+
+        if total_failures:
+            self.stdout.write(self.style.WARNING("Blind index rebuilt with errors."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Blind index rebuilt successfully."))
@@ -1,23 +1,159 @@
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
-from cryptography.fernet import Fernet, InvalidToken
+from django.db import connections, router, transaction
+from cryptography.fernet import InvalidToken
+from django.core.exceptions import ImproperlyConfigured
+
+from audit.archive import archive_dir, list_segments, rewrap_segments
+from audit.models import AuditLog
+from clinic import blind_index, envelope
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE, discover_encrypted_columns, iter_raw_chunks
+from clinic.encrypted_fields import raw_ciphertexts
+from clinic.models import DataKey
+from clinic.keyring import (
+    DEFAULT_ENGINE, ENGINE_CHOICES, MAX_KEY_ID, KeyRing, configured_engine, get_key_ring, parse_key_entries,
+)
+
+_worker_keys = {}
+
+
+def _init_worker(old_keys, new_key, engine=DEFAULT_ENGINE):
+    """``old_keys`` and ``new_key`` are ``(key_id, key)`` pairs."""
+    _worker_keys['ring'] = KeyRing(
+        [new_key] + [entry for entry in old_keys if entry[1] != new_key[1]], engine=engine
+    )
+
+
+def rotate_rows(rows):
+    """
+    Re-encrypt one chunk of ``(pk, token, ...)`` rows under the new key and
+    engine. Runs in a worker process. Returns ``(updates, errors, current)``
+    where ``updates`` maps pk to the new token per column (None where nothing
+    changes), ``errors`` lists ``(pk, column index)`` pairs no key could decrypt
+    and ``current`` counts values that were already on the new key and engine.
+    Text tokens stay text and binary envelopes stay binary. Values under a
+    patient's data key are left alone: rewrapping the key table covers them.
+    """
+    ring = _worker_keys['ring']
+    updates = {}
+    errors = []
+    current = 0
+    for pk, *tokens in rows:
+        new_tokens = []
+        changed = False
+        for index, token in enumerate(tokens):
+            if not token:
+                new_tokens.append(None)
+                continue
+            if envelope.data_key_id(token) is not None:
+                current += 1
+                new_tokens.append(None)
+                continue
+            try:
+                plaintext, key_id = ring.decrypt_with_key_id(token)
+            except InvalidToken:
+                errors.append((pk, index))
+                new_tokens.append(None)
+                continue
+            if ring.is_current(token, key_id):
+                current += 1
+                new_tokens.append(None)
+                continue
+            new_tokens.append(ring.reencrypt(token, plaintext))
+            changed = True
+        if changed:
+            updates[pk] = new_tokens
+    return updates, errors, current
+
+
+def _plain(token):
+    if isinstance(token, str):
+        return str(token)
+    if isinstance(token, (bytes, bytearray, memoryview)):
+        return bytes(token)
+    return token
+
+
+class _InlineExecutor:
+    def submit(self, fn, *args):
+        class _Done:
+            def __init__(self, value):
+                self._value = value
+
+            def result(self):
+                return self._value
+        return _Done(fn(*args))
+
+    def shutdown(self):
+        pass
 
 
 class Command(BaseCommand):
-    help = 'Rotate encryption keys for all encrypted fields in the database'
+    help = (
+        'Re-encrypt every encrypted column under a new key. Streams primary-key '
+        'ranges, re-encrypts them in a process pool and commits one chunk at a time; '
+        'an interrupted run resumes from its checkpoint file. Archived audit segments '
+        'are re-sealed too when the audit log is rotated'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--old-key',
-            type=str,
-            required=True,
-            help='The current encryption key (base64-encoded Fernet key)'
+            action='append',
+            default=None,
+            help='A key existing data may be encrypted with, as "<key id>:<key>" or a bare key (repeatable). '
+                 'Defaults to every key on the configured key ring'
         )
         parser.add_argument(
             '--new-key',
             type=str,
-            required=True,
-            help='The new encryption key to rotate to (base64-encoded Fernet key)'
+            default=None,
+            help='The key to rotate to, as "<key id>:<key>" or a bare key. Defaults to the newest key on the '
+                 'configured key ring'
+        )
+        parser.add_argument(
+            '--engine',
+            choices=ENGINE_CHOICES,
+            default=None,
+            help='Engine to re-encrypt with (default: FIELD_ENCRYPTION_ENGINE). Values already on the new key '
+                 'but another engine are re-encrypted too'
+        )
+        parser.add_argument(
+            '--models',
+            nargs='*',
+            default=None,
+            help='Restrict to these app labels or app_label.Model names'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows per chunk (one transaction per chunk)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Worker processes used for re-encryption (1 runs inline)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            type=str,
+            default=None,
+            help='File used to record progress so an interrupted run can resume '
+                 '(default: rotate_keys.checkpoint.json in BASE_DIR, whatever the working directory)'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and start from the beginning'
         )
         parser.add_argument(
             '--dry-run',
@@ -26,148 +162,262 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        old_key = options['old_key']
+        ring = get_key_ring()
+        old_keys = options['old_key']
         new_key = options['new_key']
         dry_run = options['dry_run']
+        chunk_size = options['chunk_size']
+        workers = max(1, options['workers'])
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
 
+        engine = options['engine'] or configured_engine()
         try:
-            old_fernet = Fernet(old_key.encode() if isinstance(old_key, str) else old_key)
-        except Exception as e:
-            raise CommandError(f"Invalid old key: {e}")
+            old_keys, new_key = self._resolve_keys(ring, old_keys, new_key)
+            KeyRing([new_key] + old_keys, engine=engine)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
 
-        try:
-            new_fernet = Fernet(new_key.encode() if isinstance(new_key, str) else new_key)
-        except Exception as e:
-            raise CommandError(f"Invalid new key: {e}")
+        fingerprint = hashlib.sha256(new_key[1] + engine.encode()).hexdigest()[:16]
+        checkpoint_path = options['checkpoint'] or os.path.join(settings.BASE_DIR, 'rotate_keys.checkpoint.json')
+        checkpoint = self._load_checkpoint(checkpoint_path, fingerprint, options['restart'] or dry_run)
+
+        columns = discover_encrypted_columns(options['models'])
+        if not columns:
+            raise CommandError("No encrypted columns found")
+        # Rewrap the data keys first; blind index rebuilds unwrap them with the new key.
+        columns.sort(key=lambda item: item[0] is not DataKey)
 
         if dry_run:
             self.stdout.write(self.style.WARNING("DRY RUN MODE - No changes will be made"))
 
-        from accounts.models import PatientProfile
-        from clinic.models import Appointment, MedicalNote
+        self.stdout.write("Starting key rotation...")
+        self.stdout.write(f"  New key id: {new_key[0]}, engine: {engine}, fingerprint: {fingerprint}")
+        self.stdout.write(f"  Chunk size: {chunk_size}, workers: {workers}")
+        for model, fields in columns:
+            self.stdout.write(f"  {model._meta.label}: {', '.join(f.name for f in fields)}")
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(old_keys, new_key, engine)
+            )
+        else:
+            _init_worker(old_keys, new_key, engine)
+            executor = _InlineExecutor()
 
-        stats = {
-            'PatientProfile': {'processed': 0, 'updated': 0, 'errors': 0},
-            'Appointment': {'processed': 0, 'updated': 0, 'errors': 0},
-            'MedicalNote': {'processed': 0, 'updated': 0, 'errors': 0},
-        }
+        stats = {}
+        try:
+            for model, fields in columns:
+                label = model._meta.label_lower
+                entry = checkpoint['models'].setdefault(
+                    label,
+                    {'last_pk': None, 'done': False, 'processed': 0, 'updated': 0, 'current': 0, 'errors': 0},
+                )
+                stats[model._meta.label] = entry
+                if entry['done']:
+                    self.stdout.write(f"\n{model._meta.label}: already rotated (checkpoint)")
+                    continue
+                self._rotate_model(
+                    model, fields, entry, executor, workers, chunk_size, dry_run, new_key, checkpoint, checkpoint_path
+                )
+            if any(model is AuditLog for model, _ in columns):
+                stats['audit archive segments'] = self._rewrap_archive(
+                    KeyRing([new_key] + old_keys, engine=engine), dry_run, checkpoint, checkpoint_path
+                )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("\nInterrupted. Re-run the same command to resume from the checkpoint."))
+            raise CommandError("Key rotation interrupted")
+        finally:
+            executor.shutdown()
 
-        self.stdout.write("Starting key rotation...")
-        self.stdout.write(f"  Old key: {old_key[:8]}...")
-        self.stdout.write(f"  New key: {new_key[:8]}...")
+        self._summary(stats, dry_run, new_key, engine, ring)
+        if not dry_run and os.path.exists(checkpoint_path) and all(e['done'] for e in stats.values()):
+            os.remove(checkpoint_path)
+
+    @staticmethod
+    def _resolve_keys(ring, old_keys, new_key):
+        """
+        Turn the command line keys into ``(key_id, key)`` pairs. A bare new key
+        keeps its id if it is already on the ring and otherwise gets the next
+        free id, which is what binary envelopes will record.
+        """
+        ring_keys = list(ring.key_material)
+        old = parse_key_entries(old_keys) if old_keys else ring_keys
+        if new_key is None:
+            new = ring_keys[0]
+        else:
+            key_id, sep, key = new_key.partition(':')
+            if sep:
+                try:
+                    new = (int(key_id), key.strip().encode())
+                except ValueError:
+                    raise ImproperlyConfigured(f"Invalid new key id {key_id!r}")
+            else:
+                key = new_key.strip().encode()
+                ids = {material: entry_id for entry_id, material in ring_keys}
+                used = [entry_id for entry_id, _ in ring_keys + old]
+                new = (ids.get(key, max(used) + 1), key)
+        old = [entry for entry in old if entry[1] != new[1]]
+        if not 0 <= new[0] <= MAX_KEY_ID:
+            raise ImproperlyConfigured(f"Encryption key id {new[0]} is outside 0-{MAX_KEY_ID}")
+        if new[0] in {entry_id for entry_id, _ in old}:
+            raise ImproperlyConfigured(
+                f"Key id {new[0]} is used by an old key and the new key; give the keys explicit ids"
+            )
+        return old, new
+
+    def _load_checkpoint(self, path, fingerprint, ignore_existing):
+        if not ignore_existing and os.path.exists(path):
+            with open(path) as fh:
+                checkpoint = json.load(fh)
+            if checkpoint.get('fingerprint') != fingerprint:
+                raise CommandError(
+                    f"Checkpoint {path} belongs to a rotation to a different key. "
+                    "Use --restart to discard it."
+                )
+            self.stdout.write(self.style.WARNING(f"Resuming from checkpoint {path}"))
+            return checkpoint
+        return {'fingerprint': fingerprint, 'models': {}}
+
+    @staticmethod
+    def _save_checkpoint(path, checkpoint):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as fh:
+            json.dump(checkpoint, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
 
+    def _rotate_model(self, model, fields, entry, executor, workers, chunk_size, dry_run, new_key, checkpoint, checkpoint_path):
+        self.stdout.write(f"\nProcessing {model._meta.label} records...")
+        started = time.monotonic()
+        processed_before = entry['processed']
+        in_flight = deque()
+
+        def complete_oldest():
+            rows, future = in_flight.popleft()
+            updates, errors, current = future.result()
+            for pk, index in errors:
+                self.stdout.write(self.style.ERROR(
+                    f"  Failed to decrypt {fields[index].name} for {model._meta.label} {pk}"
+                ))
+            written = 0 if dry_run else self._apply_updates(model, fields, rows, updates)
+            entry['processed'] += len(rows)
+            entry['updated'] += len(updates) if dry_run else written
+            entry['current'] += current
+            entry['errors'] += len(errors)
+            entry['last_pk'] = rows[-1][0]
+            if not dry_run:
+                self._save_checkpoint(checkpoint_path, checkpoint)
+
+        for rows in iter_raw_chunks(model, fields, chunk_size=chunk_size, start_after=entry['last_pk']):
+            plain_rows = [(pk, *(_plain(t) for t in tokens)) for pk, *tokens in rows]
+            in_flight.append((rows, executor.submit(rotate_rows, plain_rows)))
+            if len(in_flight) >= workers * 2:
+                complete_oldest()
+        while in_flight:
+            complete_oldest()
+
+        if not dry_run and blind_index.indexed_fields(model) and blind_index.uses_derived_key():
+            # The index key is derived from the encryption key, so it changes too.
+            rows, failures = blind_index.rebuild(
+                model, chunk_size=chunk_size, decryptor=KeyRing([new_key]),
+                index_key=blind_index.derive_index_key(new_key[1]),
+            )
+            self.stdout.write(f"  Rebuilt blind index for {rows} rows")
+            entry['errors'] += failures
+
+        entry['done'] = True
+        if not dry_run:
+            self._save_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.monotonic() - started
+        processed = entry['processed'] - processed_before
+        rate = processed / elapsed if elapsed > 0 else 0
+        entry['rows_per_second'] = round(rate, 1)
+        self.stdout.write(f"  {processed} rows in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+    def _rewrap_archive(self, ring, dry_run, checkpoint, checkpoint_path):
+        """
+        Re-seal the archived audit segments, which are files rather than
+        rows: once the old key leaves the ring they would be unreadable.
+        """
+        entry = checkpoint.setdefault(
+            'archive', {'processed': 0, 'updated': 0, 'current': 0, 'errors': 0, 'done': False}
+        )
+        directory = archive_dir()
+        if entry['done']:
+            self.stdout.write("\nAudit archive: already rewrapped (checkpoint)")
+            return entry
+        self.stdout.write(f"\nRewrapping audit archive segments in {directory}...")
+        segments = len(list_segments(directory))
+        entry['processed'] = segments
+        if dry_run:
+            entry['updated'] = segments
+            return entry
         try:
-            with transaction.atomic():
-                self.stdout.write("\nProcessing PatientProfile records...")
-                for profile in PatientProfile.objects.all():
-                    stats['PatientProfile']['processed'] += 1
-                    updated = False
-
-                    if profile.phone and profile.phone not in ('', '[DATA_UNAVAILABLE]'):
-                        try:
-                            raw_phone = PatientProfile.objects.filter(pk=profile.pk).values_list('phone', flat=True).first()
-                            if raw_phone:
-                                decrypted = old_fernet.decrypt(raw_phone.encode()).decode('utf-8')
-                                new_encrypted = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                                profile.phone = decrypted  
-                                updated = True
-                        except InvalidToken:
-                            self.stdout.write(self.style.ERROR(f"  Failed to decrypt phone for PatientProfile {profile.pk}"))
-                            stats['PatientProfile']['errors'] += 1
-
-                    if profile.address and profile.address not in ('', '[DATA_UNAVAILABLE]'):
-                        try:
-                            raw_address = PatientProfile.objects.filter(pk=profile.pk).values_list('address', flat=True).first()
-                            if raw_address:
-                                decrypted = old_fernet.decrypt(raw_address.encode()).decode('utf-8')
-                                new_encrypted = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                                profile.address = decrypted
-                                updated = True
-                        except InvalidToken:
-                            self.stdout.write(self.style.ERROR(f"  Failed to decrypt address for PatientProfile {profile.pk}"))
-                            stats['PatientProfile']['errors'] += 1
-
-                    if updated and not dry_run:
-                        from django.db import connection
-                        cursor = connection.cursor()
-                        
-                        updates = {}
-                        if profile.phone and profile.phone not in ('', '[DATA_UNAVAILABLE]'):
-                            try:
-                                raw_phone = PatientProfile.objects.filter(pk=profile.pk).values_list('phone', flat=True).first()
-                                if raw_phone:
-                                    decrypted = old_fernet.decrypt(raw_phone.encode()).decode('utf-8')
-                                    updates['phone'] = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                            except InvalidToken:
-                                pass
-                        
-                        if profile.address and profile.address not in ('', '[DATA_UNAVAILABLE]'):
-                            try:
-                                raw_address = PatientProfile.objects.filter(pk=profile.pk).values_list('address', flat=True).first()
-                                if raw_address:
-                                    decrypted = old_fernet.decrypt(raw_address.encode()).decode('utf-8')
-                                    updates['address'] = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                            except InvalidToken:
-                                pass
-                        
-                        if updates:
-                            PatientProfile.objects.filter(pk=profile.pk).update(**updates)
-                            stats['PatientProfile']['updated'] += 1
-
-                self.stdout.write("\nProcessing Appointment records...")
-                for appointment in Appointment.objects.all():
-                    stats['Appointment']['processed'] += 1
-                    
-                    if appointment.diagnosis and appointment.diagnosis not in ('', '[DATA_UNAVAILABLE]'):
-                        try:
-                            raw_diagnosis = Appointment.objects.filter(pk=appointment.pk).values_list('diagnosis', flat=True).first()
-                            if raw_diagnosis:
-                                decrypted = old_fernet.decrypt(raw_diagnosis.encode()).decode('utf-8')
-                                if not dry_run:
-                                    new_encrypted = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                                    Appointment.objects.filter(pk=appointment.pk).update(diagnosis=new_encrypted)
-                                stats['Appointment']['updated'] += 1
-                        except InvalidToken:
-                            self.stdout.write(self.style.ERROR(f"  Failed to decrypt diagnosis for Appointment {appointment.pk}"))
-                            stats['Appointment']['errors'] += 1
-
-                self.stdout.write("\nProcessing MedicalNote records...")
-                for note in MedicalNote.objects.all():
-                    stats['MedicalNote']['processed'] += 1
-                    
-                    if note.content and note.content not in ('', '[DATA_UNAVAILABLE]'):
-                        try:
-                            raw_content = MedicalNote.objects.filter(pk=note.pk).values_list('content', flat=True).first()
-                            if raw_content:
-                                decrypted = old_fernet.decrypt(raw_content.encode()).decode('utf-8')
-                                if not dry_run:
-                                    new_encrypted = new_fernet.encrypt(decrypted.encode()).decode('utf-8')
-                                    MedicalNote.objects.filter(pk=note.pk).update(content=new_encrypted)
-                                stats['MedicalNote']['updated'] += 1
-                        except InvalidToken:
-                            self.stdout.write(self.style.ERROR(f"  Failed to decrypt content for MedicalNote {note.pk}"))
-                            stats['MedicalNote']['errors'] += 1
-
-                if dry_run:
-                    self.stdout.write(self.style.WARNING("\nDRY RUN - Rolling back all changes..."))
-                    raise Exception("Dry run rollback")
-
-        except Exception as e:
-            if "Dry run rollback" not in str(e):
-                self.stdout.write(self.style.ERROR(f"\nKey rotation failed: {e}"))
-                self.stdout.write(self.style.ERROR("All changes have been rolled back."))
-                raise CommandError(f"Key rotation failed: {e}")
+            entry['updated'] = rewrap_segments(directory, ring=ring)
+        except InvalidToken:
+            entry['errors'] += 1
+            self.stdout.write(self.style.ERROR("  A segment could not be decrypted with the old keys"))
+            return entry
+        entry['done'] = True
+        self._save_checkpoint(checkpoint_path, checkpoint)
+        return entry
+
+    def _apply_updates(self, model, fields, rows, updates):
+        """
+        Write one chunk in a single transaction. Rows whose tokens changed since
+        they were read (the application kept running) are skipped so a
+        concurrent edit is never overwritten with the value we read.
+        """
+        if not updates:
+            return 0
+        attnames = [field.attname for field in fields]
+        originals = {pk: tokens for pk, *tokens in rows if pk in updates}
+        db = router.db_for_write(model)
+        manager = model._base_manager.db_manager(db)
+        with transaction.atomic(using=db):
+            qs = manager.filter(pk__in=list(originals))
+            if connections[db].features.has_select_for_update:
+                qs = qs.select_for_update()
+            with raw_ciphertexts():
+                latest = {pk: list(tokens) for pk, *tokens in qs.values_list('pk', *attnames)}
+
+            params = []
+            for pk, old_tokens in originals.items():
+                if latest.get(pk) != list(old_tokens):
+                    continue
+                values = [
+                    new_token if new_token is not None else old_token
+                    for old_token, new_token in zip(old_tokens, updates[pk])
+                ]
+                params.append([_plain(v) for v in values] + [pk])
+            if params:
+                connection = connections[db]
+                quote = connection.ops.quote_name
+                assignments = ', '.join(f"{quote(field.column)} = %s" for field in fields)
+                sql = (
+                    f"UPDATE {quote(model._meta.db_table)} SET {assignments} "
+                    f"WHERE {quote(model._meta.pk.column)} = %s"
+                )
+                with connection.cursor() as cursor:
+                    cursor.executemany(sql, params)
+        return len(params)
 
+    def _summary(self, stats, dry_run, new_key, engine, ring):
         self.stdout.write("\n" + "=" * 50)
         self.stdout.write(self.style.SUCCESS("KEY ROTATION SUMMARY"))
         self.stdout.write("=" * 50)
-        
+
         total_updated = 0
         total_errors = 0
         for model_name, model_stats in stats.items():
             self.stdout.write(f"\n{model_name}:")
             self.stdout.write(f"  Processed: {model_stats['processed']}")
             self.stdout.write(f"  Updated:   {model_stats['updated']}")
+            self.stdout.write(f"  Current:   {model_stats['current']} values already on the new key")
+            if 'rows_per_second' in model_stats:
+                self.stdout.write(f"  Throughput: {model_stats['rows_per_second']:,.0f} rows/s")
             if model_stats['errors'] > 0:
                 self.stdout.write(self.style.ERROR(f"  Errors:    {model_stats['errors']}"))
             total_updated += model_stats['updated']
@@ -175,12 +425,28 @@ class Command(BaseCommand):
 
         self.stdout.write("\n" + "-" * 50)
         self.stdout.write(f"Total records updated: {total_updated}")
-        
+
         if total_errors > 0:
             self.stdout.write(self.style.WARNING(f"Total errors: {total_errors}"))
             self.stdout.write(self.style.WARNING("Some records could not be decrypted. Check if old key is correct."))
-        
+
         if not dry_run and total_errors == 0:
             self.stdout.write(self.style.SUCCESS("\nKey rotation completed successfully!"))
-            self.stdout.write(self.style.WARNING("\nIMPORTANT: Update your FIELD_ENCRYPTION_KEY environment variable to the new key:"))
-            self.stdout.write(f"  FIELD_ENCRYPTION_KEY={new_key}")
+            if new_key[1] not in [key for _, key in ring.key_material]:
+                self.stdout.write(self.style.WARNING(
+                    "\nIMPORTANT: The new key is not on the configured key ring. Add it as the "
+                    "first entry of FIELD_ENCRYPTION_KEYS before serving traffic."
+                ))
+            elif 'audit archive segments' not in stats and list_segments(archive_dir()):
+                self.stdout.write(self.style.WARNING(
+                    "\nThe audit log was not rotated, so archived segments are still under the old keys. "
+                    "Run archive_audit_log --rewrap before removing them from FIELD_ENCRYPTION_KEYS."
+                ))
+            else:
+                self.stdout.write(
+                    "Run verify_audit_chain --resign, then older keys can be removed from FIELD_ENCRYPTION_KEYS."
+                )
+            if engine != configured_engine():
+                self.stdout.write(self.style.WARNING(
+                    f"Set FIELD_ENCRYPTION_ENGINE={engine} so new values are written with the same engine."
+                ))
@@ -0,0 +1,260 @@
+import base64
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import InvalidToken
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+
+from clinic import envelope
+from clinic.data_keys import UnwrappedKey, get_data_key_cache
+from clinic.encrypted_columns import DEFAULT_CHUNK_SIZE, discover_encrypted_columns, iter_raw_chunks
+from clinic.encrypted_fields import raw_ciphertexts
+from clinic.keyring import KeyRing, get_key_ring, parse_key_entries
+from clinic.management.commands.rotate_keys import _InlineExecutor, _plain
+from clinic.models import DataKey
+
+INVALID = 'invalid'
+CORRUPT = 'corrupt'
+NO_DATA_KEY = 'data key missing'
+BAD_DATA_KEY = 'data key unreadable'
+MAX_LISTED_RANGES = 1000
+
+_worker_state = {}
+
+
+def _init_worker(keys):
+    _worker_state['ring'] = KeyRing(keys)
+
+
+def verify_rows(rows, data_keys):
+    """
+    Decrypt every token of one chunk of ``(pk, token, ...)`` rows. Runs in a
+    worker process. ``data_keys`` maps the data key ids used in the chunk to
+    their raw key, or to the reason it is unusable. Returns ``(checked,
+    failures)`` with ``failures`` a list of ``(pk, column index, reason)``.
+    """
+    ring = _worker_state['ring']
+    cache = get_data_key_cache()
+    for key_id, key in data_keys.items():
+        if isinstance(key, bytes):
+            cache.put(UnwrappedKey(key_id, None, key))
+    checked = 0
+    failures = []
+    for pk, *tokens in rows:
+        for index, token in enumerate(tokens):
+            if not token:
+                continue
+            checked += 1
+            try:
+                key_id = envelope.data_key_id(token)
+                if key_id is not None and not isinstance(data_keys.get(key_id), bytes):
+                    failures.append((pk, index, data_keys.get(key_id, NO_DATA_KEY)))
+                    continue
+                ring.decrypt(token).decode('utf-8')
+            except InvalidToken:
+                failures.append((pk, index, INVALID))
+            except Exception:
+                failures.append((pk, index, CORRUPT))
+    return checked, failures
+
+
+class PkRanges:
+    """Failing primary keys of one column as ``[first, last]`` runs, capped."""
+
+    def __init__(self, limit=MAX_LISTED_RANGES):
+        self.limit = limit
+        self.ranges = []
+        self.count = 0
+        self.truncated = False
+
+    def add(self, pk):
+        self.count += 1
+        if self.ranges and isinstance(pk, int) and self.ranges[-1][1] == pk - 1:
+            self.ranges[-1][1] = pk
+        elif len(self.ranges) < self.limit:
+            self.ranges.append([pk, pk])
+        else:
+            self.truncated = True
+
+    def __str__(self):
+        text = ', '.join(str(a) if a == b else f"{a}-{b}" for a, b in self.ranges)
+        return text + (', ...' if self.truncated else '')
+
+
+class Command(BaseCommand):
+    help = (
+        'Check that every encrypted value decrypts. Streams raw ciphertexts in primary-key chunks, '
+        'decrypts them in a process pool without building model instances and reports the failing '
+        'primary keys per column. Exits non-zero when anything fails'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models',
+            nargs='*',
+            default=None,
+            help='Restrict to these app labels or app_label.Model names'
+        )
+        parser.add_argument(
+            '--key',
+            action='append',
+            default=None,
+            help='Verify against this key ring instead of the configured one, as "<key id>:<key>" entries '
+                 '(repeatable, newest first), e.g. before deploying a key change'
+        )
+        parser.add_argument(
+            '--database',
+            default=None,
+            help='Database alias to scan, e.g. a copy of production; only the models it holds are checked '
+                 '(default: each model in the database the routers assign it)'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help='Rows per chunk'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Worker processes used for decryption (1 runs inline)'
+        )
+        parser.add_argument(
+            '--report',
+            type=str,
+            default=None,
+            help='Also write the failing primary keys per column as JSON to this file'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        workers = max(1, options['workers'])
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+        try:
+            ring = KeyRing(parse_key_entries(options['key'])) if options['key'] else get_key_ring()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        columns = discover_encrypted_columns(options['models'])
+        if not columns:
+            raise CommandError("No encrypted columns found")
+
+        self.database = options['database']
+        self.ring = ring
+        self.data_keys = {}
+        where = f"database '{self.database}'" if self.database else "the routed databases"
+        self.stdout.write(f"Verifying encrypted columns on {where}...")
+        self.stdout.write(f"  Key ids: {', '.join(map(str, ring.key_ids))}")
+        self.stdout.write(f"  Chunk size: {chunk_size}, workers: {workers}")
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(ring.key_material,)
+            )
+        else:
+            _init_worker(ring.key_material)
+            executor = _InlineExecutor()
+
+        report = {}
+        try:
+            for model, fields in columns:
+                if self.database and not router.allow_migrate_model(self.database, model):
+                    continue
+                report[model._meta.label] = self._verify_model(model, fields, executor, workers, chunk_size)
+        except KeyboardInterrupt:
+            raise CommandError("Verification interrupted")
+        finally:
+            executor.shutdown()
+
+        total_failed = sum(
+            column['failed'] for model_report in report.values() for column in model_report['columns'].values()
+        )
+        if options['report']:
+            with open(options['report'], 'w') as fh:
+                json.dump({'database': self.database, 'key_ids': ring.key_ids, 'models': report}, fh, indent=2)
+            self.stdout.write(f"\nReport written to {options['report']}")
+
+        self.stdout.write("\n" + "-" * 50)
+        if total_failed:
+            raise CommandError(f"{total_failed} encrypted values failed to decrypt")
+        self.stdout.write(self.style.SUCCESS("Every encrypted value decrypts."))
+
+    def _verify_model(self, model, fields, executor, workers, chunk_size):
+        self.stdout.write(f"\n{model._meta.label}: {', '.join(f.name for f in fields)}")
+        started = time.monotonic()
+        rows_seen = checked = 0
+        failing = [PkRanges() for _ in fields]
+        reasons = [{} for _ in fields]
+        in_flight = deque()
+
+        def complete_oldest():
+            nonlocal checked
+            chunk_checked, failures = in_flight.popleft().result()
+            checked += chunk_checked
+            for pk, index, reason in failures:
+                failing[index].add(pk)
+                reasons[index][reason] = reasons[index].get(reason, 0) + 1
+
+        for rows in iter_raw_chunks(model, fields, chunk_size=chunk_size, using=self.database):
+            rows = [(pk, *(_plain(t) for t in tokens)) for pk, *tokens in rows]
+            rows_seen += len(rows)
+            in_flight.append(executor.submit(verify_rows, rows, self._data_keys_for(rows)))
+            if len(in_flight) >= workers * 2:
+                complete_oldest()
+        while in_flight:
+            complete_oldest()
+
+        elapsed = time.monotonic() - started
+        rate = rows_seen / elapsed if elapsed > 0 else 0
+        self.stdout.write(f"  {rows_seen} rows, {checked} values in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+        columns = {}
+        for field, pks, field_reasons in zip(fields, failing, reasons):
+            columns[field.name] = {
+                'failed': pks.count,
+                'reasons': field_reasons,
+                'pk_ranges': pks.ranges,
+                'truncated': pks.truncated,
+            }
+            if pks.count:
+                summary = ', '.join(f"{count} {reason}" for reason, count in sorted(field_reasons.items()))
+                self.stdout.write(self.style.ERROR(f"  {field.name}: {pks.count} failed ({summary})"))
+                self.stdout.write(f"    pks: {pks}")
+        return {'rows': rows_seen, 'values': checked, 'columns': columns}
+
+    def _data_keys_for(self, rows):
+        """
+        Unwrap, once per run, the data keys the chunk's values are encrypted
+        under, so workers never touch the database.
+        """
+        wanted = set()
+        for _, *tokens in rows:
+            for token in tokens:
+                if token:
+                    try:
+                        key_id = envelope.data_key_id(token)
+                    except InvalidToken:
+                        continue
+                    if key_id is not None:
+                        wanted.add(key_id)
+        missing = wanted - self.data_keys.keys()
+        if missing:
+            with raw_ciphertexts():
+                wrapped = dict(
+                    DataKey.objects.using(self.database).filter(pk__in=missing).values_list('pk', 'wrapped_key')
+                )
+            for key_id in missing:
+                if key_id not in wrapped:
+                    self.data_keys[key_id] = NO_DATA_KEY
+                    continue
+                try:
+                    self.data_keys[key_id] = base64.urlsafe_b64decode(self.ring.decrypt(wrapped[key_id]))
+                except (InvalidToken, ValueError):
+                    self.data_keys[key_id] = BAD_DATA_KEY
+        return {key_id: self.data_keys[key_id] for key_id in wanted}
@@ -0,0 +1,30 @@
+import logging
+
+from django.conf import settings
+
+from .encrypted_fields import decryption_cache
+
+logger = logging.getLogger(__name__)
+
+
+class DecryptionCacheMiddleware:
+    """
+    Give each request its own bounded decryption cache and drop it, together
+    with every plaintext it holds, as soon as the response has been built.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with decryption_cache() as cache:
+            response = self.get_response(request)
+
+        if cache is not None and (cache.hits or cache.misses):
+            logger.debug(
+                "Decryption cache for %s: %d hits, %d misses",
+                request.path, cache.hits, cache.misses,
+            )
+            if settings.DEBUG:
+                response['X-Decryption-Cache'] = f"hits={cache.hits}; misses={cache.misses}"
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.15 on 2026-10-16 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0002_alter_appointment_diagnosis_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlindIndexEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.BigIntegerField()),
+                ('field', models.CharField(max_length=100)),
+                ('token', models.CharField(max_length=32)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'field', 'token'], name='blindindex_lookup_idx'), models.Index(fields=['model', 'object_id'], name='blindindex_object_idx')],
+            },
+        ),
+    ]
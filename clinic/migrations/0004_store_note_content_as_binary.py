@@ -0,0 +1,43 @@
+import clinic.encrypted_fields
+from clinic.encrypted_columns import copy_encrypted_column
+from django.db import migrations
+
+
+def content_to_binary(apps, schema_editor):
+    copy_encrypted_column(apps.get_model('clinic', 'MedicalNote'), 'content', 'content_binary')
+
+
+def content_to_text(apps, schema_editor):
+    copy_encrypted_column(apps.get_model('clinic', 'MedicalNote'), 'content_binary', 'content')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0003_blindindexentry'),
+    ]
+
+    operations = [
+        # Lets the reverse migration re-add the text column before refilling it.
+        migrations.AlterField(
+            model_name='medicalnote',
+            name='content',
+            field=clinic.encrypted_fields.EncryptedTextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='medicalnote',
+            name='content_binary',
+            field=clinic.encrypted_fields.EncryptedBinaryTextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.RunPython(content_to_binary, content_to_text),
+        migrations.RemoveField(
+            model_name='medicalnote',
+            name='content',
+        ),
+        migrations.RenameField(
+            model_name='medicalnote',
+            old_name='content_binary',
+            new_name='content',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.15 on 2026-10-16 22:59
+
+import clinic.encrypted_fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0004_store_note_content_as_binary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appointment',
+            name='diagnosis',
+            field=clinic.encrypted_fields.EncryptedTextField(blank=True, compress='zlib', help_text="Doctor's diagnosis after completion."),
+        ),
+        migrations.AlterField(
+            model_name='medicalnote',
+            name='content',
+            field=clinic.encrypted_fields.EncryptedBinaryTextField(compress='zlib'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:03
+
+import clinic.encrypted_fields
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0005_compress_large_encrypted_text'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appointment',
+            name='diagnosis',
+            field=clinic.encrypted_fields.EncryptedTextField(blank=True, compress='zlib', data_key='patient_id', help_text="Doctor's diagnosis after completion."),
+        ),
+        migrations.AlterField(
+            model_name='medicalnote',
+            name='content',
+            field=clinic.encrypted_fields.EncryptedBinaryTextField(compress='zlib', data_key='patient_id'),
+        ),
+        migrations.CreateModel(
+            name='DataKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wrapped_key', clinic.encrypted_fields.EncryptedBinaryTextField(editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='data_key', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
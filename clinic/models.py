@@ -1,8 +1,8 @@
 from django.db import models
 from django.conf import settings
-from .encrypted_fields import EncryptedTextField
+from .encrypted_fields import ChangeTrackingMixin, EncryptedBinaryTextField, EncryptedManager, EncryptedTextField
 
-class Appointment(models.Model):
+class Appointment(ChangeTrackingMixin, models.Model):
     class Status(models.TextChoices):
         REQUESTED = 'REQUESTED', 'Requested'
         CONFIRMED = 'CONFIRMED', 'Confirmed'
@@ -20,11 +20,13 @@ class Appointment(models.Model):
     doctor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='appointments_as_doctor')
     date_time = models.DateTimeField()
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.REQUESTED)
-    diagnosis = EncryptedTextField(blank=True, help_text="Doctor's diagnosis after completion.")
+    diagnosis = EncryptedTextField(blank=True, compress='zlib', data_key='patient_id', help_text="Doctor's diagnosis after completion.")
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = EncryptedManager()
+
     def clean(self):
         from django.core.exceptions import ValidationError
         from django.utils import timezone
@@ -84,11 +86,48 @@ class Appointment(models.Model):
         return f"Appt: {self.patient} with {self.doctor} on {self.date_time}"
 
 
-class MedicalNote(models.Model):
+class MedicalNote(ChangeTrackingMixin, models.Model):
     patient = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='medical_notes')
     author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='authored_notes')
-    content = EncryptedTextField()
+    content = EncryptedBinaryTextField(compress='zlib', data_key='patient_id')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = EncryptedManager()
+
     def __str__(self):
         return f"Note for {self.patient} by {self.author}"
+
+
+class DataKey(models.Model):
+    """
+    A patient's data encryption key, wrapped by the master key ring (see
+    clinic.data_keys). Deleting the row crypto-shreds everything encrypted
+    under it.
+    """
+    owner = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='data_key')
+    wrapped_key = EncryptedBinaryTextField(editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Data key #{self.pk} for user #{self.owner_id}"
+
+
+class BlindIndexEntry(models.Model):
+    """
+    One keyed-HMAC token of a normalized prefix of an encrypted value, so the
+    value can be searched without decrypting the table (see clinic.blind_index).
+    """
+    model = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    field = models.CharField(max_length=100)
+    token = models.CharField(max_length=32)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'field', 'token'], name='blindindex_lookup_idx'),
+            models.Index(fields=['model', 'object_id'], name='blindindex_object_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model}.{self.field} #{self.object_id}"
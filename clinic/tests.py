@@ -0,0 +1,829 @@
+import os
+import tempfile
+import threading
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import CustomUser, PatientProfile
+from audit.actions import AuditAction
+from audit.archive import ArchiveQuery, archive_old_entries
+from audit.chain import GENESIS_HASH, iter_chain_chunks, verify_chain_rows
+from audit.identifiers import ERASED, reveal_logs
+from audit.models import AuditLog
+from clinic import blind_index, data_keys, decryption_alerts, envelope, keyring
+from clinic.data_keys import REVOCATION_KEY, DataKeyCache, UnwrappedKey, destroy_data_key, key_for_owner
+from clinic.encrypted_fields import (
+    DATA_UNAVAILABLE_PLACEHOLDER, EncryptedFieldMixin, as_ciphertext, decryption_cache, raw_ciphertexts,
+)
+from clinic.keyring import ENGINE_CHOICES, FERNET, LEGACY_KEY_ID, KeyRing, get_key_ring, parse_key_entries, reset_key_ring
+from clinic.models import Appointment, BlindIndexEntry, MedicalNote
+from clinic.management.commands import rotate_keys
+
+
+OLD_KEY = Fernet.generate_key()
+NEW_KEY = Fernet.generate_key()
+
+
+class BatchDecryptionTests(TestCase):
+    def setUp(self):
+        for index in range(3):
+            user = CustomUser.objects.create_user(
+                f'patient{index}', f'patient{index}@example.com', 'pw', role=CustomUser.Role.PATIENT,
+            )
+            PatientProfile.objects.create(user=user, phone=f'+1 555 010{index}', address=f'{index} Main Street')
+        self.profiles = PatientProfile.objects.select_related('user').order_by('pk')
+
+    @staticmethod
+    def values(profiles):
+        return [(profile.phone, profile.address, profile.user.email) for profile in profiles]
+
+    def test_batches_decrypt_to_the_same_values(self):
+        expected = self.values(self.profiles.all())
+        self.assertEqual(expected[0], ('+1 555 0100', '0 Main Street', 'patient0@example.com'))
+        for chunk_size in (1, 2, 500):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.values(self.profiles.decrypt_in_batches(chunk_size=chunk_size)), expected)
+
+    def test_data_keys_of_a_chunk_are_loaded_with_one_query(self):
+        cache = data_keys.get_data_key_cache()
+        cache.clear()
+        cache.sync(force=True)
+        # The rows, then every patient's data key at once.
+        with self.assertNumQueries(2):
+            profiles = list(self.profiles.decrypt_in_batches())
+        with self.assertNumQueries(0):
+            self.values(profiles)
+
+    def test_an_unreadable_value_does_not_spoil_the_chunk(self):
+        CustomUser.objects.filter(username='patient1').update(email=as_ciphertext('not a ciphertext'))
+        with mock.patch.object(EncryptedFieldMixin, '_report_decryption_failure') as report:
+            emails = [profile.user.email for profile in self.profiles.decrypt_in_batches()]
+        self.assertEqual(emails, ['patient0@example.com', DATA_UNAVAILABLE_PLACEHOLDER, 'patient2@example.com'])
+        self.assertEqual(report.call_count, 1)
+
+
+class DecryptionCacheTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('cached', 'cached@example.com', 'pw', first_name='Ada')
+        patcher = mock.patch.object(
+            KeyRing, 'decrypt_with_key_id', autospec=True, side_effect=KeyRing.decrypt_with_key_id,
+        )
+        self.decrypt = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def first_name(self):
+        return CustomUser.objects.get(pk=self.user.pk).first_name
+
+    def test_repeated_reads_in_a_request_decrypt_once(self):
+        with decryption_cache() as cache:
+            self.assertEqual([self.first_name() for _ in range(3)], ['Ada'] * 3)
+        self.assertEqual(self.decrypt.call_count, 1)
+        self.assertEqual((cache.misses, cache.hits), (1, 2))
+        # The plaintext does not outlive the block.
+        self.assertEqual(len(cache), 0)
+
+    def test_each_request_starts_empty(self):
+        with decryption_cache():
+            self.first_name()
+        with decryption_cache() as cache:
+            self.first_name()
+        self.assertEqual((cache.misses, cache.hits), (1, 0))
+        self.assertEqual(self.decrypt.call_count, 2)
+
+    def test_nothing_is_cached_outside_a_request(self):
+        self.first_name()
+        self.first_name()
+        self.assertEqual(self.decrypt.call_count, 2)
+
+    def test_other_threads_do_not_see_the_cache(self):
+        with raw_ciphertexts():
+            token = CustomUser.objects.values_list('first_name', flat=True).get(pk=self.user.pk)
+        field = CustomUser._meta.get_field('first_name')
+        with decryption_cache() as cache:
+            self.assertEqual(field.decrypt(token), 'Ada')
+            thread = threading.Thread(target=field.decrypt, args=(token,))
+            thread.start()
+            thread.join()
+        self.assertEqual((cache.misses, cache.hits), (1, 0))
+        self.assertEqual(self.decrypt.call_count, 2)
+
+    @override_settings(FIELD_DECRYPTION_CACHE_SIZE=0)
+    def test_size_zero_disables_the_cache(self):
+        with decryption_cache() as cache:
+            self.first_name()
+            self.first_name()
+        self.assertIsNone(cache)
+        self.assertEqual(self.decrypt.call_count, 2)
+
+
+class KeyRingTests(SimpleTestCase):
+    def test_key_entries_are_numbered_newest_first(self):
+        self.assertEqual(parse_key_entries(['b', 'a']), [(2, b'b'), (1, b'a')])
+        self.assertEqual(parse_key_entries(['7:b', '3:a']), [(7, b'b'), (3, b'a')])
+        with self.assertRaises(ImproperlyConfigured):
+            parse_key_entries(['1:b', '1:a'])
+
+    def test_old_fernet_tokens_fall_back_to_older_keys(self):
+        token = Fernet(OLD_KEY).encrypt(b'legacy').decode()
+        ring = KeyRing([(2, NEW_KEY), (1, OLD_KEY)])
+        self.assertEqual(ring.fernet.decrypt(token.encode()), b'legacy')
+        self.assertEqual(ring.decrypt_with_key_id(token), (b'legacy', 1))
+        self.assertFalse(ring.is_current(token, 1))
+        rotated = ring.rotate(token)
+        self.assertEqual(KeyRing([(2, NEW_KEY)]).decrypt_with_key_id(rotated), (b'legacy', 2))
+        with self.assertRaises(InvalidToken):
+            KeyRing([(2, NEW_KEY)]).decrypt(token)
+
+    def test_envelope_round_trip_with_compression(self):
+        ring = KeyRing([(2, NEW_KEY), (1, OLD_KEY)])
+        text = ring.encrypt_text(b'jane@example.com')
+        self.assertIsInstance(text, str)
+        self.assertEqual(ring.decrypt_with_key_id(text), (b'jane@example.com', 2))
+        sealed = ring.seal(b'note ' * 100, compression='zlib')
+        self.assertTrue(envelope.is_envelope(sealed))
+        self.assertLess(len(sealed), 500)
+        self.assertEqual(ring.decrypt(sealed), b'note ' * 100)
+
+    def test_envelope_opens_when_key_ids_were_assigned_differently(self):
+        sealed = KeyRing([(1, OLD_KEY)]).seal(b'value')
+        self.assertEqual(KeyRing([(5, NEW_KEY), (7, OLD_KEY)]).decrypt_with_key_id(sealed), (b'value', 7))
+
+    def test_round_trip_with_every_engine(self):
+        for engine in ENGINE_CHOICES:
+            ring = KeyRing([(2, NEW_KEY), (1, OLD_KEY)], engine=engine)
+            with self.subTest(engine=engine):
+                text = ring.encrypt_text(b'jane@example.com')
+                self.assertEqual(ring.decrypt_with_key_id(text), (b'jane@example.com', 2))
+                self.assertEqual(ring.decrypt(ring.seal(b'note ' * 100, compression='zlib')), b'note ' * 100)
+                self.assertTrue(ring.is_current(text, 2))
+                # Every engine can still read what the others wrote.
+                for other in ENGINE_CHOICES:
+                    self.assertEqual(KeyRing([(2, NEW_KEY)], engine=other).decrypt(text), b'jane@example.com')
+
+    def test_envelope_header_is_authenticated(self):
+        ring = KeyRing([(2, NEW_KEY)])
+        sealed = bytearray(ring.seal(b'secret'))
+        sealed[3] ^= envelope.FLAG_ZLIB
+        with self.assertRaises(InvalidToken):
+            ring.decrypt(bytes(sealed))
+
+    def test_fernet_engine_writes_fernet_tokens(self):
+        ring = KeyRing([(2, NEW_KEY)], engine=FERNET)
+        self.assertTrue(ring.encrypt_text(b'x').startswith('gAAAAA'))
+
+
+@override_settings(FIELD_ENCRYPTION_LAZY_REENCRYPT=True)
+class LazyReencryptionTests(TestCase):
+    def setUp(self):
+        self.addCleanup(reset_key_ring)
+        self.user = CustomUser.objects.create_user('lazy', 'lazy@example.com', 'pw', first_name='Old')
+        old_key = dict(get_key_ring().key_material)[LEGACY_KEY_ID].decode()
+        patcher = mock.patch.dict(
+            os.environ, {'FIELD_ENCRYPTION_KEYS': f'2:{NEW_KEY.decode()},{LEGACY_KEY_ID}:{old_key}'}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_key_ring()
+
+    def stored_key_id(self):
+        with raw_ciphertexts():
+            token = CustomUser.objects.values_list('first_name', flat=True).get(pk=self.user.pk)
+        return get_key_ring().decrypt_with_key_id(token)[1]
+
+    def test_reading_an_old_value_queues_it_for_reencryption(self):
+        with mock.patch.object(keyring._reencryption_worker, 'submit', return_value=True) as submit:
+            self.assertEqual(CustomUser.objects.get(pk=self.user.pk).first_name, 'Old')
+            self.assertEqual(CustomUser.objects.get(pk=self.user.pk).first_name, 'Old')
+        # Queued once, however often it is read before the worker runs.
+        self.assertEqual(submit.call_count, 1)
+        keyring._reencrypt_batch([submit.call_args.args[0]])
+        self.assertEqual(self.stored_key_id(), 2)
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).first_name, 'Old')
+
+    def test_a_value_changed_meanwhile_is_not_overwritten(self):
+        with mock.patch.object(keyring._reencryption_worker, 'submit', return_value=True) as submit:
+            CustomUser.objects.get(pk=self.user.pk).first_name
+        CustomUser.objects.filter(pk=self.user.pk).update(first_name='New')
+        keyring._reencrypt_batch([submit.call_args.args[0]])
+        self.assertEqual(CustomUser.objects.get(pk=self.user.pk).first_name, 'New')
+
+
+class PackedFieldTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('packed', 'packed@example.com', 'pw', role=CustomUser.Role.PATIENT)
+        self.profile = PatientProfile.objects.create(
+            user=self.user, phone='+1 555 0100', address='1 Main Street', date_of_birth=date(1980, 2, 29),
+        )
+
+    def load(self):
+        return PatientProfile.objects.get(pk=self.profile.pk)
+
+    def stored_record(self):
+        with raw_ciphertexts():
+            return PatientProfile.objects.values_list('pii', flat=True).get(pk=self.profile.pk)
+
+    def test_members_round_trip_through_one_envelope(self):
+        profile = self.load()
+        self.assertEqual(
+            (profile.phone, profile.address, profile.date_of_birth), ('+1 555 0100', '1 Main Street', date(1980, 2, 29))
+        )
+        self.assertTrue(envelope.is_envelope(self.stored_record()))
+        self.assertEqual(
+            profile.pii, {'phone': '+1 555 0100', 'address': '1 Main Street', 'date_of_birth': '1980-02-29'}
+        )
+
+    def test_cleared_members_read_as_empty(self):
+        profile = self.load()
+        profile.address = ''
+        profile.date_of_birth = None
+        profile.save()
+        profile = self.load()
+        self.assertEqual((profile.phone, profile.address, profile.date_of_birth), ('+1 555 0100', '', None))
+        self.assertEqual(profile.pii, {'phone': '+1 555 0100'})
+
+    def test_changing_a_member_rewrites_the_record(self):
+        record = self.stored_record()
+        profile = self.load()
+        profile.phone
+        profile.save()
+        self.assertEqual(self.stored_record(), record)
+        profile.phone = '+1 555 0199'
+        profile.save()
+        self.assertNotEqual(self.stored_record(), record)
+        self.assertEqual((self.load().phone, self.load().address), ('+1 555 0199', '1 Main Street'))
+
+    def test_unreadable_record(self):
+        PatientProfile.objects.filter(pk=self.profile.pk).update(pii=as_ciphertext(b'\xc1broken'))
+        with mock.patch.object(EncryptedFieldMixin, '_report_decryption_failure'):
+            profile = self.load()
+            self.assertEqual(profile.phone, DATA_UNAVAILABLE_PLACEHOLDER)
+            self.assertIsNone(profile.date_of_birth)
+
+    def test_members_cannot_be_used_in_queries(self):
+        for queryset in (
+            lambda: PatientProfile.objects.filter(phone='+1 555 0100'),
+            lambda: PatientProfile.objects.order_by('date_of_birth'),
+            lambda: CustomUser.objects.filter(patient_profile__address__contains='Main'),
+        ):
+            with self.assertRaisesMessage(FieldError, 'clinic.blind_index'):
+                list(queryset())
+
+    def test_deferring_keeps_the_record_of_a_kept_member(self):
+        profile = PatientProfile.objects.defer_encrypted('phone').get(pk=self.profile.pk)
+        self.assertNotIn('pii', profile.get_deferred_fields())
+        profile = PatientProfile.objects.defer_encrypted().get(pk=self.profile.pk)
+        self.assertIn('pii', profile.get_deferred_fields())
+        self.assertEqual(profile.address, '1 Main Street')
+
+
+class ChangeTrackingSaveTests(TestCase):
+    def setUp(self):
+        patient = CustomUser.objects.create_user('patient', 'patient@example.com', 'pw', role=CustomUser.Role.PATIENT)
+        doctor = CustomUser.objects.create_user('doctor', 'doctor@example.com', 'pw', role=CustomUser.Role.DOCTOR)
+        self.appointment = Appointment.objects.create(
+            patient=patient, doctor=doctor, date_time=timezone.now() + timedelta(days=1),
+            diagnosis='Seasonal allergies',
+        )
+
+    def load(self):
+        return Appointment.objects.get(pk=self.appointment.pk)
+
+    def stored_diagnosis(self):
+        with raw_ciphertexts():
+            return Appointment.objects.values_list('diagnosis', flat=True).get(pk=self.appointment.pk)
+
+    def update_sql(self, appointment):
+        with CaptureQueriesContext(connection) as queries:
+            appointment.save()
+        return [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+
+    def test_only_the_changed_column_is_written(self):
+        appointment = self.load()
+        appointment.diagnosis
+        appointment.status = Appointment.Status.CONFIRMED
+        [sql] = self.update_sql(appointment)
+        columns = sql.split(' SET ')[1].split(' WHERE ')[0]
+        self.assertIn('"status"', columns)
+        self.assertIn('"updated_at"', columns)
+        self.assertNotIn('"diagnosis"', columns)
+        self.assertNotIn('"date_time"', columns)
+        self.assertEqual(self.load().status, Appointment.Status.CONFIRMED)
+
+    def test_saving_without_changes_writes_nothing(self):
+        appointment = self.load()
+        appointment.diagnosis
+        self.assertEqual(self.update_sql(appointment), [])
+
+    def test_unchanged_ciphertext_is_kept(self):
+        token = self.stored_diagnosis()
+        appointment = self.load()
+        self.assertEqual(appointment.diagnosis, 'Seasonal allergies')
+        # Forcing every column keeps the stored token rather than re-encrypting it.
+        appointment.save(update_fields=['diagnosis', 'status'])
+        self.assertEqual(self.stored_diagnosis(), token)
+
+    def test_changed_encrypted_value_is_reencrypted(self):
+        token = self.stored_diagnosis()
+        appointment = self.load()
+        appointment.diagnosis = 'Hay fever'
+        [sql] = self.update_sql(appointment)
+        self.assertIn('"diagnosis"', sql)
+        self.assertNotEqual(self.stored_diagnosis(), token)
+        self.assertEqual(self.load().diagnosis, 'Hay fever')
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        self.patient = CustomUser.objects.create_user('patient', 'patient@example.com', 'pw', role=CustomUser.Role.PATIENT)
+        self.doctor = CustomUser.objects.create_user('doctor', 'doctor@example.com', 'pw', role=CustomUser.Role.DOCTOR)
+
+    def stored(self, model, pk, field):
+        with raw_ciphertexts():
+            return model.objects.values_list(field, flat=True).get(pk=pk)
+
+    def test_flag_is_recorded_and_read_back(self):
+        ring = KeyRing([(2, NEW_KEY)])
+        text = 'Follow-up in two weeks. ' * 40
+        for method in envelope.COMPRESSION_FLAGS:
+            with self.subTest(method=method):
+                sealed = ring.seal(text.encode(), compression=method)
+                self.assertEqual(envelope.compression_of(sealed), method)
+                self.assertLess(len(sealed), len(text))
+                self.assertEqual(ring.decrypt(sealed), text.encode())
+                as_text = ring.encrypt_text(text.encode(), compression=method)
+                self.assertEqual(envelope.compression_of(as_text), method)
+                self.assertEqual(ring.decrypt(as_text), text.encode())
+
+    def test_data_that_does_not_shrink_is_stored_as_is(self):
+        ring = KeyRing([(2, NEW_KEY)])
+        sealed = ring.seal(os.urandom(512), compression='zlib')
+        self.assertIsNone(envelope.compression_of(sealed))
+
+    def test_long_note_is_stored_compressed(self):
+        content = 'Patient reports mild headaches in the evening. ' * 20
+        note = MedicalNote.objects.create(patient=self.patient, author=self.doctor, content=content)
+        self.assertEqual(envelope.compression_of(bytes(self.stored(MedicalNote, note.pk, 'content'))), 'zlib')
+        self.assertEqual(MedicalNote.objects.get(pk=note.pk).content, content)
+
+    def test_values_below_the_minimum_size_are_not_compressed(self):
+        appointment = Appointment.objects.create(
+            patient=self.patient, doctor=self.doctor, date_time=timezone.now() + timedelta(days=1),
+            diagnosis='Flu',
+        )
+        self.assertIsNone(envelope.compression_of(self.stored(Appointment, appointment.pk, 'diagnosis')))
+        self.assertEqual(Appointment.objects.get(pk=appointment.pk).diagnosis, 'Flu')
+
+    def test_rotation_keeps_the_compression(self):
+        ring = KeyRing([(2, NEW_KEY), (1, OLD_KEY)])
+        sealed = KeyRing([(1, OLD_KEY)]).seal(b'note ' * 100, compression='lzma')
+        rotated = ring.rotate(sealed)
+        self.assertEqual(envelope.compression_of(rotated), 'lzma')
+        self.assertEqual(ring.decrypt_with_key_id(rotated), (b'note ' * 100, 2))
+
+
+class DataKeyEnvelopeTests(TestCase):
+    def test_round_trip_under_a_data_key_and_shredding(self):
+        user = CustomUser.objects.create_user('patient', 'p@example.com', 'pw', role=CustomUser.Role.PATIENT)
+        ring = get_key_ring()
+        token = ring.encrypt_text(b'diagnosis', data_key=key_for_owner(user.pk))
+        self.assertIsNotNone(envelope.data_key_id(token))
+        self.assertEqual(ring.decrypt(token), b'diagnosis')
+        self.assertTrue(destroy_data_key(user.pk))
+        with self.assertRaises(InvalidToken):
+            ring.decrypt(token)
+
+    def test_key_is_cached_only_once_its_row_is_committed(self):
+        cache = data_keys.get_data_key_cache()
+        committed, rolled_back = (
+            CustomUser.objects.create_user(name, f'{name}@example.com', 'pw', role=CustomUser.Role.PATIENT)
+            for name in ('committed', 'rolled-back')
+        )
+        self.addCleanup(cache.discard_owner, committed.pk)
+        cache.sync(force=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            data_key = key_for_owner(committed.pk)
+        self.assertIs(cache.get_for_owner(committed.pk), data_key)
+        with self.captureOnCommitCallbacks(execute=False):
+            key_for_owner(rolled_back.pk)
+        self.assertIsNone(cache.get_for_owner(rolled_back.pk))
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class PatientErasureTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user('admin', 'admin@example.com', 'pw', role=CustomUser.Role.ADMIN)
+        self.patient = CustomUser.objects.create_user(
+            'zoe.patient', 'zoe@example.com', 'pw', role=CustomUser.Role.PATIENT,
+        )
+        PatientProfile.objects.create(user=self.patient, phone='+1 555 0100', address='1 Main Street')
+        MedicalNote.objects.create(patient=self.patient, author=self.admin, content='Allergic to penicillin')
+        self.client.force_login(self.admin)
+        self.url = reverse('clinic:delete_patient', args=[self.patient.pk])
+
+    def entry(self, action):
+        return AuditLog.objects.get(action=action)
+
+    def test_identifiers_in_audit_entries_are_sealed_under_the_data_key(self):
+        self.client.get(self.url)
+        self.client.post(reverse('clinic:toggle_patient_status', args=[self.patient.pk]))
+        entries = [
+            self.entry(action) for action in (AuditAction.VIEW_PATIENT_DELETE_CONFIRM, AuditAction.TOGGLE_PATIENT_STATUS)
+        ]
+        for log in entries:
+            self.assertNotIn('zoe.patient', log.resource + log.details)
+        viewed, toggled = reveal_logs(entries)
+        self.assertTrue(viewed.details.startswith('Patients: zoe.patient | '))
+        self.assertEqual(toggled.resource, 'User: zoe.patient, Active: False')
+        self.assertContains(self.client.get(reverse('clinic:audit_logs')), 'zoe.patient')
+
+    def test_deleting_a_patient_erases_their_identifiers_from_the_audit_log(self):
+        self.client.get(self.url)
+        response = self.client.post(self.url)
+        self.assertRedirects(response, reverse('clinic:manage_patients'))
+        self.assertFalse(CustomUser.objects.filter(pk=self.patient.pk).exists())
+        self.assertFalse(MedicalNote.objects.exists())
+
+        deleted = self.entry(AuditAction.DELETE_USER)
+        self.assertNotIn('zoe@example.com', deleted.details)
+        [deleted, viewed] = reveal_logs([deleted, self.entry(AuditAction.VIEW_PATIENT_DELETE_CONFIRM)])
+        self.assertEqual(deleted.resource, f'Patient: {ERASED}')
+        self.assertEqual(deleted.details, f'Deleted patient account (id={self.patient.pk}, email={ERASED})')
+        self.assertTrue(viewed.details.startswith(f'Patients: {ERASED} | '))
+        self.assertNotContains(self.client.get(reverse('clinic:audit_logs')), 'zoe.patient')
+        # The entries themselves are unchanged, so the chain still verifies.
+        rows = [row for chunk in iter_chain_chunks() for row in chunk]
+        self.assertEqual(verify_chain_rows(rows, 0, GENESIS_HASH), (len(rows), []))
+
+
+class BlindIndexSearchTests(TestCase):
+    def setUp(self):
+        self.zoe = CustomUser.objects.create_user(
+            'zoe', 'zoe@example.com', 'pw', first_name='Zoë', last_name='Ångström', role=CustomUser.Role.PATIENT,
+        )
+        self.smith = CustomUser.objects.create_user(
+            'smith', 'smith@example.com', 'pw', first_name='Zoe', last_name='Smith-Jones',
+            role=CustomUser.Role.PATIENT,
+        )
+        CustomUser.objects.create_user('bob', 'bob@example.com', 'pw', first_name='Bob', role=CustomUser.Role.PATIENT)
+        PatientProfile.objects.create(user=self.zoe, phone='+1 (555) 010-2030')
+
+    def search(self, term):
+        return set(
+            CustomUser.objects.filter(blind_index.search_q(CustomUser, ['first_name', 'last_name'], term))
+            .values_list('username', flat=True)
+        )
+
+    def test_matches_word_prefixes_ignoring_case_and_accents(self):
+        self.assertEqual(self.search('zoe'), {'zoe', 'smith'})
+        self.assertEqual(self.search('ANGST'), {'zoe'})
+        self.assertEqual(self.search('zo jon'), {'smith'})
+        self.assertEqual(self.search('zoe bob'), set())
+
+    def test_terms_too_short_match_nothing(self):
+        self.assertEqual(self.search('z'), set())
+        self.assertEqual(self.search(''), set())
+
+    def test_digit_search_on_a_related_model(self):
+        q = blind_index.search_q(PatientProfile, ['phone'], '+1 555 01', lookup='patient_profile')
+        self.assertEqual(list(CustomUser.objects.filter(q).values_list('username', flat=True)), ['zoe'])
+        self.assertFalse(CustomUser.objects.filter(
+            blind_index.search_q(PatientProfile, ['phone'], '0102', lookup='patient_profile')
+        ).exists())
+
+    def test_index_follows_updates_and_deletes(self):
+        self.smith.last_name = 'Brown'
+        self.smith.save()
+        self.assertEqual(self.search('smith'), set())
+        self.assertEqual(self.search('brow'), {'smith'})
+        pk = self.smith.pk
+        self.smith.delete()
+        self.assertFalse(BlindIndexEntry.objects.filter(model='accounts.customuser', object_id=pk).exists())
+
+    def test_entries_written_under_an_older_key_still_match(self):
+        self.addCleanup(reset_key_ring)
+        old_key = dict(get_key_ring().key_material)[LEGACY_KEY_ID].decode()
+        with mock.patch.dict(os.environ, {'FIELD_ENCRYPTION_KEYS': f'2:{NEW_KEY.decode()},1:{old_key}'}):
+            reset_key_ring()
+            self.assertEqual(self.search('zoe'), {'zoe', 'smith'})
+
+
+class FakeMonotonic:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@override_settings(FIELD_DECRYPTION_ALERT_INTERVAL=60)
+class DecryptionAlertTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeMonotonic()
+        patchers = [
+            mock.patch.object(decryption_alerts.time, 'monotonic', self.clock),
+            mock.patch.object(decryption_alerts, '_alert_worker'),
+            mock.patch.object(decryption_alerts, '_last_alert', {}),
+            mock.patch.object(decryption_alerts, '_failures', decryption_alerts.Counter()),
+            mock.patch.object(decryption_alerts, '_unreported', decryption_alerts.Counter()),
+            mock.patch.dict(decryption_alerts._stats, {'alerts_sent': 0, 'alerts_suppressed': 0}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.worker = decryption_alerts._alert_worker
+        self.field = MedicalNote._meta.get_field('content')
+
+    def test_repeated_failures_alert_once_per_interval(self):
+        with self.assertLogs('clinic.decryption_alerts', 'CRITICAL') as logs:
+            for _ in range(5):
+                decryption_alerts.record_failure(self.field, InvalidToken())
+        self.assertEqual(len(logs.records), 1)
+        self.worker.submit.assert_called_once_with(('clinic.MedicalNote', 'content', 'InvalidToken'))
+        self.assertEqual(decryption_alerts._stats['alerts_suppressed'], 4)
+        self.assertEqual(decryption_alerts._unreported[('clinic.MedicalNote', 'content', 'InvalidToken')], 5)
+
+    def test_alert_is_sent_again_after_the_interval(self):
+        with self.assertLogs('clinic.decryption_alerts', 'CRITICAL'):
+            decryption_alerts.record_failure(self.field, InvalidToken())
+            self.clock.advance(59)
+            decryption_alerts.record_failure(self.field, InvalidToken())
+            self.clock.advance(1)
+            decryption_alerts.record_failure(self.field, InvalidToken())
+        self.assertEqual(self.worker.submit.call_count, 2)
+        self.assertEqual(decryption_alerts._stats['alerts_suppressed'], 1)
+
+    def test_each_error_type_has_its_own_interval(self):
+        with self.assertLogs('clinic.decryption_alerts', 'CRITICAL'):
+            decryption_alerts.record_failure(self.field, InvalidToken())
+            decryption_alerts.record_failure(self.field, ValueError('bad padding'))
+        self.assertEqual(self.worker.submit.call_count, 2)
+
+    def test_alert_reports_failures_counted_since_the_last_one(self):
+        key = ('clinic.MedicalNote', 'content', 'InvalidToken')
+        with self.assertLogs('clinic.decryption_alerts', 'CRITICAL'):
+            for _ in range(3):
+                decryption_alerts.record_failure(self.field, InvalidToken())
+        with mock.patch.object(decryption_alerts, 'mail_admins') as mail_admins:
+            decryption_alerts._send_alerts([key, key])
+        message = mail_admins.call_args.kwargs['message']
+        self.assertIn('clinic.MedicalNote.content: 3 failure(s) since the last alert, 3 since startup', message)
+        self.assertEqual(decryption_alerts._unreported[key], 0)
+        self.assertEqual(decryption_alerts.get_decryption_failure_stats()['by_field'], {'clinic.MedicalNote.content': 3})
+
+
+class DataKeyCacheRevocationTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeMonotonic()
+        patcher = mock.patch.object(data_keys.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shared = LocMemCache('data-key-tests', {})
+        self.shared.clear()
+        # Two processes sharing the cache.
+        self.here = DataKeyCache(shared=self.shared, sync_interval=1.0)
+        self.there = DataKeyCache(shared=self.shared, sync_interval=1.0)
+        self.key = UnwrappedKey(7, 42, b'k' * 32)
+        for cache in (self.here, self.there):
+            cache.get(7)
+            cache.put(self.key)
+
+    def test_revocation_reaches_other_processes_within_the_interval(self):
+        self.here.discard_owner(42)
+        self.here.revoke()
+        self.assertIsNone(self.here.get(7))
+        self.assertIs(self.there.get(7), self.key)
+        self.clock.advance(1.0)
+        self.assertIsNone(self.there.get(7))
+        self.assertIsNone(self.there.get_for_owner(42))
+
+    def test_unchanged_token_keeps_keys(self):
+        self.clock.advance(5.0)
+        self.assertIs(self.there.get(7), self.key)
+        self.assertEqual(self.there.hits, 1)
+
+    def test_lost_token_forgets_keys(self):
+        self.shared.delete(REVOCATION_KEY)
+        self.clock.advance(1.0)
+        self.assertIsNone(self.there.get(7))
+        self.assertIsNotNone(self.shared.get(REVOCATION_KEY))
+
+    def test_unreadable_token_forgets_keys(self):
+        self.clock.advance(1.0)
+        with mock.patch.object(self.shared, 'get', side_effect=RuntimeError), \
+                self.assertLogs('clinic.data_keys', 'WARNING'):
+            self.assertIsNone(self.there.get(7))
+
+
+class KeyRotationTestMixin:
+    """A fresh key ring per test, with helpers to change it and run rotate_keys."""
+
+    def setUp(self):
+        super().setUp()
+        self.old_key = dict(get_key_ring().key_material)[LEGACY_KEY_ID].decode()
+        self.new_key = Fernet.generate_key().decode()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.checkpoint = os.path.join(self.directory, 'rotate.json')
+        self.addCleanup(reset_key_ring)
+
+    def use_keys(self, *entries):
+        patcher = mock.patch.dict(os.environ, {'FIELD_ENCRYPTION_KEYS': ','.join(entries)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_key_ring()
+
+    def rotate(self, **options):
+        out = StringIO()
+        call_command(
+            'rotate_keys', new_key=f'2:{self.new_key}', workers=1, checkpoint=self.checkpoint, stdout=out, **options
+        )
+        return out.getvalue()
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class RotateKeysTests(KeyRotationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for index in range(3):
+            CustomUser.objects.create_user(
+                f'user{index}', f'user{index}@example.com', 'pw', first_name=f'First{index}',
+                role=CustomUser.Role.DOCTOR,
+            )
+        self.use_keys(f'2:{self.new_key}', f'{LEGACY_KEY_ID}:{self.old_key}')
+
+    def key_ids(self):
+        ring = get_key_ring()
+        with raw_ciphertexts():
+            tokens = list(CustomUser.objects.values_list('email', 'first_name'))
+        return {ring.decrypt_with_key_id(token)[1] for row in tokens for token in row}
+
+    def assert_readable_with_the_new_key_only(self):
+        self.use_keys(f'2:{self.new_key}')
+        self.assertEqual(
+            sorted(CustomUser.objects.values_list('email', flat=True)),
+            [f'user{index}@example.com' for index in range(3)],
+        )
+
+    def test_rotation_puts_rows_under_the_new_key(self):
+        self.assertEqual(self.key_ids(), {LEGACY_KEY_ID})
+        self.rotate()
+        self.assertEqual(self.key_ids(), {2})
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assert_readable_with_the_new_key_only()
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        apply_updates = rotate_keys.Command._apply_updates
+        calls = []
+
+        def interrupt_second_chunk(command, *args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return apply_updates(command, *args)
+
+        with mock.patch.object(rotate_keys.Command, '_apply_updates', interrupt_second_chunk):
+            with self.assertRaisesMessage(CommandError, 'interrupted'):
+                self.rotate(chunk_size=1)
+        self.assertEqual(self.key_ids(), {LEGACY_KEY_ID, 2})
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        output = self.rotate(chunk_size=1)
+        self.assertIn('Resuming from checkpoint', output)
+        self.assertEqual(self.key_ids(), {2})
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assert_readable_with_the_new_key_only()
+
+    def test_row_changed_during_rotation_is_not_overwritten(self):
+        user = CustomUser.objects.get(username='user1')
+        rotate_rows = rotate_keys.rotate_rows
+
+        def rotate_then_edit(rows):
+            result = rotate_rows(rows)
+            if any(row[0] == user.pk for row in rows):
+                CustomUser.objects.filter(pk=user.pk).update(email='edited@example.com')
+            return result
+
+        with mock.patch.object(rotate_keys, 'rotate_rows', rotate_then_edit), \
+                self.assertLogs('clinic.blind_index', 'WARNING'):
+            output = self.rotate(models=['accounts.CustomUser'])
+        self.assertIn('Updated:   2', output)
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).email, 'edited@example.com')
+        # The skipped row's other columns are still under the old key until the next run.
+        self.assertIn('Total errors: 1', output)
+        self.assertEqual(self.key_ids(), {LEGACY_KEY_ID, 2})
+        self.rotate(models=['accounts.CustomUser'])
+        self.assertEqual(self.key_ids(), {2})
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).email, 'edited@example.com')
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=5)
+class ArchiveRotationTests(KeyRotationTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        settings_patcher = override_settings(AUDIT_ARCHIVE_DIR=os.path.join(self.directory, 'archive'))
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        for index in range(10):
+            AuditLog(
+                action=AuditAction.LOGIN_SUCCESS, details=f'entry {index}',
+                timestamp=timezone.now() - timedelta(days=400),
+            ).save()
+
+    def archived_details(self):
+        return sorted(row[6] for row in ArchiveQuery().rows())
+
+    def test_rotation_reseals_archived_segments(self):
+        self.assertEqual(archive_old_entries()[0], 10)
+        self.use_keys(f'2:{self.new_key}', f'{LEGACY_KEY_ID}:{self.old_key}')
+        output = self.rotate()
+        self.assertIn('Run verify_audit_chain --resign', output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.use_keys(f'2:{self.new_key}')
+        self.assertEqual(self.archived_details(), sorted(f'entry {index}' for index in range(10)))
+
+    def test_rotation_is_not_complete_while_a_segment_cannot_be_read(self):
+        # Segments sealed under a key that is not passed to rotate_keys.
+        self.use_keys(f'3:{Fernet.generate_key().decode()}', f'{LEGACY_KEY_ID}:{self.old_key}')
+        archive_old_entries()
+        self.use_keys(f'{LEGACY_KEY_ID}:{self.old_key}')
+        output = self.rotate()
+        self.assertIn('A segment could not be decrypted', output)
+        self.assertNotIn('older keys can be removed', output)
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+
+@override_settings(AUDIT_LOG_ASYNC=False, AUDIT_CHAIN_CHECKPOINT_EVERY=0)
+class PhiViewQueryCountTests(TestCase):
+    """Listing pages that log the patients they show run as many queries for one row as for many."""
+
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user('admin', 'admin@example.com', 'pw', role=CustomUser.Role.ADMIN)
+        self.doctor = CustomUser.objects.create_user(
+            'doctor', 'doctor@example.com', 'pw', role=CustomUser.Role.DOCTOR,
+        )
+        self.patients = 0
+        self.add_patients(1)
+        # Keep revocation checks of the data key cache out of the counts.
+        cache = data_keys.get_data_key_cache()
+        cache.sync(force=True)
+        patcher = mock.patch.object(cache, 'sync_interval', 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_patients(self, count):
+        for _ in range(count):
+            self.patients += 1
+            name = f'patient{self.patients}'
+            user = CustomUser.objects.create_user(
+                name, f'{name}@example.com', 'pw', first_name='Pat', last_name=name, role=CustomUser.Role.PATIENT,
+            )
+            PatientProfile.objects.create(user=user, phone=f'+1 555 01{self.patients:02d}', address='1 Main Street')
+            Appointment.objects.create(
+                patient=user, doctor=self.doctor, date_time=timezone.now() + timedelta(days=self.patients),
+            )
+            for index in range(4):
+                MedicalNote.objects.create(patient=user, author=self.doctor, content=f'note {index} for {name}')
+
+    def assertQueriesDoNotGrow(self, user, url_name):
+        self.client.force_login(user)
+        url = reverse(url_name)
+        # The first request after logging in also touches the session.
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as one_row:
+            self.assertContains(self.client.get(url), 'patient1')
+        self.add_patients(9)
+        with self.assertNumQueries(len(one_row)):
+            self.assertContains(self.client.get(url), 'patient10')
+
+    def test_admin_patient_list(self):
+        self.assertQueriesDoNotGrow(self.admin, 'clinic:admin_patient_list')
+
+    def test_admin_appointment_list(self):
+        self.assertQueriesDoNotGrow(self.admin, 'clinic:admin_appointment_list')
+
+    def test_manage_patients(self):
+        self.assertQueriesDoNotGrow(self.admin, 'clinic:manage_patients')
+
+    def test_doctor_dashboard(self):
+        self.assertQueriesDoNotGrow(self.doctor, 'clinic:doctor_dashboard')
+        response = self.client.get(reverse('clinic:doctor_dashboard'))
+        self.assertContains(response, 'note 3 for patient10')
+        self.assertNotContains(response, 'note 0 for patient10')
+
+    def test_doctor_appointment_history(self):
+        self.assertQueriesDoNotGrow(self.doctor, 'clinic:doctor_appointment_history')
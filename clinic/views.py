@@ -8,10 +8,16 @@ from django.utils.http import url_has_allowed_host_and_scheme
 from django.db.models import Q, Prefetch
 from django.core.exceptions import PermissionDenied
 
-from accounts.models import CustomUser, DoctorProfile, NurseProfile, PatientProfile
+from accounts.models import CustomUser, DoctorProfile, NurseProfile, PatientProfile, hash_email
+from . import blind_index
+from .data_keys import destroy_data_key
 from .models import Appointment, MedicalNote
 from .forms import AppointmentForm, DiagnosisForm, MedicalNoteForm, StaffCreationForm, ProfileForm, NurseAssignmentForm, PatientCreationForm
+from audit.actions import AuditAction, action_prefixes, parse_action_filter
 from audit.utils import log_action, log_phi_view
+from audit.archive import ArchiveQuery, AuditTrail
+from audit.identifiers import seal_identifier, seal_identifiers
+from audit.pagination import keyset_page
 from audit.models import AuditLog
 
 
@@ -54,7 +60,7 @@ class AdminPatientListView(AdminRequiredMixin, ListView):
     context_object_name = 'patients'
     paginate_by = 20
     def get_queryset(self):
-        return PatientProfile.objects.select_related('user').order_by('user__username')
+        return PatientProfile.objects.select_related('user').order_by('user__username').decrypt_in_batches()
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
@@ -62,7 +68,7 @@ class AdminPatientListView(AdminRequiredMixin, ListView):
         page = (self.request.GET.get('page') or '1').strip()[:10]
         log_phi_view(
             self.request,
-            action="VIEW_PATIENT_LIST_ADMIN",
+            action=AuditAction.VIEW_PATIENT_LIST_ADMIN,
             resource="Admin patient list",
             patients=patients,
             extra_details=f"page={page or '1'}",
@@ -76,7 +82,7 @@ class AdminAppointmentListView(AdminRequiredMixin, ListView):
     context_object_name = 'appointments'
     paginate_by = 30
     def get_queryset(self):
-        qs = Appointment.objects.select_related('patient', 'doctor').order_by('-date_time')
+        qs = Appointment.objects.select_related('patient', 'doctor').defer_encrypted('diagnosis').order_by('-date_time')
         status = self.request.GET.get('status')
         doctor_id = self.request.GET.get('doctor')
         if status:
@@ -85,35 +91,20 @@ class AdminAppointmentListView(AdminRequiredMixin, ListView):
             doctor_id = doctor_id.strip()
             if doctor_id.isdigit():
                 qs = qs.filter(doctor_id=int(doctor_id))
-        return qs
+        return qs.decrypt_in_batches()
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx['doctors'] = CustomUser.objects.filter(role=CustomUser.Role.DOCTOR)
         ctx['statuses'] = Appointment.Status.choices
         appointments = ctx.get('object_list') or []
-        try:
-            sample = appointments[:10]
-        except Exception:
-            sample = appointments
-
-        patient_usernames = []
-        for appt in sample:
-            patient = getattr(appt, "patient", None)
-            username = getattr(patient, "username", None)
-            if username:
-                username = str(username).strip()
-                if username and username not in patient_usernames:
-                    patient_usernames.append(username)
-            if len(patient_usernames) >= 10:
-                break
 
         page = (self.request.GET.get('page') or '1').strip()[:10]
         log_phi_view(
             self.request,
-            action="VIEW_APPOINTMENTS_ADMIN",
+            action=AuditAction.VIEW_APPOINTMENTS_ADMIN,
             resource="Admin appointment list",
-            patient_usernames=patient_usernames,
+            patients=[appt.patient for appt in appointments],
             extra_details=f"page={page or '1'}",
         )
         return ctx
@@ -125,20 +116,24 @@ class DoctorDashboardView(DoctorRequiredMixin, ListView):
 
     def get_queryset(self):
         show_all = self.request.GET.get('show_all') == '1'
-        qs = Appointment.objects.filter(doctor=self.request.user)
+        qs = Appointment.objects.filter(doctor=self.request.user).select_related('patient')
         if not show_all:
             qs = qs.exclude(status=Appointment.Status.CANCELLED)
-        return qs.order_by('date_time')
+        return qs.order_by('date_time').decrypt_in_batches()
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         patient_ids = Appointment.objects.filter(doctor=self.request.user).values_list('patient_id', flat=True)
-        ctx['my_patients'] = PatientProfile.objects.filter(user_id__in=patient_ids)
+        # The template shows each patient's three latest notes.
+        latest_notes = MedicalNote.objects.select_related('author').order_by('-created_at')[:3]
+        ctx['my_patients'] = PatientProfile.objects.filter(user_id__in=patient_ids).select_related('user').prefetch_related(
+            Prefetch('user__medical_notes', queryset=latest_notes.decrypt_in_batches(), to_attr='latest_notes')
+        ).decrypt_in_batches()
         ctx['show_all'] = self.request.GET.get('show_all') == '1'
         ctx['now'] = timezone.now()
         log_phi_view(
             self.request,
-            action="VIEW_PATIENTS_DOCTOR_DASH",
+            action=AuditAction.VIEW_PATIENTS_DOCTOR_DASH,
             resource="Doctor dashboard",
             patients=ctx.get('my_patients'),
             extra_details=f"show_all={ctx['show_all']}",
@@ -152,39 +147,24 @@ class DoctorAppointmentHistoryView(DoctorRequiredMixin, ListView):
     context_object_name = 'appointments'
     paginate_by = 20
     def get_queryset(self):
-        qs = Appointment.objects.filter(doctor=self.request.user)
+        qs = Appointment.objects.filter(doctor=self.request.user).select_related('patient')
         status = self.request.GET.get('status')
         if status:
             qs = qs.filter(status=status)
-        return qs.order_by('-date_time')
+        return qs.order_by('-date_time').decrypt_in_batches()
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx['statuses'] = Appointment.Status.choices
         appointments = ctx.get('object_list') or []
-        try:
-            sample = appointments[:10]
-        except Exception:
-            sample = appointments
-
-        patient_usernames = []
-        for appt in sample:
-            patient = getattr(appt, "patient", None)
-            username = getattr(patient, "username", None)
-            if username:
-                username = str(username).strip()
-                if username and username not in patient_usernames:
-                    patient_usernames.append(username)
-            if len(patient_usernames) >= 10:
-                break
 
         page = (self.request.GET.get('page') or '1').strip()[:10]
         status = (self.request.GET.get('status') or '').strip()[:20]
         log_phi_view(
             self.request,
-            action="VIEW_APPOINTMENT_HISTORY_DOCTOR",
+            action=AuditAction.VIEW_APPOINTMENT_HISTORY_DOCTOR,
             resource="Doctor appointment history",
-            patient_usernames=patient_usernames,
+            patients=[appt.patient for appt in appointments],
             extra_details=f"page={page or '1'}, status_filter={status or 'any'}",
         )
         return ctx
@@ -230,7 +210,7 @@ class NurseDashboardView(NurseRequiredMixin, TemplateView):
         
         log_phi_view(
             self.request,
-            action="VIEW_PATIENTS_NURSE_DASH",
+            action=AuditAction.VIEW_PATIENTS_NURSE_DASH,
             resource="Nurse dashboard",
             patients=patients,
             extra_details=f"assigned_doctors={len(doctors)}",
@@ -261,9 +241,9 @@ class PatientDashboardView(PatientRequiredMixin, ListView):
             note_count = len(notes)
         log_phi_view(
             self.request,
-            action="VIEW_OWN_RECORDS",
+            action=AuditAction.VIEW_OWN_RECORDS,
             resource="Patient dashboard",
-            patient_usernames=[getattr(self.request.user, "username", "")],
+            patients=[self.request.user],
             extra_details=f"appointments={appointment_count}, notes={note_count}",
         )
         return ctx
@@ -279,7 +259,7 @@ class ProfileEditView(PatientRequiredMixin, UpdateView):
         return profile
     def form_valid(self, form):
         messages.success(self.request, 'Your profile has been updated successfully.')
-        log_action(self.request, "EDIT_PROFILE", f"User: {self.request.user.username}")
+        log_action(self.request, AuditAction.EDIT_PROFILE, f"User: {self.request.user.username}")
         return super().form_valid(form)
 
 
@@ -292,7 +272,7 @@ class BookAppointmentView(PatientRequiredMixin, CreateView):
     def form_valid(self, form):
         form.instance.patient = self.request.user
         form.instance.status = Appointment.Status.REQUESTED
-        log_action(self.request, "REQUEST_APPOINTMENT", f"Doctor: {form.instance.doctor.username}")
+        log_action(self.request, AuditAction.REQUEST_APPOINTMENT, f"Doctor: {form.instance.doctor.username}")
         return super().form_valid(form)
 
 
@@ -313,7 +293,7 @@ class PatientCancelAppointmentView(PatientRequiredMixin, View):
         appt.save(update_fields=["status", "updated_at"])
         log_action(
             request,
-            "PATIENT_CANCEL_APPT",
+            AuditAction.PATIENT_CANCEL_APPT,
             f"Appt ID: {pk}",
             f"Previous Status: {previous_status} -> New Status: {Appointment.Status.CANCELLED}",
         )
@@ -338,7 +318,7 @@ class UpdateAppointmentStatusView(DoctorRequiredMixin, View):
         
         try:
             appt.transition_to(new_status)
-            log_action(request, "UPDATE_APPT_STATUS", f"Appt ID: {pk}, Status: {appt.status}")
+            log_action(request, AuditAction.UPDATE_APPT_STATUS, f"Appt ID: {pk}, Status: {appt.status}")
             messages.success(request, f'Appointment status updated to {appt.get_status_display()}.')
         except ValidationError as e:
             messages.error(request, e.message if hasattr(e, 'message') else str(e.messages[0] if e.messages else e))
@@ -355,7 +335,7 @@ class AddDiagnosisView(DoctorRequiredMixin, UpdateView):
         return Appointment.objects.filter(doctor=self.request.user, status=Appointment.Status.COMPLETED)
 
     def form_valid(self, form):
-        log_action(self.request, "ADD_DIAGNOSIS", f"Appt ID: {self.object.id}")
+        log_action(self.request, AuditAction.ADD_DIAGNOSIS, f"Appt ID: {self.object.id}")
         return super().form_valid(form)
 
     def _get_safe_next_url(self):
@@ -409,16 +389,16 @@ class AddMedicalNoteView(LoginRequiredMixin, CreateView):
         ctx['patient'] = self.target_patient
         log_phi_view(
             self.request,
-            action="VIEW_PATIENT_FOR_NOTE",
+            action=AuditAction.VIEW_PATIENT_FOR_NOTE,
             resource="Add medical note",
-            patient_usernames=[getattr(self.target_patient, "username", "")],
+            patients=[self.target_patient],
         )
         return ctx
 
     def form_valid(self, form):
         form.instance.author = self.request.user
         form.instance.patient = self.target_patient
-        log_action(self.request, "ADD_NOTE", f"Patient ID: {self.target_patient.id}")
+        log_action(self.request, AuditAction.ADD_NOTE, f"Patient ID: {self.target_patient.id}")
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -449,7 +429,7 @@ class EditMedicalNoteView(NoteAuthorMixin, UpdateView):
         return reverse_lazy('home')
 
     def form_valid(self, form):
-        log_action(self.request, "EDIT_NOTE", f"Note ID: {self.object.id}")
+        log_action(self.request, AuditAction.EDIT_NOTE, f"Note ID: {self.object.id}")
         return super().form_valid(form)
 
 
@@ -469,7 +449,7 @@ class DeleteMedicalNoteView(NoteAuthorMixin, DeleteView):
 
     def delete(self, request, *args, **kwargs):
         self.object = self.get_object()
-        log_action(request, "DELETE_NOTE", f"Note ID: {self.object.id}")
+        log_action(request, AuditAction.DELETE_NOTE, f"Note ID: {self.object.id}")
         return super().delete(request, *args, **kwargs)
 
 
@@ -479,7 +459,9 @@ class ManageStaffView(AdminRequiredMixin, ListView):
     context_object_name = 'staff_users'
 
     def get_queryset(self):
-        return CustomUser.objects.filter(role__in=[CustomUser.Role.DOCTOR, CustomUser.Role.NURSE])
+        return CustomUser.objects.filter(
+            role__in=[CustomUser.Role.DOCTOR, CustomUser.Role.NURSE]
+        ).defer_encrypted('email')
 
 class CreateStaffView(AdminRequiredMixin, CreateView):
     form_class = StaffCreationForm
@@ -487,7 +469,7 @@ class CreateStaffView(AdminRequiredMixin, CreateView):
     success_url = reverse_lazy('clinic:manage_staff')
 
     def form_valid(self, form):
-        log_action(self.request, "CREATE_STAFF", f"User: {form.instance.username}, Role: {form.instance.role}")
+        log_action(self.request, AuditAction.CREATE_STAFF, f"User: {form.instance.username}, Role: {form.instance.role}")
         return super().form_valid(form)
 
 class ToggleStaffStatusView(AdminRequiredMixin, View):
@@ -499,7 +481,7 @@ class ToggleStaffStatusView(AdminRequiredMixin, View):
         
         user.is_active = not user.is_active
         user.save()
-        log_action(request, "TOGGLE_STAFF_STATUS", f"User: {user.username}, Active: {user.is_active}")
+        log_action(request, AuditAction.TOGGLE_STAFF_STATUS, f"User: {user.username}, Active: {user.is_active}")
         return redirect('clinic:manage_staff')
 
 class DeleteStaffView(AdminRequiredMixin, DeleteView):
@@ -527,7 +509,7 @@ class DeleteStaffView(AdminRequiredMixin, DeleteView):
 
         log_action(
             request,
-            "DELETE_USER",
+            AuditAction.DELETE_USER,
             resource=f"User: {username}",
             details=f"Deleted staff account (id={user_id}, role={role})",
             user_obj=request.user,
@@ -562,7 +544,7 @@ class EditNurseAssignmentsView(AdminRequiredMixin, UpdateView):
     def form_valid(self, form):
         log_action(
             self.request, 
-            "UPDATE_NURSE_ASSIGNMENTS", 
+            AuditAction.UPDATE_NURSE_ASSIGNMENTS, 
             f"Nurse: {self.object.user.username}",
             f"Assigned doctors: {', '.join([d.user.username for d in form.cleaned_data['assigned_doctors']])}"
         )
@@ -573,21 +555,39 @@ class AuditLogView(AdminRequiredMixin, ListView):
     model = AuditLog
     template_name = 'clinic/audit_logs.html'
     context_object_name = 'logs'
-    paginate_by = 50
-    
+    # Pages are walked with (timestamp, id) cursors, not Paginator offsets.
+    page_size = 50
+
     def get_queryset(self):
         qs = AuditLog.objects.all()
+        archive = {}
         role = (self.request.GET.get('role') or '').strip()
-        action = (self.request.GET.get('action') or '').strip()
+        actions = parse_action_filter(self.request.GET.get('action'), self.request.GET.get('match'))
 
         valid_roles = {choice[0] for choice in CustomUser.Role.choices}
         if role in valid_roles:
-            qs = qs.filter(actor__role=role)
+            qs = qs.filter(actor_role=role)
+            # Segments predate actor_role; match their actors' current role.
+            archive['actor_ids'] = CustomUser.objects.filter(role=role).values_list('pk', flat=True)
 
-        if action:
-            action = action[:64]
-            qs = qs.filter(action__icontains=action)
-        return qs
+        if actions is not None:
+            qs = qs.filter(action__in=actions)
+            archive['actions'] = actions
+        # Entries moved to the cold tier are searched and paged through as well.
+        return AuditTrail(qs, ArchiveQuery(**archive))
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        page = keyset_page(self.object_list, self.request.GET, per_page=self.page_size)
+        filters = self.request.GET.copy()
+        for param in ('before', 'after', 'date', 'page'):
+            filters.pop(param, None)
+        ctx.update(logs=page.object_list, page=page, filter_query=filters.urlencode())
+        if self.request.GET.get('totals'):
+            ctx['approximate_total'], ctx['total_capped'] = self.object_list.approximate_count()
+        ctx['action_names'] = AuditAction.labels
+        ctx['action_prefixes'] = action_prefixes()
+        return ctx
 
 
 
@@ -597,12 +597,19 @@ class ManagePatientsView(AdminRequiredMixin, ListView):
     context_object_name = 'patients'
     paginate_by = 20
     def get_queryset(self):
-        qs = CustomUser.objects.filter(role=CustomUser.Role.PATIENT).select_related('patient_profile')
+        qs = CustomUser.objects.filter(role=CustomUser.Role.PATIENT).select_related('patient_profile').defer_encrypted(
+            'email', 'patient_profile__phone', 'patient_profile__date_of_birth'
+        )
         search = (self.request.GET.get('search') or '').strip()
         if search:
             search = search[:100]
-            qs = qs.filter(Q(username__icontains=search))
-        return qs.order_by('username')
+            qs = qs.filter(
+                Q(username__icontains=search)
+                | Q(email_hash=hash_email(search))
+                | blind_index.search_q(CustomUser, ['first_name', 'last_name'], search)
+                | blind_index.search_q(PatientProfile, ['phone'], search, lookup='patient_profile')
+            )
+        return qs.order_by('username').decrypt_in_batches()
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
@@ -610,7 +617,7 @@ class ManagePatientsView(AdminRequiredMixin, ListView):
         page = (self.request.GET.get('page') or '1').strip()[:10]
         log_phi_view(
             self.request,
-            action="VIEW_PATIENT_LIST_MANAGE",
+            action=AuditAction.VIEW_PATIENT_LIST_MANAGE,
             resource="Manage patients",
             patients=patients,
             extra_details=f"page={page or '1'}",
@@ -635,9 +642,9 @@ class DeletePatientView(AdminRequiredMixin, DeleteView):
         ctx['note_count'] = MedicalNote.objects.filter(patient=self.object).count()
         log_phi_view(
             self.request,
-            action="VIEW_PATIENT_DELETE_CONFIRM",
+            action=AuditAction.VIEW_PATIENT_DELETE_CONFIRM,
             resource="Delete patient confirm",
-            patient_usernames=[getattr(self.object, "username", "")],
+            patients=[self.object],
             extra_details=f"appointments={ctx['appointment_count']}, notes={ctx['note_count']}",
         )
         return ctx
@@ -653,14 +660,20 @@ class DeletePatientView(AdminRequiredMixin, DeleteView):
         email = self.object.email
         user_id = self.object.pk
 
+        sealed_username, sealed_email = seal_identifiers([(user_id, username), (user_id, email)])
         log_action(
             request,
-            "DELETE_USER",
-            resource=f"Patient: {username}",
-            details=f"Deleted patient account (id={user_id}, email={email})",
+            AuditAction.DELETE_USER,
+            resource=f"Patient: {sealed_username}",
+            details=f"Deleted patient account (id={user_id}, email={sealed_email})",
             user_obj=request.user,
         )
-        
+
+        # The cascade below deletes the profile, notes and appointments. Also
+        # destroying the data key makes the copies left in backups and
+        # replicas, and the identifiers sealed into audit entries, unreadable.
+        destroy_data_key(user_id)
+
         messages.success(request, f"Patient account '{username}' has been deleted.")
         return super().post(request, *args, **kwargs)
 
@@ -676,7 +689,10 @@ class TogglePatientStatusView(AdminRequiredMixin, View):
         user.save()
         
         status = "activated" if user.is_active else "deactivated"
-        log_action(request, "TOGGLE_PATIENT_STATUS", f"User: {user.username}, Active: {user.is_active}")
+        log_action(
+            request, AuditAction.TOGGLE_PATIENT_STATUS,
+            f"User: {seal_identifier(user.pk, user.username)}, Active: {user.is_active}",
+        )
         messages.success(request, f"Patient '{user.username}' has been {status}.")
         return redirect('clinic:manage_patients')
 
@@ -695,7 +711,7 @@ class PatientCreateView(AdminOrDoctorRequiredMixin, CreateView):
         response = super().form_valid(form)
         log_action(
             self.request, 
-            "CREATE_PATIENT", 
+            AuditAction.CREATE_PATIENT, 
             f"User: {form.instance.username}",
             f"Created by: {self.request.user.username} ({self.request.user.get_role_display()})"
         )
@@ -14,7 +14,37 @@ environ.Env.read_env(os.path.join(BASE_DIR, '.env'))
 SECRET_KEY = env('SECRET_KEY')  
 ALLOWED_HOSTS = env.list('ALLOWED_HOSTS')  
 
-FIELD_ENCRYPTION_KEY = env('FIELD_ENCRYPTION_KEY')  
+FIELD_ENCRYPTION_KEY = env('FIELD_ENCRYPTION_KEY', default='')
+# Versioned key ring, newest first: "<key id>:<fernet key>,<key id>:<fernet key>".
+# Takes precedence over FIELD_ENCRYPTION_KEY when set.
+FIELD_ENCRYPTION_KEYS = env.list('FIELD_ENCRYPTION_KEYS', default=[])
+# Cipher for new values: aes-gcm, chacha20-poly1305 or fernet. Values written
+# with any engine remain readable after switching.
+FIELD_ENCRYPTION_ENGINE = env('FIELD_ENCRYPTION_ENGINE', default='aes-gcm')
+FIELD_ENCRYPTION_LAZY_REENCRYPT = env.bool('FIELD_ENCRYPTION_LAZY_REENCRYPT', default=False)
+FIELD_DECRYPTION_CACHE_SIZE = env.int('FIELD_DECRYPTION_CACHE_SIZE', default=1024)
+# Seconds between decryption-failure emails for one field; see clinic.decryption_alerts.
+FIELD_DECRYPTION_ALERT_INTERVAL = env.int('FIELD_DECRYPTION_ALERT_INTERVAL', default=900)
+# Per-patient data key cache and how fast key destruction reaches other processes; see clinic.data_keys.
+FIELD_DATA_KEY_CACHE_SIZE = env.int('FIELD_DATA_KEY_CACHE_SIZE', default=1024)
+FIELD_DATA_KEY_CACHE_TTL = env.int('FIELD_DATA_KEY_CACHE_TTL', default=300)
+FIELD_DATA_KEY_SYNC_INTERVAL = env.float('FIELD_DATA_KEY_SYNC_INTERVAL', default=1.0)
+# Background audit writer and its crash spool; what a crash can lose is in audit.writer.
+AUDIT_LOG_ASYNC = env.bool('AUDIT_LOG_ASYNC', default=True)
+AUDIT_LOG_BATCH_SIZE = env.int('AUDIT_LOG_BATCH_SIZE', default=200)
+AUDIT_LOG_FLUSH_INTERVAL = env.float('AUDIT_LOG_FLUSH_INTERVAL', default=0.5)
+AUDIT_LOG_QUEUE_SIZE = env.int('AUDIT_LOG_QUEUE_SIZE', default=10000)
+AUDIT_LOG_SPOOL_DIR = env('AUDIT_LOG_SPOOL_DIR', default=str(BASE_DIR / 'audit_spool'))
+# Seconds over which identical PHI-view entries are merged (0 disables); see audit.writer.
+AUDIT_PHI_COALESCE_WINDOW = env.int('AUDIT_PHI_COALESCE_WINDOW', default=60)
+# Where archive_audit_log moves old audit entries, and after how long; see audit.archive.
+AUDIT_ARCHIVE_DIR = env('AUDIT_ARCHIVE_DIR', default=str(BASE_DIR / 'audit_archive'))
+AUDIT_ARCHIVE_AFTER_DAYS = env.int('AUDIT_ARCHIVE_AFTER_DAYS', default=90)
+# Checkpoint signing key and interval of the audit hash chain; see audit.chain.
+AUDIT_CHAIN_KEY = env('AUDIT_CHAIN_KEY', default='')
+AUDIT_CHAIN_CHECKPOINT_EVERY = env.int('AUDIT_CHAIN_CHECKPOINT_EVERY', default=10000)
+# HMAC key for searchable blind indexes; see clinic.blind_index.
+FIELD_BLIND_INDEX_KEY = env('FIELD_BLIND_INDEX_KEY', default='')
 
 DEBUG = env.bool('DEBUG', default=False)
 
@@ -34,6 +64,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'clinic.middleware.DecryptionCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -68,6 +99,11 @@ DATABASES = {
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+# Separate database for the audit tables and the cache table; see audit.routers.
+AUDIT_DATABASE_URL = env('AUDIT_DATABASE_URL', default='')
+if AUDIT_DATABASE_URL:
+    DATABASES['audit'] = env.db_url_config(AUDIT_DATABASE_URL)
+DATABASE_ROUTERS = ['audit.routers.AuditRouter']
 
 CACHES = {
     'default': {
@@ -75,6 +111,10 @@ CACHES = {
         'LOCATION': 'my_cache_table',
     }
 }
+# Where rate-limit counters live; "local" is single-host only, see audit.ratelimit.
+RATE_LIMIT_BACKEND = env('RATE_LIMIT_BACKEND', default='cache')
+RATE_LIMIT_PATH = env('RATE_LIMIT_PATH', default='')
+RATE_LIMIT_CACHE = env('RATE_LIMIT_CACHE', default='default')
 
 AUTH_USER_MODEL = 'accounts.CustomUser'
 LOGIN_REDIRECT_URL = 'dashboard'